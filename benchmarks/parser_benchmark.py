@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from index_db.db import dispose_engines, get_session_factory, init_db
+from index_db.operations import product_state_index
+from ozon_scraper import parser
+from ozon_scraper.scheduler import revisit_scheduler
+
+BENCHMARK_DATABASE_URL = "sqlite://"
+DEFAULT_FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+TIMED_FUNCTIONS = (
+    'identify_and_parse', 'parse_product', 'parse_brand', 'parse_seller', 'parse_category', 'parse_listing',
+    'parse_product_card', 'scrape_product_card', 'scrape_product_page', 'store_product',
+    'extract_product', 'extract_tile_cards',
+)
+
+
+class FixtureDriver:
+    # Serves recorded pages instead of a browser, keyed by canonical url
+    def __init__(self, fixtures_dir : str):
+        with open(os.path.join(fixtures_dir, "index.json"), "r") as f:
+            index = json.load(f)
+        self.pages = {}
+        for url, file_name in index.items():
+            with open(os.path.join(fixtures_dir, file_name), "r", encoding="utf-8") as f:
+                self.pages[url] = f.read()
+
+    def load_page(self, url : str, *args, **kwargs) -> str:
+        return self.pages.get(url, "")
+
+    def wait_page(self, *args, **kwargs) -> Optional[str]:
+        return None
+
+    def quit(self):
+        pass
+
+class FunctionStats:
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.retained = defaultdict(int)
+
+    def wrap(self, name : str, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            tracing = tracemalloc.is_tracing()
+            memory_before = tracemalloc.get_traced_memory()[0] if tracing else 0
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+                if tracing:
+                    self.retained[name] += tracemalloc.get_traced_memory()[0] - memory_before
+        return timed
+
+@contextlib.contextmanager
+def instrument(stats : FunctionStats):
+    # Parser functions call each other through module globals, so patching the module times nested calls too
+    originals = {name: getattr(parser, name) for name in TIMED_FUNCTIONS}
+    for name, function in originals.items():
+        setattr(parser, name, stats.wrap(name, function))
+    try:
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(parser, name, function)
+
+def fresh_session():
+    # Every iteration starts from an empty database, so sellers and brands are stale and every card is new
+    dispose_engines()
+    init_db(BENCHMARK_DATABASE_URL)
+    product_state_index.clear()
+    revisit_scheduler.intervals.clear()
+    return get_session_factory(BENCHMARK_DATABASE_URL)()
+
+def run_pass(driver : FixtureDriver, stats : FunctionStats) -> Dict[str, float]:
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        db = fresh_session()
+    try:
+        with instrument(stats), contextlib.redirect_stdout(output):
+            start = time.perf_counter()
+            for url in driver.pages:
+                parser.identify_and_parse(url, driver, db)
+            elapsed = time.perf_counter() - start
+    finally:
+        db.close()
+    errors = [line for line in output.getvalue().splitlines() if line.startswith("Exception occurred")]
+    return {'seconds' : elapsed, 'errors' : len(errors), 'error_lines' : errors}
+
+def run_benchmark(fixtures_dir : str, iterations : int = 5, warmup : int = 1, trace_memory : bool = True) -> dict:
+    driver = FixtureDriver(fixtures_dir)
+    if not driver.pages:
+        raise ValueError(f"No fixtures were found in {fixtures_dir}")
+    for _ in range(warmup):
+        run_pass(driver, FunctionStats())
+    stats = FunctionStats()
+    total_seconds = 0.0
+    errors = []
+    for _ in range(iterations):
+        result = run_pass(driver, stats)
+        total_seconds += result['seconds']
+        errors = result['error_lines']
+    report = {
+        'pages' : len(driver.pages),
+        'iterations' : iterations,
+        'pages_per_second' : len(driver.pages) * iterations / total_seconds if total_seconds else 0.0,
+        'errors' : errors,
+        'functions' : {
+            name: {
+                'calls' : stats.calls[name] // iterations,
+                'mean_ms' : stats.seconds[name] / stats.calls[name] * 1000,
+                'total_ms' : stats.seconds[name] / iterations * 1000,
+            }
+            for name in TIMED_FUNCTIONS if stats.calls[name]
+        },
+    }
+    if trace_memory:
+        # Allocation tracing slows every call down, so it gets a pass of its own
+        memory_stats = FunctionStats()
+        tracemalloc.start()
+        try:
+            run_pass(driver, memory_stats)
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        report['peak_kib'] = peak / 1024
+        for name, function_report in report['functions'].items():
+            function_report['retained_kib'] = memory_stats.retained[name] / 1024
+        top_sites = snapshot.filter_traces([tracemalloc.Filter(True, "*ozon_scraper*"), tracemalloc.Filter(True, "*index_db*")])
+        report['allocation_sites'] = [
+            {'site' : str(stat.traceback), 'kib' : stat.size / 1024, 'count' : stat.count}
+            for stat in top_sites.statistics('lineno')[:10]
+        ]
+    return report
+
+def compare(report : dict, baseline : dict, tolerance : float, min_ms : float = 0.5) -> List[str]:
+    # Functions faster than min_ms are dominated by timer noise and are not compared
+    regressions = []
+    base_speed = baseline.get('pages_per_second')
+    if base_speed and report['pages_per_second'] < base_speed * (1 - tolerance):
+        regressions.append(f"pages/sec {report['pages_per_second']:.1f} < baseline {base_speed:.1f}")
+    for name, function_report in report['functions'].items():
+        base_function = baseline.get('functions', {}).get(name)
+        if base_function and base_function['mean_ms'] >= min_ms and function_report['mean_ms'] > base_function['mean_ms'] * (1 + tolerance):
+            regressions.append(f"{name} {function_report['mean_ms']:.3f} ms > baseline {base_function['mean_ms']:.3f} ms")
+    return regressions
+
+def print_report(report : dict, baseline : dict = None):
+    print(f"Pages: {report['pages']}, iterations: {report['iterations']}, pages/sec: {report['pages_per_second']:.1f}")
+    if 'peak_kib' in report:
+        print(f"Peak traced memory: {report['peak_kib']:.0f} KiB")
+    print(f"{'function':<22}{'calls':>8}{'mean ms':>12}{'total ms':>12}{'retained KiB':>14}{'vs baseline':>13}")
+    for name, function_report in report['functions'].items():
+        base_function = (baseline or {}).get('functions', {}).get(name)
+        delta = ""
+        if base_function and base_function['mean_ms']:
+            delta = f"{(function_report['mean_ms'] / base_function['mean_ms'] - 1) * 100:+.1f}%"
+        print(
+            f"{name:<22}{function_report['calls']:>8}{function_report['mean_ms']:>12.3f}"
+            f"{function_report['total_ms']:>12.1f}{function_report.get('retained_kib', 0):>14.1f}{delta:>13}"
+        )
+    for site in report.get('allocation_sites', []):
+        print(f"  {site['kib']:>10.1f} KiB {site['count']:>8} blocks  {site['site']}")
+    if report['errors']:
+        print(f"{len(report['errors'])} pages failed to parse:")
+        for line in report['errors']:
+            print(f"  {line}")
+
+def record(urls : List[str], fixtures_dir : str, headless : bool = True):
+    # Pages are loaded with the same waits the crawler uses, so the recorded markup matches what the parser sees
+    from ozon_scraper.driver import ChromeDriver
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    index_path = os.path.join(fixtures_dir, "index.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    driver = ChromeDriver(headless=headless, block_profile="lean")
+    try:
+        for url in urls:
+            target = parser.identify_target(url)
+            if target is None:
+                print(f"Skipping {url}, it is not an Ozon page", flush=True)
+                continue
+            url, target_type = target
+            if target_type == "product":
+                html_src = driver.load_page(url, parser.PRODUCT_READY_SELECTORS, timeout=parser.PRODUCT_LOAD_TIMEOUTS[-1])
+            elif target_type in ("brand", "seller"):
+                html_src = driver.load_page(url, parser.LISTING_READY_SELECTORS, parser.LISTING_TILES_SELECTOR, 60)
+            else:
+                html_src = driver.load_page(url, (parser.LISTING_TILES_SELECTOR,), parser.LISTING_TILES_SELECTOR, 30)
+            file_name = f"{target_type}-{hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]}.html"
+            with open(os.path.join(fixtures_dir, file_name), "w", encoding="utf-8") as f:
+                f.write(html_src)
+            index[url] = file_name
+            print(f"Recorded {url}", flush=True)
+    finally:
+        driver.quit()
+        with open(index_path, "w") as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+
+def main(argv : List[str] = None) -> int:
+    arguments = argparse.ArgumentParser(description="Offline benchmark of the Ozon parsers over recorded pages")
+    commands = arguments.add_subparsers(dest="command", required=True)
+    record_command = commands.add_parser("record", help="Record pages with a browser into the fixtures directory")
+    record_command.add_argument("urls_file", help="File with one url per line")
+    record_command.add_argument("--fixtures", default=DEFAULT_FIXTURES_DIR)
+    record_command.add_argument("--headful", action="store_true")
+    run_command = commands.add_parser("run", help="Run the parsers over the recorded pages")
+    run_command.add_argument("--fixtures", default=DEFAULT_FIXTURES_DIR)
+    run_command.add_argument("--iterations", type=int, default=5)
+    run_command.add_argument("--warmup", type=int, default=1)
+    run_command.add_argument("--no-memory", action="store_true", help="Skip the allocation tracing pass")
+    run_command.add_argument("--baseline", default=DEFAULT_BASELINE)
+    run_command.add_argument("--save-baseline", action="store_true")
+    run_command.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown against the baseline")
+    run_command.add_argument("--min-ms", type=float, default=0.5, help="Functions faster than this are not compared")
+    options = arguments.parse_args(argv)
+
+    if options.command == "record":
+        with open(options.urls_file, "r") as f:
+            urls = [line.strip() for line in f if line.strip()]
+        record(urls, options.fixtures, headless=not options.headful)
+        return 0
+
+    report = run_benchmark(options.fixtures, options.iterations, options.warmup, not options.no_memory)
+    baseline = None
+    if os.path.exists(options.baseline):
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if options.save_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump({key: value for key, value in report.items() if key != 'errors'}, f, indent=2)
+        print(f"Baseline was saved to {options.baseline}")
+        return 0
+    if baseline:
+        regressions = compare(report, baseline, options.tolerance, options.min_ms)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,78 @@
-from sqlalchemy import create_engine, inspect
+import os
+from threading import Lock
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 
-from index_db.models import Base
+from index_db.models import Base, ProductCurrentState
+from index_db.operations import ProductRepository
+
+_engines = {}
+_session_factories = {}
+_registry_lock = Lock()
+
+def get_engine(db_url : str, pool_size : int = None, max_overflow : int = None, pool_pre_ping : bool = True):
+    with _registry_lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            options = {'echo' : False, 'pool_pre_ping' : pool_pre_ping}
+            # SQLite engines use their own pool classes without overflow settings
+            if make_url(db_url).get_backend_name() != 'sqlite':
+                options['pool_size'] = pool_size or int(os.getenv('DB_POOL_SIZE', 5))
+                options['max_overflow'] = max_overflow or int(os.getenv('DB_MAX_OVERFLOW', 10))
+                options['pool_recycle'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+            engine = create_engine(db_url, **options)
+            _engines[db_url] = engine
+        return engine
+
+def get_session_factory(db_url : str):
+    engine = get_engine(db_url)
+    with _registry_lock:
+        factory = _session_factories.get(db_url)
+        if factory is None:
+            factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            _session_factories[db_url] = factory
+        return factory
+
+def dispose_engines():
+    with _registry_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _session_factories.clear()
 
 def init_db(db_url : str):
-    engine = create_engine(db_url, echo=False)
+    engine = get_engine(db_url)
     inspector = inspect(engine)
     tables = inspector.get_table_names()
     if not tables:
         Base.metadata.create_all(bind=engine)
         print(f"Database was created with tables {list(Base.metadata.tables.keys())}")
     else:
+        missing_tables = [table for table in Base.metadata.tables.keys() if table not in tables]
+        if missing_tables:
+            Base.metadata.create_all(bind=engine)
+            print(f"Database was extended with tables: {missing_tables}")
+        if ProductCurrentState.__tablename__ in missing_tables:
+            db = get_session_factory(db_url)()
+            try:
+                ProductRepository.rebuild_current_states(db)
+            finally:
+                db.close()
         print(f"Database already exist with tables: {tables}")
+    create_search_indexes(engine)
+
+def create_search_indexes(engine):
+    # Product names are searched by substrings, only trigram indexes can serve such queries
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products USING gin (name gin_trgm_ops)"))
 
 def get_db(db_url : str):
-    engine = create_engine(db_url, echo=False)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    SessionLocal = get_session_factory(db_url)
     db = SessionLocal()
     try:
         yield db
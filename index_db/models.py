@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import datetime
@@ -10,7 +10,7 @@ class Brand(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False, unique=True)
     url = Column(String, nullable=True)
-    last_update = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
+    last_update = Column(DateTime, nullable=True)
     products = relationship("Product", back_populates="brand")
 
 class Seller(Base):
@@ -18,7 +18,7 @@ class Seller(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False, unique=True)
     url = Column(String, nullable=True)
-    last_update = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
+    last_update = Column(DateTime, nullable=True)
     products = relationship("Product", back_populates="seller")
 
 class Product(Base):
@@ -36,6 +36,7 @@ class Product(Base):
     seller = relationship("Seller", back_populates="products")
 
     product_history = relationship("ProductHistory", back_populates="product")
+    current_state = relationship("ProductCurrentState", back_populates="product", uselist=False)
 
 class ProductHistory(Base):
     __tablename__ = "products_history"
@@ -50,6 +51,73 @@ class ProductHistory(Base):
     on_sale = Column(Boolean, default=False)
     hash = Column(String, nullable=False)
 
-    created_at = Column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
 
     product = relationship("Product", back_populates="product_history")
+
+class ProductCurrentState(Base):
+    __tablename__ = "products_current_state"
+
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    history_id = Column(Integer, ForeignKey("products_history.id"), nullable=False)
+    hash = Column(String, nullable=False)
+
+    product = relationship("Product", back_populates="current_state")
+    state = relationship("ProductHistory")
+
+class ProductPageVisit(Base):
+    __tablename__ = "products_page_visits"
+
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    visited_at = Column(DateTime, nullable=False)
+
+class CrawlTask(Base):
+    __tablename__ = "crawl_frontier"
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, nullable=False, unique=True, index=True)
+    url = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="pending", index=True)
+
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    visited_at = Column(DateTime, nullable=True)
+
+class CrawlLease(Base):
+    __tablename__ = "crawl_leases"
+
+    task_id = Column(Integer, ForeignKey("crawl_frontier.id"), primary_key=True)
+    owner = Column(String, nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class ProductRollup(Base):
+    __tablename__ = "products_rollups"
+    __table_args__ = (UniqueConstraint("product_id", "resolution", "bucket_start"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    resolution = Column(String, nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    states_count = Column(Integer, nullable=False, default=0)
+
+    min_price = Column(Float)
+    max_price = Column(Float)
+    last_price = Column(Float)
+    min_price_ozon_card = Column(Float)
+    max_price_ozon_card = Column(Float)
+    last_price_ozon_card = Column(Float)
+    min_rating = Column(Float)
+    max_rating = Column(Float)
+    last_rating = Column(Float)
+    min_review_count = Column(Integer)
+    max_review_count = Column(Integer)
+    last_review_count = Column(Integer)
+    last_question_count = Column(Integer)
+    last_on_sale = Column(Boolean)
+    last_at = Column(DateTime)
+    last_history_id = Column(Integer)
+
+class RollupWatermark(Base):
+    __tablename__ = "rollup_watermarks"
+
+    resolution = Column(String, primary_key=True)
+    history_id = Column(Integer, nullable=False, default=0)
@@ -2,10 +2,17 @@ import hashlib
 import json
 import datetime
 import re
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from typing import List, Tuple, Optional
 
+from sqlalchemy import insert, delete, select, update, func, and_, false
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from index_db.models import Product, ProductHistory, Brand, Seller
+from index_db.models import Product, ProductHistory, ProductCurrentState, ProductPageVisit, Brand, Seller, CrawlTask, CrawlLease
 
 def normalize_text(text : str) -> str:
     lower_text = text.lower()
@@ -13,6 +20,201 @@ def normalize_text(text : str) -> str:
     normalized_text = re.sub(r"\s+", " ", cleared_text).strip()
     return normalized_text
 
+def as_number(value) -> Optional[float]:
+    try:
+        return float(str(value).replace(',', '.')) if value not in (None, '') else None
+    except ValueError:
+        return None
+
+def utc_now() -> datetime.datetime:
+    # Lease times are compared in the database, so they are written as naive UTC on every backend
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def naive_utc(moment : datetime.datetime) -> datetime.datetime:
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+# A crawled state is written moments after its page was archived, replays match it within this window
+REPLAY_MATCH_SECONDS = 600
+
+def next_update_time(db : Session, last_update : Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    # Replayed pages only move the update time forward to when they were fetched, None keeps it as it is
+    observed_at = db.info.get('observed_at')
+    if observed_at is None:
+        return datetime.datetime.now(datetime.timezone.utc)
+    observed_at = naive_utc(observed_at)
+    if last_update is not None and naive_utc(last_update) >= observed_at:
+        return None
+    return observed_at
+
+def persist(db : Session, instance=None):
+    # Inside a batch the changes are only flushed, so generated ids are available
+    # to the following statements, and the whole batch is committed at once
+    if db.info.get('batch_depth'):
+        db.flush()
+    else:
+        db.commit()
+        if instance is not None:
+            db.refresh(instance)
+
+@contextmanager
+def batch(db : Session):
+    db.info['batch_depth'] = db.info.get('batch_depth', 0) + 1
+    outermost = db.info['batch_depth'] == 1
+    try:
+        yield db
+        if outermost:
+            pending_states = db.info.get('pending_states')
+            if pending_states:
+                history_ids = db.scalars(
+                    insert(ProductHistory).returning(ProductHistory.id, sort_by_parameter_order=True),
+                    pending_states
+                ).all()
+                ProductRepository.set_current_states(db, [
+                    (state['product_id'], history_id, state['hash'])
+                    for state, history_id, is_current in zip(pending_states, history_ids, db.info['pending_current'])
+                    if is_current
+                ])
+            db.commit()
+            product_state_index.update(
+                db.info.get('pending_index'), db.info.get('pending_products'), db.info.get('pending_visits')
+            )
+    except Exception:
+        if outermost:
+            db.rollback()
+        raise
+    finally:
+        db.info['batch_depth'] -= 1
+        if outermost:
+            db.info.pop('pending_states', None)
+            db.info.pop('pending_current', None)
+            db.info.pop('pending_hashes', None)
+            db.info.pop('pending_index', None)
+            db.info.pop('pending_products', None)
+            db.info.pop('pending_visits', None)
+
+class ProductStateIndex:
+    # Listing cards are checked against memory, so unchanged cards of known products cost no queries
+    def __init__(self):
+        self.hashes = {}
+        self.product_ids = {}
+        self.visits = {}
+        self.lock = Lock()
+        self.warmed = False
+
+    def warm(self, db : Session):
+        rows = db.query(Product.pk, Product.id, ProductCurrentState.hash, ProductPageVisit.visited_at) \
+            .outerjoin(ProductCurrentState, ProductCurrentState.product_id == Product.id) \
+            .outerjoin(ProductPageVisit, ProductPageVisit.product_id == Product.id)
+        hashes, product_ids, visits = {}, {}, {}
+        for pk, product_id, state_hash, visited_at in rows:
+            product_ids[pk] = product_id
+            if state_hash is not None:
+                hashes[pk] = state_hash
+            if visited_at is not None:
+                visits[product_id] = visited_at
+        with self.lock:
+            self.hashes = hashes
+            self.product_ids = product_ids
+            self.visits = visits
+            self.warmed = True
+        print(f"Product state index was warmed with {len(product_ids)} products", flush=True)
+
+    def clear(self):
+        with self.lock:
+            self.hashes = {}
+            self.product_ids = {}
+            self.visits = {}
+            self.warmed = True
+
+    def get(self, db : Session, product_pk : int) -> Optional[str]:
+        if not self.warmed:
+            self.warm(db)
+        return self.hashes.get(product_pk)
+
+    def get_product_id(self, db : Session, product_pk : int) -> Optional[int]:
+        if not self.warmed:
+            self.warm(db)
+        return self.product_ids.get(product_pk)
+
+    def get_visited_at(self, db : Session, product_id : int) -> Optional[datetime.datetime]:
+        if not self.warmed:
+            self.warm(db)
+        return self.visits.get(product_id)
+
+    def update(self, hashes : Optional[dict] = None, product_ids : Optional[dict] = None, visits : Optional[dict] = None):
+        if hashes or product_ids or visits:
+            with self.lock:
+                self.hashes.update(hashes or {})
+                self.product_ids.update(product_ids or {})
+                for product_id, visited_at in (visits or {}).items():
+                    if self.visits.get(product_id) is None or self.visits[product_id] < visited_at:
+                        self.visits[product_id] = visited_at
+
+product_state_index = ProductStateIndex()
+
+def get_trigrams(token : str) -> set:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+class ProductSearchIndex:
+    # Inverted index over normalized product names, used where the database has no trigram indexes.
+    # Products are never renamed, so the index only has to pick up rows with a larger id.
+    def __init__(self):
+        self.lock = Lock()
+        self.last_product_id = 0
+        self.names = {}
+        self.token_products = defaultdict(set)
+        self.trigram_tokens = defaultdict(set)
+
+    def refresh(self, db : Session):
+        with self.lock:
+            rows = db.query(Product.id, Product.name).filter(Product.id > self.last_product_id).order_by(Product.id)
+            for product_id, name in rows:
+                name = normalize_text(name)
+                self.names[product_id] = name
+                for token in name.split():
+                    if token not in self.token_products:
+                        for trigram in get_trigrams(token):
+                            self.trigram_tokens[trigram].add(token)
+                    self.token_products[token].add(product_id)
+                self.last_product_id = product_id
+
+    def matching_tokens(self, word : str) -> set:
+        trigrams = get_trigrams(word)
+        if not trigrams:
+            return {token for token in self.token_products if word in token}
+        candidates = set.intersection(*(self.trigram_tokens.get(trigram, set()) for trigram in trigrams))
+        return {token for token in candidates if word in token}
+
+    def search(self, db : Session, query : str, limit : Optional[int] = None) -> List[int]:
+        words = normalize_text(query).split()
+        if not words:
+            return []
+        self.refresh(db)
+        with self.lock:
+            scores = None
+            for word in words:
+                word_scores = {}
+                for token in self.matching_tokens(word):
+                    token_score = 3 if token == word else 2 if token.startswith(word) else 1
+                    for product_id in self.token_products[token]:
+                        word_scores[product_id] = max(word_scores.get(product_id, 0), token_score)
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {product_id: score + word_scores[product_id] for product_id, score in scores.items() if product_id in word_scores}
+                if not scores:
+                    return []
+            phrase = " ".join(words)
+            ranked = sorted(
+                scores,
+                key=lambda product_id: (-scores[product_id], phrase not in self.names[product_id], len(self.names[product_id]), product_id)
+            )
+        return ranked[:limit] if limit else ranked
+
+product_search_index = ProductSearchIndex()
+
 class BrandRepository:
     @staticmethod
     def get_by_id(db : Session, brand_id : int):
@@ -33,8 +235,7 @@ class BrandRepository:
             raise KeyError(f"Brand with id {brand_id} does not exist!")
         if brand.url != new_url:
             brand.url = new_url
-            db.commit()
-            db.refresh(brand)
+            persist(db, brand)
         return brand
 
     @staticmethod
@@ -42,9 +243,10 @@ class BrandRepository:
         brand = BrandRepository.get_by_id(db, brand_id)
         if brand is None:
             raise KeyError(f"Brand with id {brand_id} does not exist!")
-        brand.last_update = datetime.datetime.now(datetime.timezone.utc)
-        db.commit()
-        db.refresh(brand)
+        last_update = next_update_time(db, brand.last_update)
+        if last_update is not None:
+            brand.last_update = last_update
+            persist(db, brand)
         return brand
 
     @staticmethod
@@ -53,8 +255,7 @@ class BrandRepository:
         if not brand:
             brand = Brand(name=name, url=url)
             db.add(brand)
-            db.commit()
-            db.refresh(brand)
+            persist(db, brand)
         elif url is not None:
             brand = BrandRepository.change_url(db, brand.id, url)
         return brand
@@ -83,8 +284,7 @@ class SellerRepository:
             raise KeyError(f"Seller with id {seller_id} does not exist!")
         if seller.url != new_url:
             seller.url = new_url
-            db.commit()
-            db.refresh(seller)
+            persist(db, seller)
         return seller
 
     @staticmethod
@@ -92,9 +292,10 @@ class SellerRepository:
         seller = SellerRepository.get_by_id(db, seller_id)
         if seller is None:
             raise KeyError(f"Seller with id {seller_id} does not exist!")
-        seller.last_update = datetime.datetime.now(datetime.timezone.utc)
-        db.commit()
-        db.refresh(seller)
+        last_update = next_update_time(db, seller.last_update)
+        if last_update is not None:
+            seller.last_update = last_update
+            persist(db, seller)
         return seller
 
     @staticmethod
@@ -103,8 +304,7 @@ class SellerRepository:
         if not seller:
             seller = Seller(name=name, url=url)
             db.add(seller)
-            db.commit()
-            db.refresh(seller)
+            persist(db, seller)
         elif url is not None:
             seller = SellerRepository.change_url(db, seller.id, url)
         return seller
@@ -130,9 +330,33 @@ class ProductRepository:
     def get_by_pk(db : Session, product_pk : int):
         return db.query(Product).filter(Product.pk == product_pk).first()
 
+    @staticmethod
+    def uses_trigram_search(db : Session) -> bool:
+        return db.get_bind().dialect.name == 'postgresql'
+
+    @staticmethod
+    def filter_by_keyword(db : Session, query, product_keyword : str):
+        # Every word has to be found in the name, the trigram similarity to the whole phrase ranks the rows
+        words = normalize_text(product_keyword).split()
+        if not words:
+            return query.filter(false())
+        return query.filter(and_(*[Product.name.ilike(f"%{word}%") for word in words])) \
+            .order_by(func.similarity(Product.name, " ".join(words)).desc(), Product.id)
+
+    @staticmethod
+    def order_by_search_rank(rows, ranked_ids : List[int], get_id):
+        ranks = {product_id: rank for rank, product_id in enumerate(ranked_ids)}
+        return sorted(rows, key=lambda row: ranks[get_id(row)])
+
     @staticmethod
     def get_by_keyword(db : Session, product_keyword : str):
-        return db.query(Product).filter(Product.name.like(f"%{product_keyword}%")).all()
+        if ProductRepository.uses_trigram_search(db):
+            return ProductRepository.filter_by_keyword(db, db.query(Product), product_keyword).all()
+        product_ids = product_search_index.search(db, product_keyword)
+        if not product_ids:
+            return []
+        products = db.query(Product).filter(Product.id.in_(product_ids)).all()
+        return ProductRepository.order_by_search_rank(products, product_ids, lambda product: product.id)
 
     @staticmethod
     def get_or_create(db : Session, product_description : dict):
@@ -144,61 +368,446 @@ class ProductRepository:
                 seller_id=product_description['seller_id']
             )
             db.add(product)
-            db.commit()
-            db.refresh(product)
+            persist(db, product)
+            ProductRepository.index_product(db, product)
         return product
 
+    @staticmethod
+    def index_product(db : Session, product : Product):
+        # Rows written in a batch reach the index only once it is committed
+        if db.info.get('batch_depth'):
+            db.info.setdefault('pending_products', {})[product.pk] = product.id
+        else:
+            product_state_index.update(product_ids={product.pk: product.id})
+
     @staticmethod
     def get_product_count(db : Session):
         return db.query(Product).count()
 
     @staticmethod
     def get_last_state(db: Session, product_id: int):
-        return db.query(ProductHistory).filter(ProductHistory.product_id == product_id).order_by(ProductHistory.created_at.desc()).first()
+        return db.query(ProductHistory) \
+            .join(ProductCurrentState, ProductCurrentState.history_id == ProductHistory.id) \
+            .filter(ProductCurrentState.product_id == product_id).first()
+
+    @staticmethod
+    def page_fields_changed(db : Session, product : Product, product_description : dict) -> bool:
+        # The hash only covers what listing cards show, the fields only product pages show are compared with the last state
+        if product.seller_id != product_description['seller_id']:
+            return True
+        last_state = ProductRepository.get_last_state(db, product.id)
+        if last_state is None:
+            return False
+        return as_number(last_state.price) != as_number(product_description['price']) \
+            or (last_state.question_count or 0) != (product_description['question_count'] or 0)
+
+    @staticmethod
+    def change_seller(db : Session, product : Product, seller_id : int):
+        observed_at = db.info.get('observed_at')
+        if observed_at is not None and not ProductRepository.is_newer_than_current(db, product.id, naive_utc(observed_at)):
+            return product
+        if product.seller_id != seller_id:
+            product.seller_id = seller_id
+            persist(db, product)
+        return product
+
+    @staticmethod
+    def get_page_visited_at(db : Session, product_id : int) -> Optional[datetime.datetime]:
+        return db.query(ProductPageVisit.visited_at).filter(ProductPageVisit.product_id == product_id).scalar()
+
+    @staticmethod
+    def mark_page_visited(db : Session, product_id : int):
+        # Cards do not show the seller, the regular price and the questions, this is when they were last read
+        observed_at = db.info.get('observed_at')
+        visited_at = naive_utc(observed_at) if observed_at else utc_now()
+        visit = db.get(ProductPageVisit, product_id)
+        if visit is None:
+            db.add(ProductPageVisit(product_id=product_id, visited_at=visited_at))
+        elif visit.visited_at < visited_at:
+            visit.visited_at = visited_at
+        persist(db)
+        if db.info.get('batch_depth'):
+            db.info.setdefault('pending_visits', {})[product_id] = visited_at
+        else:
+            product_state_index.update(visits={product_id: visited_at})
+
+    @staticmethod
+    def get_last_hash(db : Session, product_id : int) -> Optional[str]:
+        return db.query(ProductCurrentState.hash).filter(ProductCurrentState.product_id == product_id).scalar()
+
+    @staticmethod
+    def set_current_states(db : Session, states : List[Tuple[int, int, str]]):
+        # Later states of the same product win
+        current_states = {product_id: (history_id, state_hash) for product_id, history_id, state_hash in states}
+        if not current_states:
+            return
+        rows = [
+            {'product_id' : product_id, 'history_id' : history_id, 'hash' : state_hash}
+            for product_id, (history_id, state_hash) in current_states.items()
+        ]
+        dialect = db.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            # Another transaction may write the same product meanwhile, the upsert never conflicts with it
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            statement = dialect_insert(ProductCurrentState)
+            db.execute(statement.on_conflict_do_update(
+                index_elements=['product_id'],
+                set_={'history_id' : statement.excluded.history_id, 'hash' : statement.excluded.hash}
+            ), rows)
+            return
+        db.execute(delete(ProductCurrentState).where(ProductCurrentState.product_id.in_(list(current_states))))
+        db.execute(insert(ProductCurrentState), rows)
+
+    @staticmethod
+    def rebuild_current_states(db : Session):
+        last_states = select(func.max(ProductHistory.id)).group_by(ProductHistory.product_id)
+        db.execute(delete(ProductCurrentState))
+        db.execute(insert(ProductCurrentState).from_select(
+            ['product_id', 'history_id', 'hash'],
+            select(ProductHistory.product_id, ProductHistory.id, ProductHistory.hash).where(ProductHistory.id.in_(last_states))
+        ))
+        db.commit()
+
+    @staticmethod
+    def query_current_states(db : Session):
+        return db.query(Product, ProductHistory, Brand, Seller) \
+            .join(ProductCurrentState, ProductCurrentState.product_id == Product.id) \
+            .join(ProductHistory, ProductHistory.id == ProductCurrentState.history_id) \
+            .outerjoin(Brand, Brand.id == Product.brand_id) \
+            .join(Seller, Seller.id == Product.seller_id)
+
+    @staticmethod
+    def fetch(query, batch_size : Optional[int] = None):
+        # With batch_size the rows are streamed from a server side cursor instead of being loaded at once
+        if batch_size:
+            return query.yield_per(batch_size)
+        return query.all()
+
+    @staticmethod
+    def get_current_by_seller_id(db : Session, seller_id : int, batch_size : Optional[int] = None):
+        query = ProductRepository.query_current_states(db).filter(Product.seller_id == seller_id)
+        return ProductRepository.fetch(query, batch_size)
+
+    @staticmethod
+    def get_current_by_brand_id(db : Session, brand_id : int, batch_size : Optional[int] = None):
+        query = ProductRepository.query_current_states(db).filter(Product.brand_id == brand_id)
+        return ProductRepository.fetch(query, batch_size)
+
+    @staticmethod
+    def get_current_by_keyword(db : Session, product_keyword : str, batch_size : Optional[int] = None):
+        query = ProductRepository.query_current_states(db)
+        if ProductRepository.uses_trigram_search(db):
+            return ProductRepository.fetch(ProductRepository.filter_by_keyword(db, query, product_keyword), batch_size)
+        product_ids = product_search_index.search(db, product_keyword)
+        if not product_ids:
+            return []
+        rows = query.filter(Product.id.in_(product_ids)).all()
+        return ProductRepository.order_by_search_rank(rows, product_ids, lambda row: row[0].id)
+
+    @staticmethod
+    def get_keyword_product_ids(db : Session, product_keyword : str) -> List[int]:
+        if ProductRepository.uses_trigram_search(db):
+            return [product_id for product_id, in ProductRepository.filter_by_keyword(db, db.query(Product.id), product_keyword)]
+        return product_search_index.search(db, product_keyword)
+
+    @staticmethod
+    def get_history_columns(db : Session, seller_id : Optional[int] = None, brand_id : Optional[int] = None,
+                            product_ids : Optional[List[int]] = None) -> List[tuple]:
+        # Plain tuples of the numeric columns only, analytics load them into arrays without building ORM objects
+        query = select(
+            ProductHistory.product_id, ProductHistory.price, ProductHistory.price_ozon_card,
+            ProductHistory.on_sale, ProductHistory.created_at
+        ).join(Product, Product.id == ProductHistory.product_id)
+        if seller_id is not None:
+            query = query.where(Product.seller_id == seller_id)
+        if brand_id is not None:
+            query = query.where(Product.brand_id == brand_id)
+        if product_ids is not None:
+            query = query.where(Product.id.in_(product_ids))
+        return db.execute(query.order_by(ProductHistory.product_id, ProductHistory.created_at, ProductHistory.id)).all()
+
+    @staticmethod
+    def get_products_info(db : Session, product_ids : List[int]) -> List[tuple]:
+        return db.query(Product.id, Product.pk, Product.name, Product.url, Seller.name) \
+            .join(Seller, Seller.id == Product.seller_id) \
+            .filter(Product.id.in_(product_ids)).all()
+
+    @staticmethod
+    def get_current_prices_by_names(db : Session, names : List[str]) -> List[tuple]:
+        return db.query(Product.id, Product.name, ProductHistory.price_ozon_card) \
+            .join(ProductCurrentState, ProductCurrentState.product_id == Product.id) \
+            .join(ProductHistory, ProductHistory.id == ProductCurrentState.history_id) \
+            .filter(Product.name.in_(names)).all()
+
+    @staticmethod
+    def get_data_version(db : Session, seller_id : Optional[int] = None, brand_id : Optional[int] = None,
+                         product_id : Optional[int] = None) -> Tuple[Optional[int], int]:
+        # History ids only grow, so the latest one together with the product count changes
+        # whenever a state is written or a product appears for the selected entity
+        query = db.query(func.max(ProductCurrentState.history_id), func.count(ProductCurrentState.product_id)) \
+            .join(Product, Product.id == ProductCurrentState.product_id)
+        if seller_id is not None:
+            query = query.filter(Product.seller_id == seller_id)
+        if brand_id is not None:
+            query = query.filter(Product.brand_id == brand_id)
+        if product_id is not None:
+            query = query.filter(Product.id == product_id)
+        last_history_id, products_count = query.one()
+        return last_history_id, products_count
+
+    @staticmethod
+    def get_last_history_id(db : Session, product_id : Optional[int] = None, seller_id : Optional[int] = None,
+                            brand_id : Optional[int] = None) -> Optional[int]:
+        # Reports over the whole history change with any new row, current or not
+        query = db.query(func.max(ProductHistory.id)).join(Product, Product.id == ProductHistory.product_id)
+        if product_id is not None:
+            query = query.filter(ProductHistory.product_id == product_id)
+        if seller_id is not None:
+            query = query.filter(Product.seller_id == seller_id)
+        if brand_id is not None:
+            query = query.filter(Product.brand_id == brand_id)
+        return query.scalar()
+
+    @staticmethod
+    def get_change_stats(db : Session, seller_id : Optional[int] = None, brand_id : Optional[int] = None,
+                         product_id : Optional[int] = None) -> Tuple[int, Optional[datetime.datetime]]:
+        # add_state writes a row only when the hash changes, so every row but the first one of a product is a change
+        query = db.query(
+            func.count(ProductHistory.id) - func.count(func.distinct(ProductHistory.product_id)),
+            func.min(ProductHistory.created_at)
+        ).join(Product, Product.id == ProductHistory.product_id)
+        if seller_id is not None:
+            query = query.filter(Product.seller_id == seller_id)
+        if brand_id is not None:
+            query = query.filter(Product.brand_id == brand_id)
+        if product_id is not None:
+            query = query.filter(Product.id == product_id)
+        changes, first_seen = query.one()
+        return changes or 0, first_seen
+
+    @staticmethod
+    def get_all_change_stats(db : Session, group_by):
+        return db.query(
+            group_by,
+            func.count(ProductHistory.id) - func.count(func.distinct(ProductHistory.product_id)),
+            func.min(ProductHistory.created_at),
+            func.max(ProductHistory.created_at)
+        ).join(Product, Product.id == ProductHistory.product_id).group_by(group_by).all()
 
     @staticmethod
     def get_by_seller_id(db : Session, seller_id : int):
-        seller_products = db.query(Product).filter(Product.seller_id == seller_id)
-        if seller_products is None:
-            return None
-        current_product = [
-            (product, ProductRepository.get_last_state(db, product.id)) for product in seller_products
+        return [
+            (product, state) for product, state, _, _ in ProductRepository.get_current_by_seller_id(db, seller_id)
         ]
-        return current_product
 
     @staticmethod
     def get_by_brand_id(db : Session, brand_id : int):
-        brand_products = db.query(Product).filter(Product.brand_id == brand_id)
-        if brand_products is None:
-            return None
-        current_product = [
-            (product, ProductRepository.get_last_state(db, product.id)) for product in brand_products
+        return [
+            (product, state) for product, state, _, _ in ProductRepository.get_current_by_brand_id(db, brand_id)
         ]
-        return current_product
 
     @staticmethod
     def get_product_history(db : Session, product_id : int):
         return db.query(ProductHistory).filter(ProductHistory.product_id == product_id).order_by(ProductHistory.created_at.desc())
 
     @staticmethod
-    def add_state(db: Session, product_id: int, product_description: dict):
+    def replayed_state_exists(db : Session, product_id : int, state_hash : str, observed_at : datetime.datetime) -> bool:
+        window = datetime.timedelta(seconds=REPLAY_MATCH_SECONDS)
+        return db.query(ProductHistory.id).filter(
+            ProductHistory.product_id == product_id,
+            ProductHistory.hash == state_hash,
+            ProductHistory.created_at.between(observed_at - window, observed_at + window)
+        ).first() is not None
+
+    @staticmethod
+    def get_hash_at(db : Session, product_id : int, moment : datetime.datetime) -> Optional[str]:
+        return db.query(ProductHistory.hash).filter(
+            ProductHistory.product_id == product_id, ProductHistory.created_at <= moment
+        ).order_by(ProductHistory.created_at.desc(), ProductHistory.id.desc()).limit(1).scalar()
+
+    @staticmethod
+    def get_current_created_at(db : Session, product_id : int) -> Optional[datetime.datetime]:
+        return db.query(ProductHistory.created_at) \
+            .join(ProductCurrentState, ProductCurrentState.history_id == ProductHistory.id) \
+            .filter(ProductCurrentState.product_id == product_id).scalar()
+
+    @staticmethod
+    def is_newer_than_current(db : Session, product_id : int, observed_at : datetime.datetime) -> bool:
+        current_created_at = ProductRepository.get_current_created_at(db, product_id)
+        return current_created_at is None or observed_at > naive_utc(current_created_at)
+
+    @staticmethod
+    def add_state(db: Session, product_id: int, product_description: dict, force : bool = False):
         new_hash = ProductRepository.compute_product_hash(product_description)
-        last_price_entry = ProductRepository.get_last_state(db, product_id)
-
-        if last_price_entry and last_price_entry.hash == new_hash:
-            return None
-
-        new_price_entry = ProductHistory(
-            product_id=product_id,
-            price=product_description['price'],
-            price_ozon_card=product_description['price_ozon_card'],
-            rating=product_description['rating'],
-            review_count=product_description['review_count'],
-            question_count=product_description['question_count'],
-            on_sale=product_description['on_sale'],
-            hash=new_hash
-        )
+        observed_at = db.info.get('observed_at')
+        is_current = True
+        if observed_at is not None:
+            # Replayed pages are compared with the state in force when they were fetched, and a page
+            # that was already ingested, when it was crawled or by an earlier replay, adds nothing
+            observed_at = naive_utc(observed_at)
+            if ProductRepository.replayed_state_exists(db, product_id, new_hash, observed_at):
+                return None
+            if ProductRepository.get_hash_at(db, product_id, observed_at) == new_hash and not force:
+                return None
+            is_current = ProductRepository.is_newer_than_current(db, product_id, observed_at)
+        else:
+            pending_hashes = db.info.get('pending_hashes', {})
+            if product_id in pending_hashes:
+                last_hash = pending_hashes[product_id]
+            else:
+                last_hash = ProductRepository.get_last_hash(db, product_id)
+            if last_hash == new_hash and not force:
+                return None
+
+        new_state = {
+            'product_id' : product_id,
+            'price' : product_description['price'],
+            'price_ozon_card' : product_description['price_ozon_card'],
+            'rating' : product_description['rating'],
+            'review_count' : product_description['review_count'],
+            'question_count' : product_description['question_count'],
+            'on_sale' : product_description['on_sale'],
+            'hash' : new_hash,
+            # Replayed pages carry the time they were fetched at
+            'created_at' : observed_at or datetime.datetime.now(datetime.timezone.utc)
+        }
+        product_pk = product_description.get('pk')
+        if db.info.get('batch_depth'):
+            db.info.setdefault('pending_states', []).append(new_state)
+            db.info.setdefault('pending_current', []).append(is_current)
+            if is_current:
+                db.info.setdefault('pending_hashes', {})[product_id] = new_hash
+                if product_pk is not None:
+                    db.info.setdefault('pending_index', {})[product_pk] = new_hash
+            return ProductHistory(**new_state)
+
+        new_price_entry = ProductHistory(**new_state)
         db.add(new_price_entry)
-        db.commit()
-        db.refresh(new_price_entry)
+        db.flush()
+        if is_current:
+            ProductRepository.set_current_states(db, [(product_id, new_price_entry.id, new_hash)])
+        persist(db, new_price_entry)
+        if product_pk is not None and is_current:
+            product_state_index.update({product_pk: new_hash})
         return new_price_entry
+
+class FrontierRepository:
+    @staticmethod
+    def get_pending(db : Session):
+        # Tasks leased by worker processes of an earlier distributed run were never finished either
+        return db.query(CrawlTask).filter(CrawlTask.status.in_(("pending", "leased"))).order_by(CrawlTask.id).all()
+
+    @staticmethod
+    def get_keys(db : Session):
+        return {key for key, in db.query(CrawlTask.key)}
+
+    @staticmethod
+    def add_many(db : Session, tasks : List[Tuple[str, str]]):
+        new_tasks = [CrawlTask(key=key, url=url) for key, url in tasks]
+        if new_tasks:
+            db.add_all(new_tasks)
+            db.commit()
+        return new_tasks
+
+    @staticmethod
+    def requeue(db : Session, key : str, url : str):
+        task = db.query(CrawlTask).filter(CrawlTask.key == key).first()
+        if task is None:
+            task = CrawlTask(key=key, url=url)
+            db.add(task)
+        task.status = "pending"
+        db.commit()
+        return task
+
+    @staticmethod
+    def mark_visited(db : Session, key : str):
+        task = db.query(CrawlTask).filter(CrawlTask.key == key).first()
+        if task is None:
+            raise KeyError(f"Crawl task {key} does not exist!")
+        task.status = "visited"
+        task.visited_at = datetime.datetime.now(datetime.timezone.utc)
+        db.commit()
+        return task
+
+    @staticmethod
+    def add_many_ignore(db : Session, tasks : List[Tuple[str, str]]) -> int:
+        # Several crawler processes discover the same links, the unique key decides which insert wins
+        if not tasks:
+            return 0
+        rows = [{'key' : key, 'url' : url, 'status' : "pending"} for key, url in tasks]
+        dialect = db.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            added_ids = db.scalars(
+                dialect_insert(CrawlTask).on_conflict_do_nothing(index_elements=['key']).returning(CrawlTask.id), rows
+            ).all()
+            db.commit()
+            return len(added_ids)
+        added = 0
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(CrawlTask), [row])
+                added += 1
+            except IntegrityError:
+                continue
+        db.commit()
+        return added
+
+    @staticmethod
+    def lease(db : Session, owner : str, limit : int, lease_seconds : float) -> List[CrawlTask]:
+        pending_ids = select(CrawlTask.id).where(CrawlTask.status == "pending").order_by(CrawlTask.id)
+        if db.get_bind().dialect.name == 'postgresql':
+            # Rows locked by another worker's lease transaction are skipped instead of waited for
+            task_ids = db.scalars(pending_ids.limit(limit).with_for_update(skip_locked=True)).all()
+            if task_ids:
+                db.execute(update(CrawlTask).where(CrawlTask.id.in_(task_ids)).values(status="leased"))
+        else:
+            # Without row locks every task is claimed by a compare-and-set on its status
+            task_ids = []
+            for task_id in db.scalars(pending_ids.limit(limit * 2)).all():
+                result = db.execute(update(CrawlTask).where(CrawlTask.id == task_id, CrawlTask.status == "pending").values(status="leased"))
+                if result.rowcount == 1:
+                    task_ids.append(task_id)
+                    if len(task_ids) == limit:
+                        break
+        if not task_ids:
+            db.commit()
+            return []
+        expires_at = utc_now() + datetime.timedelta(seconds=lease_seconds)
+        db.execute(insert(CrawlLease), [{'task_id' : task_id, 'owner' : owner, 'expires_at' : expires_at} for task_id in task_ids])
+        db.commit()
+        return db.query(CrawlTask).filter(CrawlTask.id.in_(task_ids)).order_by(CrawlTask.id).all()
+
+    @staticmethod
+    def heartbeat(db : Session, owner : str, lease_seconds : float) -> int:
+        result = db.execute(update(CrawlLease).where(CrawlLease.owner == owner)
+                            .values(expires_at=utc_now() + datetime.timedelta(seconds=lease_seconds)))
+        db.commit()
+        return result.rowcount
+
+    @staticmethod
+    def reclaim_expired(db : Session) -> int:
+        # Leases of crashed workers run out, their tasks become pending again
+        task_ids = db.scalars(delete(CrawlLease).where(CrawlLease.expires_at < utc_now()).returning(CrawlLease.task_id)).all()
+        if task_ids:
+            db.execute(update(CrawlTask).where(CrawlTask.id.in_(task_ids), CrawlTask.status == "leased").values(status="pending"))
+        db.commit()
+        return len(task_ids)
+
+    @staticmethod
+    def complete(db : Session, task_id : int):
+        db.execute(delete(CrawlLease).where(CrawlLease.task_id == task_id))
+        db.execute(update(CrawlTask).where(CrawlTask.id == task_id)
+                   .values(status="visited", visited_at=datetime.datetime.now(datetime.timezone.utc)))
+        db.commit()
+
+    @staticmethod
+    def count_by_status(db : Session) -> dict:
+        return dict(db.query(CrawlTask.status, func.count(CrawlTask.id)).group_by(CrawlTask.status).all())
+
+    @staticmethod
+    def clear(db : Session):
+        db.query(CrawlLease).delete()
+        db.query(CrawlTask).delete()
+        db.commit()
@@ -0,0 +1,203 @@
+import datetime
+import os
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Optional, Tuple
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+from index_db.db import get_db
+from index_db.models import ProductHistory, ProductCurrentState, ProductRollup, RollupWatermark
+
+RESOLUTIONS = ('hour', 'day')
+AGGREGATED_FIELDS = ('price', 'price_ozon_card', 'rating', 'review_count')
+# Raw states newer than this stay untouched, older ones are compacted into daily rollups
+HISTORY_RAW_DAYS = int(os.getenv('HISTORY_RAW_DAYS', 90))
+HOURLY_ROLLUP_DAYS = int(os.getenv('HOURLY_ROLLUP_DAYS', 30))
+# History ids are taken before commit, so concurrent writers may still commit rows below the highest id seen.
+# Only ids that were already visible this long ago are rolled up.
+ROLLUP_GRACE_SECONDS = float(os.getenv('ROLLUP_GRACE_SECONDS', 600))
+
+
+def as_utc(moment : datetime.datetime) -> datetime.datetime:
+    # Timestamps come back naive from some databases, they are always written in UTC
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+def bucket_start(moment : datetime.datetime, resolution : str) -> datetime.datetime:
+    moment = as_utc(moment).replace(minute=0, second=0, microsecond=0)
+    if resolution == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+def raw_history_cutoff(raw_days : int = HISTORY_RAW_DAYS) -> datetime.datetime:
+    # Aligned to a day, so a day is either fully raw or fully rolled up in reports
+    return bucket_start(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=raw_days), 'day')
+
+def merge_state(rollup : ProductRollup, state : ProductHistory):
+    rollup.states_count = (rollup.states_count or 0) + 1
+    for field in AGGREGATED_FIELDS:
+        value = getattr(state, field)
+        if value is None:
+            continue
+        minimum, maximum = getattr(rollup, f"min_{field}"), getattr(rollup, f"max_{field}")
+        setattr(rollup, f"min_{field}", value if minimum is None else min(minimum, value))
+        setattr(rollup, f"max_{field}", value if maximum is None else max(maximum, value))
+    state_at = as_utc(state.created_at)
+    # Replayed pages may arrive out of order, the last value is the one observed last
+    if rollup.last_at is None or (state_at, state.id) >= (rollup.last_at, rollup.last_history_id):
+        rollup.last_price = state.price
+        rollup.last_price_ozon_card = state.price_ozon_card
+        rollup.last_rating = state.rating
+        rollup.last_review_count = state.review_count
+        rollup.last_question_count = state.question_count
+        rollup.last_on_sale = state.on_sale
+        rollup.last_at = state_at
+        rollup.last_history_id = state.id
+
+class HistoryIdSnapshots:
+    def __init__(self):
+        self.lock = Lock()
+        self.snapshots = deque()
+
+    def settled_id(self, db : Session, grace_seconds : float = ROLLUP_GRACE_SECONDS) -> Optional[int]:
+        # The highest id observed at least grace_seconds ago, every row below it has been committed by now
+        now = time.monotonic()
+        max_id = db.query(func.max(ProductHistory.id)).scalar() or 0
+        with self.lock:
+            self.snapshots.append((now, max_id))
+            while len(self.snapshots) > 1 and self.snapshots[1][0] <= now - grace_seconds:
+                self.snapshots.popleft()
+            observed_at, settled_id = self.snapshots[0]
+        return settled_id if observed_at <= now - grace_seconds else None
+
+history_id_snapshots = HistoryIdSnapshots()
+
+class RollupRepository:
+    @staticmethod
+    def get_watermarks(db : Session) -> dict:
+        watermarks = {watermark.resolution: watermark for watermark in db.query(RollupWatermark)}
+        for resolution in RESOLUTIONS:
+            if resolution not in watermarks:
+                watermarks[resolution] = RollupWatermark(resolution=resolution, history_id=0)
+                db.add(watermarks[resolution])
+        return watermarks
+
+    @staticmethod
+    def get_rolled_up_id(db : Session) -> int:
+        # Every history row up to this id is accounted for in all the rollups
+        rolled_up_id = db.query(func.min(RollupWatermark.history_id)).scalar()
+        return rolled_up_id or 0
+
+    @staticmethod
+    def update(db : Session, batch_size : int = 5000, up_to_id : Optional[int] = None) -> int:
+        watermarks = RollupRepository.get_watermarks(db)
+        processed = 0
+        while True:
+            last_id = min(watermark.history_id for watermark in watermarks.values())
+            query = db.query(ProductHistory).filter(ProductHistory.id > last_id)
+            if up_to_id is not None:
+                query = query.filter(ProductHistory.id <= up_to_id)
+            states = query.order_by(ProductHistory.id).limit(batch_size).all()
+            if not states:
+                break
+            for resolution, watermark in watermarks.items():
+                groups = {}
+                for state in states:
+                    if state.id > watermark.history_id:
+                        groups.setdefault((state.product_id, bucket_start(state.created_at, resolution)), []).append(state)
+                if not groups:
+                    continue
+                product_ids = {product_id for product_id, _ in groups}
+                buckets = [bucket for _, bucket in groups]
+                existing = {
+                    (rollup.product_id, rollup.bucket_start): rollup
+                    for rollup in db.query(ProductRollup).filter(
+                        ProductRollup.resolution == resolution,
+                        ProductRollup.product_id.in_(product_ids),
+                        ProductRollup.bucket_start.between(min(buckets), max(buckets))
+                    )
+                }
+                for (product_id, bucket), bucket_states in groups.items():
+                    rollup = existing.get((product_id, bucket))
+                    if rollup is None:
+                        rollup = ProductRollup(product_id=product_id, resolution=resolution, bucket_start=bucket, states_count=0)
+                        db.add(rollup)
+                    for state in bucket_states:
+                        merge_state(rollup, state)
+                watermark.history_id = states[-1].id
+            db.commit()
+            processed += len(states)
+        return processed
+
+    @staticmethod
+    def compact(db : Session, raw_days : int = HISTORY_RAW_DAYS, hourly_days : int = HOURLY_ROLLUP_DAYS,
+                batch_size : int = 5000) -> Tuple[int, int]:
+        # Only rows that are already rolled up are deleted, current states are always kept
+        cutoff = raw_history_cutoff(raw_days)
+        rolled_up_id = RollupRepository.get_rolled_up_id(db)
+        current_ids = select(ProductCurrentState.history_id)
+        deleted_states = 0
+        lower_id = db.query(func.min(ProductHistory.id)).scalar()
+        while lower_id is not None and lower_id <= rolled_up_id:
+            upper_id = min(lower_id + batch_size, rolled_up_id + 1)
+            result = db.execute(delete(ProductHistory).where(
+                ProductHistory.id >= lower_id,
+                ProductHistory.id < upper_id,
+                ProductHistory.created_at < cutoff,
+                ProductHistory.id.not_in(current_ids)
+            ))
+            db.commit()
+            deleted_states += result.rowcount
+            lower_id = upper_id
+        result = db.execute(delete(ProductRollup).where(
+            ProductRollup.resolution == 'hour',
+            ProductRollup.bucket_start < raw_history_cutoff(hourly_days)
+        ))
+        db.commit()
+        return deleted_states, result.rowcount
+
+    @staticmethod
+    def get_product_rollups(db : Session, product_id : int, resolution : str = 'day',
+                            before : Optional[datetime.datetime] = None):
+        query = db.query(ProductRollup).filter(ProductRollup.product_id == product_id, ProductRollup.resolution == resolution)
+        if before is not None:
+            query = query.filter(ProductRollup.bucket_start < before)
+        return query.order_by(ProductRollup.bucket_start.desc())
+
+    @staticmethod
+    def get_recent_history(db : Session, product_id : int, since : datetime.datetime, rolled_up_id : int):
+        # Rows that are not rolled up yet are read raw whatever their age, so nothing goes missing
+        return db.query(ProductHistory).filter(
+            ProductHistory.product_id == product_id,
+            (ProductHistory.created_at >= since) | (ProductHistory.id > rolled_up_id)
+        ).order_by(ProductHistory.created_at.desc())
+
+def run_maintenance(database_url : str):
+    # Reports read the same HISTORY_RAW_DAYS window, so compaction never removes rows a report expects raw
+    db = next(get_db(database_url))
+    try:
+        settled_id = history_id_snapshots.settled_id(db)
+        processed = RollupRepository.update(db, up_to_id=settled_id) if settled_id is not None else 0
+        deleted_states, deleted_rollups = RollupRepository.compact(db)
+    finally:
+        db.close()
+    print(f"Rolled up {processed} states, compacted {deleted_states} states and {deleted_rollups} hourly rollups", flush=True)
+
+def start_rollup_maintenance(database_url : str, interval_seconds : float, stop : Optional[Event] = None) -> Event:
+    stop = stop or Event()
+
+    def maintain():
+        while True:
+            try:
+                run_maintenance(database_url)
+            except Exception as e:
+                print(f"Rollup maintenance failed: {e}", flush=True)
+            if stop.wait(interval_seconds):
+                break
+
+    Thread(target=maintain, name="rollups", daemon=True).start()
+    return stop
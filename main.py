@@ -1,9 +1,16 @@
 import os
+import asyncio
 from threading import Thread
 from dotenv import load_dotenv
 
 from index_db.db import init_db
+from index_db.rollups import start_rollup_maintenance
 from ozon_scraper.crawler import crawl
+from ozon_scraper.archive import PageArchive
+from ozon_scraper.async_crawler import async_crawl
+from ozon_scraper.distributed import crawl_distributed
+from ozon_scraper.http_driver import driver_options_from_env
+from ozon_scraper.metrics import start_metrics_server, start_summary_logger
 from telegram_bot.bot import bot
 
 load_dotenv()
@@ -13,6 +20,15 @@ with open('start_links.txt', 'r') as f:
 
 
 DATABASE_URL = os.getenv('DATABASE_URL')
+CRAWLER_WORKERS = int(os.getenv('CRAWLER_WORKERS', 1))
+CRAWLER_PROCESSES = int(os.getenv('CRAWLER_PROCESSES', 1))
+CRAWLER_ENGINE = os.getenv('CRAWLER_ENGINE', 'sync')
+CRAWLER_REVISIT = os.getenv('CRAWLER_REVISIT', '0') == '1'
+PAGE_ARCHIVE_DIR = os.getenv('PAGE_ARCHIVE_DIR')
+ROLLUP_INTERVAL_SECONDS = float(os.getenv('ROLLUP_INTERVAL_SECONDS', 3600))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_LOG_SECONDS = float(os.getenv('METRICS_LOG_SECONDS', 300))
+DRIVER_OPTIONS = driver_options_from_env()
 
 def start_bot():
     bot.enable_save_next_step_handlers(delay=2)
@@ -20,10 +36,25 @@ def start_bot():
     bot.polling(none_stop=True, interval=0)
 
 def start_crawler():
-    crawl(START_URLS, DATABASE_URL)
+    if CRAWLER_PROCESSES > 1:
+        # Worker processes log their own metrics, the port can only be bound once per machine
+        crawl_distributed(START_URLS, DATABASE_URL, CRAWLER_PROCESSES, DRIVER_OPTIONS, PAGE_ARCHIVE_DIR,
+                          metrics_log_seconds=METRICS_LOG_SECONDS)
+        return
+    archive = PageArchive(PAGE_ARCHIVE_DIR) if PAGE_ARCHIVE_DIR else None
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if METRICS_LOG_SECONDS > 0:
+        start_summary_logger(METRICS_LOG_SECONDS)
+    if CRAWLER_ENGINE == 'async':
+        asyncio.run(async_crawl(START_URLS, DATABASE_URL, CRAWLER_WORKERS, DRIVER_OPTIONS, CRAWLER_REVISIT, archive))
+    else:
+        crawl(START_URLS, DATABASE_URL, CRAWLER_WORKERS, DRIVER_OPTIONS, CRAWLER_REVISIT, archive)
 
 def main():
     init_db(DATABASE_URL)
+    if ROLLUP_INTERVAL_SECONDS > 0:
+        start_rollup_maintenance(DATABASE_URL, ROLLUP_INTERVAL_SECONDS)
 
     bot_thread = Thread(target=start_bot)
     bot_thread.start()
@@ -0,0 +1,216 @@
+import argparse
+import contextlib
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import sys
+import uuid
+from threading import Lock
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from index_db.db import get_db, init_db
+from index_db.operations import product_state_index
+from ozon_scraper.parser import identify_and_parse, identify_target
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_EXTENSIONS = {'zstd' : 'zst', 'gzip' : 'gz'}
+
+
+class PageArchive:
+    # Pages are stored once per content hash under objects/, index.jsonl records every fetch as url, time and hash
+    def __init__(self, root : str, codec : Optional[str] = None, level : int = 9):
+        if codec is None:
+            codec = 'zstd' if zstandard is not None else 'gzip'
+        if codec not in CODEC_EXTENSIONS:
+            raise ValueError(f"Archive codec {codec} is not supported!")
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("zstd archives need the zstandard package")
+        self.root = root
+        self.codec = codec
+        self.level = level
+        self.lock = Lock()
+        self.index_path = os.path.join(root, "index.jsonl")
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+
+    def object_path(self, content_hash : str, codec : str) -> str:
+        return os.path.join(self.root, "objects", content_hash[:2], f"{content_hash}.html.{CODEC_EXTENSIONS[codec]}")
+
+    def compress(self, content : bytes) -> bytes:
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compress(content)
+        return gzip.compress(content, compresslevel=self.level)
+
+    @staticmethod
+    def decompress(content : bytes, codec : str) -> bytes:
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd archives need the zstandard package")
+            return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+        return gzip.decompress(content)
+
+    def put(self, url : str, html_src : str, fetched_at : Optional[datetime.datetime] = None) -> str:
+        content = html_src.encode('utf-8')
+        content_hash = hashlib.sha256(content).hexdigest()
+        fetched_at = fetched_at or datetime.datetime.now(datetime.timezone.utc)
+        path = self.object_path(content_hash, self.codec)
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Written aside and renamed, so a crash never leaves a truncated object behind.
+                # Other crawler processes may write the same object, every writer gets its own temporary file.
+                temporary_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+                try:
+                    with open(temporary_path, "wb") as f:
+                        f.write(self.compress(content))
+                    os.replace(temporary_path, path)
+                finally:
+                    if os.path.exists(temporary_path):
+                        os.remove(temporary_path)
+            record = {'url' : url, 'fetched_at' : fetched_at.isoformat(), 'hash' : content_hash, 'codec' : self.codec}
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return content_hash
+
+    def get(self, content_hash : str, codec : str) -> str:
+        with open(self.object_path(content_hash, codec), "rb") as f:
+            return self.decompress(f.read(), codec).decode('utf-8')
+
+    def records(self, since : Optional[datetime.datetime] = None, latest_only : bool = False) -> List[dict]:
+        if not os.path.exists(self.index_path):
+            return []
+        records = []
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record['fetched_at'] = datetime.datetime.fromisoformat(record['fetched_at'])
+                if since is None or record['fetched_at'] >= since:
+                    records.append(record)
+        records.sort(key=lambda record: record['fetched_at'])
+        if latest_only:
+            latest = {record['url']: record for record in records}
+            records = sorted(latest.values(), key=lambda record: record['fetched_at'])
+        return records
+
+class ArchivingDriver:
+    # Wraps a ChromeDriver, every loaded page is archived before it is handed to the parser
+    def __init__(self, driver, archive : PageArchive):
+        self.driver = driver
+        self.archive = archive
+        self.url = None
+
+    def load_page(self, url : str, *args, **kwargs) -> str:
+        html_src = self.driver.load_page(url, *args, **kwargs)
+        self.archive.put(url, html_src)
+        self.url = url
+        return html_src
+
+    def wait_page(self, *args, **kwargs) -> Optional[str]:
+        html_src = self.driver.wait_page(*args, **kwargs)
+        if html_src is not None:
+            self.archive.put(self.url, html_src)
+        return html_src
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+class AsyncArchivingDriver(ArchivingDriver):
+    async def load_page(self, url : str, *args, **kwargs) -> str:
+        html_src = await self.driver.load_page(url, *args, **kwargs)
+        self.archive.put(url, html_src)
+        return html_src
+
+    async def load_page_stages(self, url : str, *args, **kwargs):
+        async with contextlib.aclosing(self.driver.load_page_stages(url, *args, **kwargs)) as pages:
+            async for html_src in pages:
+                self.archive.put(url, html_src)
+                yield html_src
+
+class ReplayDriver:
+    # Serves one archived page at a time to identify_and_parse, no browser is started
+    def __init__(self):
+        self.pages = {}
+
+    def load_page(self, url : str, *args, **kwargs) -> str:
+        return self.pages.get(url, "")
+
+    def wait_page(self, *args, **kwargs) -> Optional[str]:
+        # An archived page is all there is, waiting renders nothing more
+        return None
+
+    def quit(self):
+        pass
+
+def reparse(archive : PageArchive, database_url : str, since : Optional[datetime.datetime] = None,
+            latest_only : bool = False, target_types : Optional[List[str]] = None) -> Dict[str, int]:
+    init_db(database_url)
+    db = next(get_db(database_url))
+    product_state_index.warm(db)
+    driver = ReplayDriver()
+    stats = {'pages' : 0, 'skipped' : 0, 'missing' : 0}
+    try:
+        # Pages are replayed in fetch order, so the history is rebuilt the way it was observed
+        for record in archive.records(since, latest_only):
+            target = identify_target(record['url'])
+            if target is None or (target_types and target[1] not in target_types):
+                stats['skipped'] += 1
+                continue
+            try:
+                html_src = archive.get(record['hash'], record['codec'])
+            except FileNotFoundError:
+                stats['missing'] += 1
+                continue
+            driver.pages = {target[0]: html_src}
+            db.info['observed_at'] = record['fetched_at']
+            identify_and_parse(target[0], driver, db, force=True)
+            stats['pages'] += 1
+    finally:
+        db.info.pop('observed_at', None)
+        db.close()
+    return stats
+
+def main(argv : List[str] = None) -> int:
+    load_dotenv()
+    arguments = argparse.ArgumentParser(description="Archived Ozon pages")
+    commands = arguments.add_subparsers(dest="command", required=True)
+    reparse_command = commands.add_parser("reparse", help="Replay archived pages through the parser into the database")
+    reparse_command.add_argument("--archive", default=os.getenv('PAGE_ARCHIVE_DIR', 'page_archive'))
+    reparse_command.add_argument("--database-url", default=os.getenv('DATABASE_URL'))
+    reparse_command.add_argument("--since", type=datetime.datetime.fromisoformat, help="Only pages fetched after this ISO time")
+    reparse_command.add_argument("--latest-only", action="store_true", help="Only the last fetch of every url")
+    reparse_command.add_argument("--target-type", action="append", help="product, seller, brand, category or search")
+    stats_command = commands.add_parser("stats", help="Show the archive size")
+    stats_command.add_argument("--archive", default=os.getenv('PAGE_ARCHIVE_DIR', 'page_archive'))
+    options = arguments.parse_args(argv)
+
+    archive = PageArchive(options.archive)
+    if options.command == "stats":
+        records = archive.records()
+        hashes = {record['hash'] for record in records}
+        size = 0
+        for directory, _, files in os.walk(os.path.join(archive.root, "objects")):
+            size += sum(os.path.getsize(os.path.join(directory, file)) for file in files)
+        print(f"{len(records)} fetches of {len({record['url'] for record in records})} urls, "
+              f"{len(hashes)} unique pages, {size / 1024 / 1024:.1f} MiB on disk")
+        return 0
+    if not options.database_url:
+        print("DATABASE_URL is not set", flush=True)
+        return 1
+    since = options.since
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    stats = reparse(archive, options.database_url, since, options.latest_only, options.target_type)
+    print(f"Replayed {stats['pages']} pages, skipped {stats['skipped']}, missing objects {stats['missing']}", flush=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
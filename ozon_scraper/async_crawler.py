@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import time
+from typing import List, Optional
+
+from index_db.db import get_db
+from index_db.operations import product_state_index
+from ozon_scraper.archive import AsyncArchivingDriver, PageArchive
+from ozon_scraper.async_driver import AsyncChromeDriver
+from ozon_scraper.frontier import Frontier
+from ozon_scraper.http_driver import browser_options
+from ozon_scraper.metrics import metrics, PRODUCT_LOAD_RETRIES_TOTAL, PRODUCT_LOAD_FAILURES_TOTAL, QUEUE_DEPTH
+from ozon_scraper.scheduler import revisit_scheduler
+from ozon_scraper.parser import (
+    identify_target, parse_product_source, timed_batch, record_page, record_exception,
+    seller_needs_refresh, parse_seller_page, brand_needs_refresh,
+    parse_brand_page, parse_category_page, LISTING_TILES_SELECTOR,
+    LISTING_READY_SELECTORS, PRODUCT_LOAD_STAGES, PRODUCT_LOAD_TIMEOUTS, PRODUCT_READY_SELECTORS
+)
+
+
+def parse_product_in_batch(url : str, html_src : str, db, refresh_after_seconds : Optional[int] = None):
+    # The session is shared by all coroutines, so a batch must not span an await
+    with timed_batch(db):
+        return parse_product_source(url, html_src, db, refresh_after_seconds)
+
+async def async_parse_product(url : str, db, driver : AsyncChromeDriver, refresh_after_seconds : Optional[int] = None):
+    async with contextlib.aclosing(driver.load_page_stages(url, PRODUCT_LOAD_STAGES)) as pages:
+        stage = 0
+        async for html_src in pages:
+            if stage:
+                metrics.inc(PRODUCT_LOAD_RETRIES_TOTAL)
+            stage += 1
+            links_to_parse = parse_product_in_batch(url, html_src, db, refresh_after_seconds)
+            if links_to_parse is not None:
+                return links_to_parse
+    # Only a page that never rendered its widgets is loaded once more
+    metrics.inc(PRODUCT_LOAD_RETRIES_TOTAL)
+    html_src = await driver.load_page(url, PRODUCT_READY_SELECTORS, timeout=PRODUCT_LOAD_TIMEOUTS[-1])
+    links_to_parse = parse_product_in_batch(url, html_src, db, refresh_after_seconds)
+    if links_to_parse is not None:
+        return links_to_parse
+    metrics.inc(PRODUCT_LOAD_FAILURES_TOTAL)
+    print(f"Page {url} was not loaded", flush=True)
+    return []
+
+async def async_parse_seller(url : str, db, driver : AsyncChromeDriver, refresh_after_seconds : Optional[int] = None):
+    if not seller_needs_refresh(url, db, refresh_after_seconds):
+        return []
+    html_src = await driver.load_page(url, LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR, 60)
+    with timed_batch(db):
+        return parse_seller_page(url, html_src, db)
+
+async def async_parse_brand(url : str, db, driver : AsyncChromeDriver, refresh_after_seconds : Optional[int] = None):
+    if not brand_needs_refresh(url, db, refresh_after_seconds):
+        return []
+    html_src = await driver.load_page(url, LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR, 60)
+    with timed_batch(db):
+        return parse_brand_page(url, html_src, db)
+
+async def async_parse_category(url : str, db, driver : AsyncChromeDriver):
+    html_src = await driver.load_page(url, (LISTING_TILES_SELECTOR,), LISTING_TILES_SELECTOR, 30)
+    with timed_batch(db):
+        return parse_category_page(url, html_src, db)
+
+async def async_identify_and_parse(url : str, driver : AsyncChromeDriver, db):
+    target = identify_target(url)
+    if target is None:
+        return []
+    url, target_type = target
+
+    started = time.perf_counter()
+    try:
+        if target_type == "product":
+            new_urls = await async_parse_product(url, db, driver)
+        elif target_type == "brand":
+            new_urls = await async_parse_brand(url, db, driver)
+        elif target_type == "category" or target_type == "search":
+            new_urls = await async_parse_category(url, db, driver)
+        elif target_type == "seller":
+            new_urls = await async_parse_seller(url, db, driver)
+        else:
+            new_urls = []
+        record_page(target_type, started, new_urls)
+        print(f"Found {len(new_urls)} urls", flush=True)
+        return new_urls
+    except Exception as e:
+        record_exception(target_type, e)
+        print(f"Exception occurred in {url}: {e}", flush=True)
+        return []
+
+async def async_crawl(start_urls : List[str], database_url : str, concurrency : int = 8, driver_options : Optional[dict] = None,
+                      revisit : bool = False, archive : Optional[PageArchive] = None):
+    driver_options = driver_options or {}
+    task_queue = asyncio.Queue()
+    frontier = Frontier(database_url)
+    # Page loads run concurrently, while the parsing and the database writes
+    # happen on the event loop thread, so one session is shared by all workers.
+    # The page API fetcher is synchronous, the async engine always drives the browser
+    driver = await AsyncChromeDriver(concurrency, **browser_options(driver_options)).start()
+    if archive is not None:
+        driver = AsyncArchivingDriver(driver, archive)
+    db = next(get_db(database_url))
+    product_state_index.warm(db)
+    if revisit:
+        revisit_scheduler.warm(db)
+
+    def enqueue(urls : List[str]):
+        for url in urls:
+            task_queue.put_nowait(url)
+
+    async def worker():
+        while True:
+            url = await task_queue.get()
+            metrics.set_gauge(QUEUE_DEPTH, task_queue.qsize())
+            try:
+                new_urls = await async_identify_and_parse(url, driver, db)
+                frontier.mark_visited(url)
+                if revisit:
+                    revisit_scheduler.schedule(db, url)
+                enqueue(frontier.add(new_urls))
+            except Exception as e:
+                # A worker that died here would leave its share of the queue undone and join waiting forever
+                print(f"Failed to process {url}: {e}", flush=True)
+            finally:
+                task_queue.task_done()
+
+    enqueue(frontier.start(start_urls))
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await task_queue.join()
+        while revisit:
+            delay = revisit_scheduler.seconds_until_next()
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            enqueue(frontier.requeue(revisit_scheduler.pop_due()))
+            await task_queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        db.close()
+        frontier.close()
+        await driver.quit()
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import time
+from typing import Optional, Sequence, Tuple
+
+from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+
+from ozon_scraper.driver import is_blocked, get_resource_profile
+from ozon_scraper.lifecycle import BrowserLifecycle, HEAP_SCRIPT, is_crash, processes_rss
+from ozon_scraper.metrics import metrics, STAGE_SECONDS, BROWSER_RECYCLES_TOTAL
+
+async def close_quietly(target):
+    if target is None:
+        return
+    try:
+        await target.close()
+    except PlaywrightError:
+        pass
+
+class AsyncChromeDriver:
+    def __init__(self, max_pages : int = 8, headless : bool = False, block_profile : str = "full", page_navigations : int = 100,
+                 context_navigations : int = 1000, max_heap_mb : float = 512, max_rss_mb : float = 2048):
+        logging.getLogger("playwright").setLevel(logging.WARNING)
+        self.max_pages = max_pages
+        self.headless = headless
+        self.resource_profile = get_resource_profile(block_profile)
+        self.pages_semaphore = asyncio.BoundedSemaphore(max_pages)
+        # Every load opens its own page, so only the context and the browser are ever recycled
+        self.lifecycle = BrowserLifecycle(0, context_navigations, max_heap_mb, max_rss_mb)
+        self.recycle_lock = asyncio.Lock()
+        self.playwright = None
+        self.browser = None
+        self.browser_session = None
+        self.context = None
+        # Replaced contexts are closed once the loads still running in them are done
+        self.open_pages = {}
+        self.context_browsers = {}
+
+    async def start(self):
+        self.playwright = await async_playwright().start()
+        await self.start_browser()
+        return self
+
+    async def start_browser(self):
+        self.browser = await self.playwright.chromium.launch(
+            headless=self.headless,
+            args=[
+                "--disable-session-crashed-bubble",
+                "--disable-blink-features=AutomationControlled",
+                "--no-sandbox",
+                "--disable-dev-shm-usage",
+                "--window-size=1280,720",
+                "--start-maximized",
+            ]
+        )
+        try:
+            self.browser_session = await self.browser.new_browser_cdp_session()
+        except PlaywrightError:
+            self.browser_session = None
+        await self.new_context()
+
+    async def new_context(self):
+        self.context = await self.browser.new_context(
+            viewport={"width": 1280, "height": 720}
+        )
+        if self.resource_profile["resource_types"] or self.resource_profile["domains"]:
+            await self.context.route("**/*", self.route_request)
+        self.open_pages[self.context] = 0
+        self.context_browsers[self.context] = self.browser
+
+    async def browser_rss(self) -> Optional[int]:
+        if self.browser_session is None:
+            return None
+        try:
+            processes = (await self.browser_session.send("SystemInfo.getProcessInfo"))["processInfo"]
+        except PlaywrightError:
+            return None
+        return processes_rss(process["id"] for process in processes)
+
+    async def retire_context(self, context):
+        if context is self.context or self.open_pages.get(context):
+            return
+        self.open_pages.pop(context, None)
+        browser = self.context_browsers.pop(context, None)
+        await close_quietly(context)
+        if browser is not self.browser and browser not in self.context_browsers.values():
+            await close_quietly(browser)
+
+    async def recycle(self, level : str, reason : str, seen=None):
+        async with self.recycle_lock:
+            # Concurrent loads notice the same crash or threshold, what they saw is replaced only once
+            if seen is not None and seen is not self.browser and seen is not self.context:
+                return
+            print(f"Recycling browser {level} after {self.lifecycle.context_count} navigations: {reason}", flush=True)
+            metrics.inc(BROWSER_RECYCLES_TOTAL, level=level, reason=reason)
+            context = self.context
+            if level == 'browser':
+                if reason == 'crash':
+                    # Pages of a crashed browser are dead already, nothing is left to wait for
+                    self.open_pages[context] = 0
+                await self.start_browser()
+            else:
+                await self.new_context()
+            self.lifecycle.reset(level)
+            await self.retire_context(context)
+
+    async def maintain(self, heap_bytes : Optional[int] = None):
+        if not self.browser.is_connected():
+            await self.recycle('browser', 'crash', self.browser)
+            return
+        context = self.context
+        rss_bytes = await self.browser_rss() if heap_bytes is not None else None
+        action = self.lifecycle.decide(heap_bytes, rss_bytes)
+        if action is not None:
+            await self.recycle(*action, context)
+
+    async def open_page(self):
+        await self.maintain()
+        context = self.context
+        self.open_pages[context] += 1
+        try:
+            return context, await context.new_page()
+        except PlaywrightError:
+            await self.close_page(context, None)
+            raise
+
+    async def close_page(self, context, page, measure : bool = False):
+        heap_bytes = None
+        if page is not None:
+            if measure and self.lifecycle.should_check_memory():
+                try:
+                    heap_bytes = int(await page.evaluate(HEAP_SCRIPT)) or None
+                except PlaywrightError:
+                    heap_bytes = None
+            await close_quietly(page)
+        if context in self.open_pages:
+            self.open_pages[context] -= 1
+            await self.retire_context(context)
+        if heap_bytes is not None:
+            await self.maintain(heap_bytes)
+
+    async def route_request(self, route):
+        request = route.request
+        if is_blocked(self.resource_profile, request.resource_type, request.url):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def wait_for_selectors(self, page, selectors : Sequence[str], max_scrolls : int = 15, timeout : float = 15000):
+        deadline = time.monotonic() + timeout / 1000
+        for _ in range(max_scrolls + 1):
+            missing = [selector for selector in selectors if await page.query_selector(selector) is None]
+            if not missing:
+                return True
+            remaining = (deadline - time.monotonic()) * 1000
+            if remaining <= 0:
+                return False
+            try:
+                await page.wait_for_selector(missing[0], state='attached', timeout=min(remaining, 1000))
+            except PlaywrightTimeoutError:
+                await page.mouse.wheel(0, 720)
+        return False
+
+    async def scroll_until_stable(self, page, tiles_selector : str, max_scrolls : int = 60, stable_rounds : int = 2, idle_timeout : float = 2000):
+        tiles_count = await page.locator(tiles_selector).count()
+        idle_rounds = 0
+        for _ in range(max_scrolls):
+            await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+            try:
+                await page.wait_for_function(
+                    "([selector, count]) => document.querySelectorAll(selector).length > count",
+                    arg=[tiles_selector, tiles_count], timeout=idle_timeout
+                )
+            except PlaywrightTimeoutError:
+                idle_rounds += 1
+                if idle_rounds >= stable_rounds:
+                    break
+                continue
+            idle_rounds = 0
+            tiles_count = await page.locator(tiles_selector).count()
+        return tiles_count
+
+    async def load_page(self, url : str, ready_selectors : Sequence[str] = (), tiles_selector : Optional[str] = None,
+                        max_scrolls : int = 60, timeout : float = 15000):
+        async with self.pages_semaphore:
+            browser = self.browser
+            try:
+                return await self.navigate(url, ready_selectors, tiles_selector, max_scrolls, timeout)
+            except PlaywrightError as e:
+                crashed = not browser.is_connected() or (not isinstance(e, PlaywrightTimeoutError) and is_crash(e))
+                if not crashed:
+                    raise
+                # The task is not lost with the browser, it is loaded once more in a fresh one
+                print(f"Browser crashed while loading {url}: {e}", flush=True)
+                await self.recycle('browser', 'crash', browser)
+                return await self.navigate(url, ready_selectors, tiles_selector, max_scrolls, timeout)
+
+    async def load_page_stages(self, url : str, stages : Sequence[Tuple[Sequence[str], float]]):
+        # Every stage keeps waiting on the same open page and yields what it has rendered by then.
+        # A failing page simply ends the stages, the caller loads it again with load_page.
+        async with self.pages_semaphore:
+            context, page = await self.open_page()
+            try:
+                started = time.perf_counter()
+                with metrics.timer(STAGE_SECONDS, stage="navigate"):
+                    await page.goto(url, timeout=60000, wait_until='domcontentloaded')
+                self.lifecycle.record_navigation(time.perf_counter() - started)
+                for ready_selectors, timeout in stages:
+                    with metrics.timer(STAGE_SECONDS, stage="wait"):
+                        await self.wait_for_selectors(page, ready_selectors, timeout=timeout)
+                    with metrics.timer(STAGE_SECONDS, stage="content"):
+                        html_src = await page.content()
+                    yield html_src
+            except PlaywrightError as e:
+                print(f"Page {url} stopped rendering: {e}", flush=True)
+            finally:
+                await self.close_page(context, page, measure=True)
+
+    async def navigate(self, url : str, ready_selectors : Sequence[str] = (), tiles_selector : Optional[str] = None,
+                       max_scrolls : int = 60, timeout : float = 15000):
+        context, page = await self.open_page()
+        try:
+            started = time.perf_counter()
+            with metrics.timer(STAGE_SECONDS, stage="navigate"):
+                await page.goto(url, timeout=60000, wait_until='domcontentloaded')
+            self.lifecycle.record_navigation(time.perf_counter() - started)
+            if ready_selectors:
+                with metrics.timer(STAGE_SECONDS, stage="wait"):
+                    await self.wait_for_selectors(page, ready_selectors, timeout=timeout)
+            if tiles_selector:
+                with metrics.timer(STAGE_SECONDS, stage="scroll"):
+                    await self.scroll_until_stable(page, tiles_selector, max_scrolls)
+            with metrics.timer(STAGE_SECONDS, stage="network_idle"):
+                try:
+                    await page.wait_for_load_state('networkidle', timeout=3000)
+                except PlaywrightTimeoutError:
+                    pass
+            with metrics.timer(STAGE_SECONDS, stage="content"):
+                return await page.content()
+        finally:
+            await self.close_page(context, page, measure=True)
+
+    async def quit(self):
+        for context, browser in list(self.context_browsers.items()):
+            await close_quietly(context)
+            await close_quietly(browser)
+        self.context_browsers.clear()
+        if self.playwright:
+            await self.playwright.stop()
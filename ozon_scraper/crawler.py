@@ -1,27 +1,131 @@
 from queue import Queue
-from typing import List
+from threading import Thread
+from typing import List, Optional
 
 from index_db.db import get_db
-from ozon_scraper.driver import ChromeDriver
+from index_db.operations import product_state_index
+from ozon_scraper.archive import ArchivingDriver, PageArchive
+from ozon_scraper.frontier import Frontier
+from ozon_scraper.http_driver import create_driver
+from ozon_scraper.metrics import metrics, QUEUE_DEPTH
 from ozon_scraper.parser import identify_and_parse
+from ozon_scraper.scheduler import revisit_scheduler
 
 
-def crawl(start_urls : List[str], database_url : str):
+def crawl(start_urls : List[str], database_url : str, workers : int = 1, driver_options : Optional[dict] = None,
+          revisit : bool = False, archive : Optional[PageArchive] = None):
+    driver_options = driver_options or {}
+    if workers > 1:
+        return crawl_concurrent(start_urls, database_url, workers, driver_options, revisit, archive)
+
     task_queue = Queue()
-    visited_urls = set()
-    driver = ChromeDriver()
+    frontier = Frontier(database_url)
+    driver = create_driver(driver_options)
+    if archive is not None:
+        driver = ArchivingDriver(driver, archive)
     db = next(get_db(database_url))
-    for url in start_urls:
+    product_state_index.warm(db)
+    if revisit:
+        revisit_scheduler.warm(db)
+    for url in frontier.start(start_urls):
         task_queue.put(url)
 
     try:
-        while not task_queue.empty():
+        while True:
+            if task_queue.empty():
+                # The frontier is exhausted, wait for the next entity that is expected to change
+                if not revisit or revisit_scheduler.seconds_until_next() is None:
+                    break
+                for url in frontier.requeue(revisit_scheduler.wait_next()):
+                    task_queue.put(url)
+                continue
             url = task_queue.get()
+            metrics.set_gauge(QUEUE_DEPTH, task_queue.qsize())
             new_urls = identify_and_parse(url, driver, db)
-            visited_urls.add(url)
-            for url in new_urls:
-                if not url in visited_urls:
-                    task_queue.put(url)
+            frontier.mark_visited(url)
+            if revisit:
+                revisit_scheduler.schedule(db, url)
+            for url in frontier.add(new_urls):
+                task_queue.put(url)
     finally:
         db.close()
         driver.quit()
+        frontier.close()
+
+def crawl_concurrent(start_urls : List[str], database_url : str, workers : int = 4, driver_options : Optional[dict] = None,
+                     revisit : bool = False, archive : Optional[PageArchive] = None):
+    driver_options = driver_options or {}
+    task_queue = Queue()
+    frontier = Frontier(database_url)
+
+    startup_errors = []
+
+    def enqueue(urls : List[str]):
+        for url in frontier.add(urls):
+            task_queue.put(url)
+
+    def worker():
+        # Playwright's sync API is bound to the thread that started it,
+        # so every worker owns its browser, context and page.
+        try:
+            driver = create_driver(driver_options)
+            if archive is not None:
+                driver = ArchivingDriver(driver, archive)
+            db = next(get_db(database_url))
+        except Exception as e:
+            print(f"Crawler worker failed to start: {e}", flush=True)
+            startup_errors.append(e)
+            with task_queue.all_tasks_done:
+                task_queue.all_tasks_done.notify_all()
+            return
+        try:
+            while True:
+                url = task_queue.get()
+                metrics.set_gauge(QUEUE_DEPTH, task_queue.qsize())
+                if url is None or startup_errors:
+                    task_queue.task_done()
+                    break
+                try:
+                    new_urls = identify_and_parse(url, driver, db)
+                    frontier.mark_visited(url)
+                    if revisit:
+                        revisit_scheduler.schedule(db, url)
+                    enqueue(new_urls)
+                except Exception as e:
+                    print(f"Failed to process {url}: {e}", flush=True)
+                finally:
+                    task_queue.task_done()
+        finally:
+            db.close()
+            driver.quit()
+
+    def wait_for_queue():
+        # join() would block forever once a worker is gone and its share of the queue is never drained
+        with task_queue.all_tasks_done:
+            while task_queue.unfinished_tasks and not startup_errors:
+                task_queue.all_tasks_done.wait(1)
+        if startup_errors:
+            for _ in threads:
+                task_queue.put(None)
+            frontier.close()
+            raise RuntimeError("Crawler worker failed to start") from startup_errors[0]
+
+    product_state_index.warm(frontier.db)
+    if revisit:
+        revisit_scheduler.warm(frontier.db)
+    for url in frontier.start(start_urls):
+        task_queue.put(url)
+    threads = [Thread(target=worker, name=f"crawler-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    wait_for_queue()
+    while revisit and revisit_scheduler.seconds_until_next() is not None:
+        for url in frontier.requeue(revisit_scheduler.wait_next()):
+            task_queue.put(url)
+        wait_for_queue()
+    for _ in threads:
+        task_queue.put(None)
+    for thread in threads:
+        thread.join()
+    frontier.close()
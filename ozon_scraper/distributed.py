@@ -0,0 +1,163 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from index_db.db import get_db, init_db
+from index_db.models import CrawlTask
+from index_db.operations import FrontierRepository, product_state_index
+from ozon_scraper.archive import ArchivingDriver, PageArchive
+from ozon_scraper.http_driver import create_driver, driver_options_from_env
+from ozon_scraper.metrics import metrics, start_summary_logger, QUEUE_DEPTH, VISITED_TOTAL
+from ozon_scraper.parser import identify_and_parse
+from ozon_scraper.urls import canonicalize_url, canonical_key
+
+LEASE_SIZE = int(os.getenv('CRAWLER_LEASE_SIZE', 4))
+LEASE_SECONDS = float(os.getenv('CRAWLER_LEASE_SECONDS', 300))
+POLL_SECONDS = float(os.getenv('CRAWLER_POLL_SECONDS', 5))
+
+
+class LeasedFrontier:
+    # The frontier table is the work queue shared by every crawler process, on any machine.
+    # Tasks are leased for a while, a worker that dies simply lets its leases run out.
+    def __init__(self, database_url : str, owner : Optional[str] = None, lease_seconds : float = LEASE_SECONDS):
+        self.db = next(get_db(database_url))
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.seen_keys = set()
+
+    def seed(self, start_urls : List[str]) -> int:
+        counts = FrontierRepository.count_by_status(self.db)
+        if counts.get("pending") or counts.get("leased"):
+            print(f"Joining crawl with {counts.get('pending', 0)} pending and {counts.get('leased', 0)} leased urls", flush=True)
+            return 0
+        # The previous round was finished, start a new one from the seeds
+        FrontierRepository.clear(self.db)
+        return self.add(start_urls)
+
+    def add(self, urls : List[str]) -> int:
+        # seen_keys only saves round trips for links this process has already pushed,
+        # duplicates from other processes are dropped by the unique key
+        new_tasks = []
+        for url in urls:
+            canonical_url = canonicalize_url(url)
+            if canonical_url is None:
+                continue
+            key = canonical_key(canonical_url)
+            if key in self.seen_keys:
+                continue
+            self.seen_keys.add(key)
+            new_tasks.append((key, canonical_url))
+        return FrontierRepository.add_many_ignore(self.db, new_tasks)
+
+    def lease(self, limit : int) -> List[CrawlTask]:
+        FrontierRepository.reclaim_expired(self.db)
+        return FrontierRepository.lease(self.db, self.owner, limit, self.lease_seconds)
+
+    def heartbeat(self):
+        FrontierRepository.heartbeat(self.db, self.owner, self.lease_seconds)
+
+    def complete(self, task : CrawlTask):
+        FrontierRepository.complete(self.db, task.id)
+        metrics.inc(VISITED_TOTAL)
+
+    def is_finished(self) -> bool:
+        counts = FrontierRepository.count_by_status(self.db)
+        metrics.set_gauge(QUEUE_DEPTH, counts.get("pending", 0))
+        return not counts.get("pending") and not counts.get("leased")
+
+    def close(self):
+        self.db.close()
+
+def crawl_worker(database_url : str, driver_options : Optional[dict] = None, archive_dir : Optional[str] = None,
+                 lease_size : int = LEASE_SIZE, lease_seconds : float = LEASE_SECONDS, poll_seconds : float = POLL_SECONDS):
+    frontier = LeasedFrontier(database_url, lease_seconds=lease_seconds)
+    driver = create_driver(driver_options)
+    if archive_dir:
+        driver = ArchivingDriver(driver, PageArchive(archive_dir))
+    db = next(get_db(database_url))
+    product_state_index.warm(db)
+    print(f"Crawler worker {frontier.owner} started", flush=True)
+    try:
+        while True:
+            tasks = frontier.lease(lease_size)
+            if not tasks:
+                # Other workers may still push links from the pages they hold
+                if frontier.is_finished():
+                    break
+                time.sleep(poll_seconds)
+                continue
+            for task in tasks:
+                new_urls = identify_and_parse(task.url, driver, db)
+                frontier.add(new_urls)
+                frontier.complete(task)
+                frontier.heartbeat()
+    finally:
+        db.close()
+        driver.quit()
+        frontier.close()
+    print(f"Crawler worker {frontier.owner} finished", flush=True)
+
+def run_worker(database_url : str, driver_options : Optional[dict], archive_dir : Optional[str],
+               lease_size : int, lease_seconds : float, metrics_log_seconds : float):
+    if metrics_log_seconds > 0:
+        start_summary_logger(metrics_log_seconds)
+    crawl_worker(database_url, driver_options, archive_dir, lease_size, lease_seconds)
+
+def crawl_distributed(start_urls : List[str], database_url : str, processes : int = 2, driver_options : Optional[dict] = None,
+                      archive_dir : Optional[str] = None, seed : bool = True, lease_size : int = LEASE_SIZE,
+                      lease_seconds : float = LEASE_SECONDS, metrics_log_seconds : float = 0):
+    if seed:
+        frontier = LeasedFrontier(database_url)
+        try:
+            frontier.seed(start_urls)
+        finally:
+            frontier.close()
+    # Every process owns its browser and database connections, nothing is shared but the database
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(
+            target=run_worker, name=f"crawler-{i}",
+            args=(database_url, driver_options, archive_dir, lease_size, lease_seconds, metrics_log_seconds)
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def main(argv : List[str] = None) -> int:
+    load_dotenv()
+    arguments = argparse.ArgumentParser(description="Crawler processes working off the shared frontier")
+    arguments.add_argument("--database-url", default=os.getenv('DATABASE_URL'))
+    arguments.add_argument("--processes", type=int, default=int(os.getenv('CRAWLER_PROCESSES', 1)))
+    arguments.add_argument("--start-links", default="start_links.txt")
+    arguments.add_argument("--no-seed", action="store_true", help="Only join a running crawl")
+    arguments.add_argument("--lease-size", type=int, default=LEASE_SIZE)
+    arguments.add_argument("--lease-seconds", type=float, default=LEASE_SECONDS)
+    arguments.add_argument("--archive", default=os.getenv('PAGE_ARCHIVE_DIR'))
+    options = arguments.parse_args(argv)
+    if not options.database_url:
+        print("DATABASE_URL is not set", flush=True)
+        return 1
+
+    init_db(options.database_url)
+    start_urls = []
+    if not options.no_seed:
+        with open(options.start_links, 'r') as f:
+            start_urls = f.read().split('\n')
+    crawl_distributed(
+        start_urls, options.database_url, options.processes, driver_options_from_env(), options.archive,
+        seed=not options.no_seed, lease_size=options.lease_size, lease_seconds=options.lease_seconds,
+        metrics_log_seconds=float(os.getenv('METRICS_LOG_SECONDS', 300))
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,69 @@
 import time
 import logging
+from typing import Optional, Sequence
+from urllib.parse import urlsplit
 
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import sync_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+
+from ozon_scraper.lifecycle import BrowserLifecycle, HEAP_SCRIPT, is_crash, processes_rss
+from ozon_scraper.metrics import metrics, STAGE_SECONDS, BROWSER_RECYCLES_TOTAL
+
+ANALYTICS_DOMAINS = (
+    "mc.yandex.ru", "an.yandex.ru", "yandex.ru/ads", "top-fwz1.mail.ru",
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net",
+    "vk.com", "mytarget.ru", "tns-counter.ru", "criteo.com", "adfox.ru"
+)
+
+# Parsers only read the DOM, so images, videos and fonts are never needed.
+# Scripts and stylesheets stay, Ozon renders widgets and lazy loads tiles with them.
+RESOURCE_PROFILES = {
+    "full": {"resource_types": set(), "domains": ()},
+    "lean": {"resource_types": {"image", "media", "font"}, "domains": ANALYTICS_DOMAINS},
+    "strict": {"resource_types": {"image", "media", "font", "manifest", "texttrack", "eventsource"}, "domains": ANALYTICS_DOMAINS},
+}
+
+def is_blocked(profile : dict, resource_type : str, url : str) -> bool:
+    if resource_type in profile["resource_types"]:
+        return True
+    if profile["domains"]:
+        parts = urlsplit(url)
+        location = parts.netloc + parts.path
+        return any(location == domain or location.startswith(domain) or parts.netloc.endswith("." + domain) for domain in profile["domains"])
+    return False
+
+def get_resource_profile(block_profile : str) -> dict:
+    if block_profile not in RESOURCE_PROFILES:
+        raise KeyError(f"Resource profile {block_profile} does not exist!")
+    return RESOURCE_PROFILES[block_profile]
+
+def close_quietly(target):
+    # Closing what already crashed raises, there is nothing left to release then
+    if target is None:
+        return
+    try:
+        target.close()
+    except PlaywrightError:
+        pass
 
 class ChromeDriver:
-    def __init__(self):
+    def __init__(self, headless : bool = False, block_profile : str = "full", page_navigations : int = 100,
+                 context_navigations : int = 1000, max_heap_mb : float = 512, max_rss_mb : float = 2048):
         logging.getLogger("playwright").setLevel(logging.WARNING)
+        self.headless = headless
+        self.resource_profile = get_resource_profile(block_profile)
+        self.lifecycle = BrowserLifecycle(page_navigations, context_navigations, max_heap_mb, max_rss_mb)
+        self.browser = None
+        self.browser_session = None
+        self.context = None
+        self.page = None
+        self.crashed = False
 
         self.playwright = sync_playwright().start()
+        self.start_browser()
 
+    def start_browser(self):
         self.browser = self.playwright.chromium.launch(
-            headless=False,
+            headless=self.headless,
             args=[
                 "--disable-session-crashed-bubble",
                 "--disable-blink-features=AutomationControlled",
@@ -20,40 +73,164 @@ class ChromeDriver:
                 "--start-maximized",
             ]
         )
+        try:
+            self.browser_session = self.browser.new_browser_cdp_session()
+        except PlaywrightError:
+            self.browser_session = None
+        self.new_context()
+
+    def new_context(self):
         self.context = self.browser.new_context(
             viewport={"width": 1280, "height": 720}
         )
+        if self.resource_profile["resource_types"] or self.resource_profile["domains"]:
+            self.context.route("**/*", self.route_request)
+        self.new_page()
+
+    def new_page(self):
         self.page = self.context.new_page()
+        self.crashed = False
+        self.page.on("crash", self.on_crash)
+
+    def on_crash(self, *args):
+        self.crashed = True
+
+    def page_heap(self) -> Optional[int]:
+        try:
+            return int(self.page.evaluate(HEAP_SCRIPT)) or None
+        except PlaywrightError:
+            return None
+
+    def browser_rss(self) -> Optional[int]:
+        if self.browser_session is None:
+            return None
+        try:
+            processes = self.browser_session.send("SystemInfo.getProcessInfo")["processInfo"]
+        except PlaywrightError:
+            return None
+        return processes_rss(process["id"] for process in processes)
+
+    def recycle(self, level : str, reason : str):
+        print(f"Recycling browser {level} after {self.lifecycle.context_count} navigations: {reason}", flush=True)
+        metrics.inc(BROWSER_RECYCLES_TOTAL, level=level, reason=reason)
+        close_quietly(self.page)
+        if level == 'page':
+            self.new_page()
+        elif level == 'context':
+            close_quietly(self.context)
+            self.new_context()
+        else:
+            close_quietly(self.context)
+            close_quietly(self.browser)
+            self.start_browser()
+        self.lifecycle.reset(level)
+
+    def maintain(self):
+        if self.crashed or not self.browser.is_connected():
+            self.recycle('browser', 'crash')
+            return
+        if self.lifecycle.should_check_memory():
+            action = self.lifecycle.decide(self.page_heap(), self.browser_rss())
+        else:
+            action = self.lifecycle.decide()
+        if action is not None:
+            self.recycle(*action)
+
+    def route_request(self, route):
+        request = route.request
+        if is_blocked(self.resource_profile, request.resource_type, request.url):
+            route.abort()
+        else:
+            route.continue_()
+
+    def wait_for_selectors(self, selectors: Sequence[str], max_scrolls: int = 15, timeout: float = 15000):
+        # Lower widgets are rendered lazily, so scroll further down while any of them is missing
+        deadline = time.monotonic() + timeout / 1000
+        for _ in range(max_scrolls + 1):
+            missing = [selector for selector in selectors if self.page.query_selector(selector) is None]
+            if not missing:
+                return True
+            remaining = (deadline - time.monotonic()) * 1000
+            if remaining <= 0:
+                return False
+            try:
+                self.page.wait_for_selector(missing[0], state='attached', timeout=min(remaining, 1000))
+            except PlaywrightTimeoutError:
+                self.page.mouse.wheel(0, 720)
+        return False
+
+    def scroll_until_stable(self, tiles_selector: str, max_scrolls: int = 60, stable_rounds: int = 2, idle_timeout: float = 2000):
+        tiles_count = self.page.locator(tiles_selector).count()
+        idle_rounds = 0
+        for _ in range(max_scrolls):
+            self.page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+            try:
+                self.page.wait_for_function(
+                    "([selector, count]) => document.querySelectorAll(selector).length > count",
+                    arg=[tiles_selector, tiles_count], timeout=idle_timeout
+                )
+            except PlaywrightTimeoutError:
+                idle_rounds += 1
+                if idle_rounds >= stable_rounds:
+                    break
+                continue
+            idle_rounds = 0
+            tiles_count = self.page.locator(tiles_selector).count()
+        return tiles_count
+
+    def wait_for_network_idle(self, timeout: float = 3000):
+        try:
+            self.page.wait_for_load_state('networkidle', timeout=timeout)
+        except PlaywrightTimeoutError:
+            # Ozon keeps background requests alive, the DOM is usable anyway
+            pass
+
+    def load_page(self, url: str, ready_selectors: Sequence[str] = (), tiles_selector: Optional[str] = None,
+                  max_scrolls: int = 60, timeout: float = 15000):
+        self.maintain()
+        try:
+            return self.navigate(url, ready_selectors, tiles_selector, max_scrolls, timeout)
+        except PlaywrightError as e:
+            crashed = self.crashed or not self.browser.is_connected() \
+                or (not isinstance(e, PlaywrightTimeoutError) and is_crash(e))
+            if not crashed:
+                raise
+            # The task is not lost with the browser, it is loaded once more in a fresh one
+            print(f"Browser crashed while loading {url}: {e}", flush=True)
+            self.recycle('browser', 'crash')
+            return self.navigate(url, ready_selectors, tiles_selector, max_scrolls, timeout)
+
+    def wait_page(self, ready_selectors: Sequence[str], timeout: float = 15000) -> Optional[str]:
+        # Keeps waiting on the page that is already open, None means it has to be loaded again
+        try:
+            with metrics.timer(STAGE_SECONDS, stage="wait"):
+                self.wait_for_selectors(ready_selectors, timeout=timeout)
+            with metrics.timer(STAGE_SECONDS, stage="content"):
+                return self.page.content()
+        except PlaywrightError as e:
+            print(f"Page stopped rendering while waiting: {e}", flush=True)
+            return None
 
-    def get_page_source(self, cool_down: float = 0.2):
-        time.sleep(cool_down)
-        return self.page.content()
-
-    def scrolldown_get_page(self, deep: int):
-        for _ in range(deep):
-            self.page.mouse.wheel(0, 250)
-            time.sleep(0.1)
-        self.page.wait_for_load_state('domcontentloaded')
-        return self.page.content()
-
-    def get_page(self, url: str, scroll_deep: int = 10, wait_seconds: float = 1):
-        self.page.goto(url, timeout=60000)
-        time.sleep(wait_seconds)
-        return self.scrolldown_get_page(scroll_deep)
-
-    def click_button_get_page(self, xpath: str, scroll_deep: int = 5):
-        self.page.wait_for_selector(f'xpath={xpath}', timeout=15000)
-        button = self.page.locator(f'xpath={xpath}')
-        button.scroll_into_view_if_needed()
-        button.click()
-        return self.scrolldown_get_page(scroll_deep)
+    def navigate(self, url: str, ready_selectors: Sequence[str] = (), tiles_selector: Optional[str] = None,
+                 max_scrolls: int = 60, timeout: float = 15000):
+        started = time.perf_counter()
+        with metrics.timer(STAGE_SECONDS, stage="navigate"):
+            self.page.goto(url, timeout=60000, wait_until='domcontentloaded')
+        self.lifecycle.record_navigation(time.perf_counter() - started)
+        if ready_selectors:
+            with metrics.timer(STAGE_SECONDS, stage="wait"):
+                self.wait_for_selectors(ready_selectors, timeout=timeout)
+        if tiles_selector:
+            with metrics.timer(STAGE_SECONDS, stage="scroll"):
+                self.scroll_until_stable(tiles_selector, max_scrolls)
+        with metrics.timer(STAGE_SECONDS, stage="network_idle"):
+            self.wait_for_network_idle()
+        with metrics.timer(STAGE_SECONDS, stage="content"):
+            return self.page.content()
 
     def quit(self):
-        if self.page:
-            self.page.close()
-        if self.context:
-            self.context.close()
-        if self.browser:
-            self.browser.close()
+        close_quietly(self.page)
+        close_quietly(self.context)
+        close_quietly(self.browser)
         if self.playwright:
             self.playwright.stop()
@@ -0,0 +1,63 @@
+from threading import Lock
+from typing import List
+
+from index_db.db import get_db
+from index_db.operations import FrontierRepository
+from ozon_scraper.metrics import metrics, VISITED_TOTAL
+from ozon_scraper.urls import canonicalize_url, canonical_key
+
+
+class Frontier:
+    def __init__(self, database_url : str):
+        self.db = next(get_db(database_url))
+        self.lock = Lock()
+        self.seen_keys = set()
+
+    def start(self, start_urls : List[str]) -> List[str]:
+        with self.lock:
+            pending = FrontierRepository.get_pending(self.db)
+            if pending:
+                self.seen_keys = FrontierRepository.get_keys(self.db)
+                print(f"Resuming crawl with {len(pending)} pending urls", flush=True)
+                return [task.url for task in pending]
+            # The previous round was finished, start a new one from the seeds
+            FrontierRepository.clear(self.db)
+            self.seen_keys = set()
+        return self.add(start_urls)
+
+    def add(self, urls : List[str]) -> List[str]:
+        new_tasks = []
+        with self.lock:
+            for url in urls:
+                canonical_url = canonicalize_url(url)
+                if canonical_url is None:
+                    continue
+                key = canonical_key(canonical_url)
+                if key in self.seen_keys:
+                    continue
+                self.seen_keys.add(key)
+                new_tasks.append((key, canonical_url))
+            FrontierRepository.add_many(self.db, new_tasks)
+        return [url for _, url in new_tasks]
+
+    def requeue(self, urls : List[str]) -> List[str]:
+        # Revisits bypass the seen check, the task becomes pending again until it is visited
+        requeued_urls = []
+        with self.lock:
+            for url in urls:
+                canonical_url = canonicalize_url(url)
+                if canonical_url is None:
+                    continue
+                key = canonical_key(canonical_url)
+                self.seen_keys.add(key)
+                FrontierRepository.requeue(self.db, key, canonical_url)
+                requeued_urls.append(canonical_url)
+        return requeued_urls
+
+    def mark_visited(self, url : str):
+        with self.lock:
+            FrontierRepository.mark_visited(self.db, canonical_key(url))
+        metrics.inc(VISITED_TOTAL)
+
+    def close(self):
+        self.db.close()
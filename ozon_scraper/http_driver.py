@@ -0,0 +1,161 @@
+import importlib.util
+import json
+import os
+import re
+import time
+from typing import Callable, Optional, Sequence
+from urllib.parse import urlsplit, urlunsplit
+
+from ozon_scraper.driver import ChromeDriver
+from ozon_scraper.metrics import metrics, STAGE_SECONDS, HTTP_FALLBACKS_TOTAL
+from ozon_scraper.urls import OZON_HOST
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+PAGE_API_PATH = "/api/entrypoint-api.bx/page/json/v2"
+BLOCKED_STATUSES = {403, 429, 498}
+SELECTOR_WIDGET_PATTERN = re.compile(r'(?:data-widget="|id\^="state-)([A-Za-z0-9]+)')
+FETCHER_OPTIONS = ('fetcher', 'api_base_url')
+API_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Accept": "application/json",
+    "Accept-Language": "ru-RU,ru;q=0.9",
+}
+
+
+class BlockedError(Exception):
+    pass
+
+class IncompletePageError(Exception):
+    pass
+
+def required_widgets(selectors : Sequence[str]) -> set:
+    # The selectors the browser would wait for name the widgets the page has to carry
+    return {match.group(1) for selector in selectors for match in SELECTOR_WIDGET_PATTERN.finditer(selector)}
+
+class OzonApiDriver:
+    # Loads pages through the JSON page API instead of a browser. Responses carry the same widget states
+    # the rendered page embeds, so they are returned as is and the parsers read them directly.
+    # The browser is only started once the API blocks us, and is used alone for a cool down after that.
+    def __init__(self, base_url : str = f"https://{OZON_HOST}", fallback : Optional[Callable] = None,
+                 listing_pages : int = 5, product_pages : int = 2, timeout : float = 20.0,
+                 block_cooldown : float = 300.0, max_connections : int = 10):
+        if httpx is None:
+            raise ValueError("The HTTP fetcher needs the httpx package")
+        self.base_url = base_url.rstrip('/')
+        self.fallback = fallback
+        self.fallback_driver = None
+        self.browser_loaded = False
+        self.listing_pages = listing_pages
+        self.product_pages = product_pages
+        self.block_cooldown = block_cooldown
+        self.blocked_until = 0.0
+        # One pooled client keeps the connections alive and carries the cookies Ozon sets between requests
+        self.client = httpx.Client(
+            http2=importlib.util.find_spec('h2') is not None,
+            headers=API_HEADERS,
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def api_path(self, url : str) -> str:
+        parts = urlsplit(url)
+        return urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+    def fetch_json(self, path : str) -> dict:
+        response = self.client.get(self.base_url + PAGE_API_PATH, params={'url': path})
+        if response.status_code in BLOCKED_STATUSES:
+            raise BlockedError(f"status {response.status_code}")
+        response.raise_for_status()
+        try:
+            page = response.json()
+        except ValueError:
+            # Anti-bot challenges are served as HTML with a success status
+            raise BlockedError("not json")
+        if not isinstance(page, dict) or not page.get('widgetStates'):
+            raise BlockedError("no widget states")
+        return page
+
+    def fetch_page(self, url : str, max_pages : int, required : set = frozenset()) -> str:
+        widget_states = {}
+        path = self.api_path(url)
+        for page_index in range(max_pages):
+            with metrics.timer(STAGE_SECONDS, stage="navigate"):
+                page = self.fetch_json(path)
+            for key, state in page['widgetStates'].items():
+                # The same widget comes back on every page, later pages get their own keys
+                widget_states[key if not page_index else f"{key}-page{page_index}"] = state
+            path = page.get('nextPage')
+            if not path:
+                break
+        names = {key.split('-')[0] for key in widget_states}
+        missing = [name for name in required if name not in names]
+        if missing:
+            raise IncompletePageError(f"no {', '.join(sorted(missing))} widgets")
+        return json.dumps({'widgetStates': widget_states}, ensure_ascii=False)
+
+    def load_browser(self, url : str, *args, **kwargs) -> str:
+        if self.fallback is None:
+            raise BlockedError(f"Page API is blocked and there is no browser to fall back to for {url}")
+        if self.fallback_driver is None:
+            self.fallback_driver = self.fallback()
+        self.browser_loaded = True
+        return self.fallback_driver.load_page(url, *args, **kwargs)
+
+    def wait_page(self, ready_selectors : Sequence[str], timeout : float = 15000) -> Optional[str]:
+        # Page API responses are complete, only a page open in the browser can render more
+        if not self.browser_loaded:
+            return None
+        return self.fallback_driver.wait_page(ready_selectors, timeout)
+
+    def load_page(self, url : str, ready_selectors : Sequence[str] = (), tiles_selector : Optional[str] = None,
+                  max_scrolls : int = 60, timeout : float = 15000) -> str:
+        self.browser_loaded = False
+        if time.monotonic() < self.blocked_until:
+            return self.load_browser(url, ready_selectors, tiles_selector, max_scrolls, timeout)
+        try:
+            return self.fetch_page(url, self.listing_pages if tiles_selector else self.product_pages,
+                                   required_widgets(ready_selectors))
+        except (BlockedError, IncompletePageError, httpx.HTTPError) as e:
+            if isinstance(e, BlockedError):
+                reason = "blocked"
+            elif isinstance(e, IncompletePageError):
+                reason = "incomplete"
+            else:
+                reason = type(e).__name__
+            metrics.inc(HTTP_FALLBACKS_TOTAL, reason=reason)
+            if isinstance(e, BlockedError):
+                self.blocked_until = time.monotonic() + self.block_cooldown
+            print(f"Page API failed for {url} ({e}), loading it in the browser", flush=True)
+            return self.load_browser(url, ready_selectors, tiles_selector, max_scrolls, timeout)
+
+    def quit(self):
+        self.client.close()
+        if self.fallback_driver is not None:
+            self.fallback_driver.quit()
+
+def driver_options_from_env() -> dict:
+    return {
+        'headless': os.getenv('CRAWLER_HEADLESS', '0') == '1',
+        'block_profile': os.getenv('CRAWLER_BLOCK_PROFILE', 'lean'),
+        'page_navigations': int(os.getenv('CRAWLER_PAGE_NAVIGATIONS', 100)),
+        'context_navigations': int(os.getenv('CRAWLER_CONTEXT_NAVIGATIONS', 1000)),
+        'max_heap_mb': float(os.getenv('CRAWLER_MAX_HEAP_MB', 512)),
+        'max_rss_mb': float(os.getenv('CRAWLER_MAX_RSS_MB', 2048)),
+        'fetcher': os.getenv('CRAWLER_FETCHER', 'browser'),
+        'api_base_url': os.getenv('OZON_API_BASE_URL'),
+    }
+
+def browser_options(driver_options : Optional[dict]) -> dict:
+    return {key: value for key, value in (driver_options or {}).items() if key not in FETCHER_OPTIONS}
+
+def create_driver(driver_options : Optional[dict] = None):
+    driver_options = driver_options or {}
+    options = browser_options(driver_options)
+    if driver_options.get('fetcher', 'browser') == 'http':
+        return OzonApiDriver(driver_options.get('api_base_url') or f"https://{OZON_HOST}", fallback=lambda: ChromeDriver(**options))
+    return ChromeDriver(**options)
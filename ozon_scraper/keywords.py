@@ -0,0 +1,80 @@
+import os
+import re
+import time
+from threading import Lock
+from typing import Iterable, List, Optional
+
+from index_db.operations import normalize_text
+
+
+def normalize_keyword_text(text : str) -> str:
+    return normalize_text(text.lower().replace('ё', 'е'))
+
+def trie_pattern(words : Iterable[str]) -> str:
+    # Keywords sharing a prefix share a branch, so the regex engine tests every position against a trie
+    # instead of trying each keyword in turn, and the cost stays flat as the list grows
+    trie = {}
+    for word in words:
+        node = trie
+        for symbol in word:
+            node = node.setdefault(symbol, {})
+        node[''] = True
+
+    def build(node : dict) -> str:
+        if '' in node:
+            # A keyword ends here, longer keywords on this branch would only repeat the same match
+            return ''
+        branches = [re.escape(symbol) + build(child) for symbol, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return build(trie)
+
+class KeywordMatcher:
+    def __init__(self, path : str, check_interval : float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.pattern = None
+        self.keywords = []
+        self.mtime = None
+        self.checked_at = 0.0
+        self.reload()
+
+    def compile(self, keywords : List[str]):
+        keywords = sorted({normalize_keyword_text(word) for word in keywords} - {''})
+        self.keywords = keywords
+        self.pattern = re.compile(trie_pattern(keywords)) if keywords else None
+
+    def reload(self, force : bool = False) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self.mtime is None:
+                raise
+            # The file is being replaced, the last loaded keywords stay in use
+            return False
+        if not force and mtime == self.mtime:
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            keywords = f.read().split('\n')
+        with self.lock:
+            self.compile(keywords)
+            self.mtime = mtime
+        print(f"Loaded {len(self.keywords)} keywords from {self.path}", flush=True)
+        return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        self.reload()
+
+    def matches(self, *texts : Optional[str]) -> bool:
+        self.maybe_reload()
+        pattern = self.pattern
+        if pattern is None:
+            return False
+        return any(text and pattern.search(normalize_keyword_text(text)) for text in texts)
+
+keyword_matcher = KeywordMatcher(os.getenv('KEYWORDS_FILE', 'keywords.txt'))
@@ -0,0 +1,85 @@
+import os
+from typing import Iterable, Optional, Tuple
+
+from ozon_scraper.metrics import metrics, BROWSER_MEMORY_BYTES, NAVIGATION_LATENCY_SECONDS
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CRASH_MARKERS = ("crash", "target closed", "has been closed", "connection closed", "browser closed")
+HEAP_SCRIPT = "() => performance.memory ? performance.memory.usedJSHeapSize : 0"
+
+
+def is_crash(error : Exception) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in CRASH_MARKERS)
+
+def processes_rss(pids : Iterable[int]) -> Optional[int]:
+    # Chromium reports its process ids over CDP, their resident memory is read from /proc
+    total, found = 0, False
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm", "r") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+            found = True
+        except (OSError, ValueError, IndexError):
+            continue
+    return total if found else None
+
+class BrowserLifecycle:
+    # Long crawls grow the renderer heap and slow navigation down, so the page, the context
+    # or the whole browser is replaced before that shows up in the per-page latency
+    def __init__(self, page_navigations : int = 100, context_navigations : int = 1000, max_heap_mb : float = 512,
+                 max_rss_mb : float = 2048, latency_factor : float = 2.0, check_every : int = 10,
+                 warmup_navigations : int = 20, smoothing : float = 0.1):
+        self.page_navigations = page_navigations
+        self.context_navigations = context_navigations
+        self.max_heap_bytes = max_heap_mb * 1024 * 1024 if max_heap_mb else None
+        self.max_rss_bytes = max_rss_mb * 1024 * 1024 if max_rss_mb else None
+        self.latency_factor = latency_factor
+        self.check_every = check_every
+        self.warmup_navigations = warmup_navigations
+        self.smoothing = smoothing
+        self.page_count = 0
+        self.context_count = 0
+        self.unchecked_count = 0
+        self.latency = None
+        self.baseline_latency = None
+
+    def reset(self, level : str):
+        self.page_count = 0
+        if level in ('context', 'browser'):
+            self.context_count = 0
+            self.latency = None
+            self.baseline_latency = None
+
+    def record_navigation(self, seconds : float):
+        self.page_count += 1
+        self.context_count += 1
+        self.unchecked_count += 1
+        self.latency = seconds if self.latency is None else self.latency + self.smoothing * (seconds - self.latency)
+        if self.baseline_latency is None and self.context_count >= self.warmup_navigations:
+            self.baseline_latency = self.latency
+        metrics.set_gauge(NAVIGATION_LATENCY_SECONDS, self.latency)
+
+    def should_check_memory(self) -> bool:
+        if self.unchecked_count < self.check_every:
+            return False
+        self.unchecked_count = 0
+        return True
+
+    def decide(self, heap_bytes : Optional[int] = None, rss_bytes : Optional[int] = None) -> Optional[Tuple[str, str]]:
+        if heap_bytes is not None:
+            metrics.set_gauge(BROWSER_MEMORY_BYTES, heap_bytes, kind="heap")
+        if rss_bytes is not None:
+            metrics.set_gauge(BROWSER_MEMORY_BYTES, rss_bytes, kind="rss")
+        if self.max_rss_bytes and rss_bytes is not None and rss_bytes > self.max_rss_bytes:
+            return 'browser', 'memory'
+        if self.max_heap_bytes and heap_bytes is not None and heap_bytes > self.max_heap_bytes:
+            return 'context', 'memory'
+        if self.context_navigations and self.context_count >= self.context_navigations:
+            return 'context', 'navigations'
+        if self.baseline_latency and self.context_count >= 2 * self.warmup_navigations \
+                and self.latency > self.latency_factor * self.baseline_latency:
+            return 'context', 'latency'
+        if self.page_navigations and self.page_count >= self.page_navigations:
+            return 'page', 'navigations'
+        return None
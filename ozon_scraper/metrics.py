@@ -0,0 +1,139 @@
+import contextlib
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Event
+from typing import Dict, Optional, Tuple
+
+STAGE_SECONDS = "crawler_stage_seconds"
+PAGES_TOTAL = "crawler_pages_total"
+PAGE_SECONDS = "crawler_page_seconds"
+EXCEPTIONS_TOTAL = "crawler_exceptions_total"
+DISCOVERED_URLS_TOTAL = "crawler_discovered_urls_total"
+VISITED_TOTAL = "crawler_visited_total"
+QUEUE_DEPTH = "crawler_queue_depth"
+PRODUCT_LOAD_RETRIES_TOTAL = "crawler_product_load_retries_total"
+PRODUCT_LOAD_FAILURES_TOTAL = "crawler_product_load_failures_total"
+BROWSER_RECYCLES_TOTAL = "crawler_browser_recycles_total"
+BROWSER_MEMORY_BYTES = "crawler_browser_memory_bytes"
+NAVIGATION_LATENCY_SECONDS = "crawler_navigation_latency_seconds"
+HTTP_FALLBACKS_TOTAL = "crawler_http_fallbacks_total"
+
+
+def label_key(labels : dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(labels : Tuple[Tuple[str, str], ...], extra : str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        # Timers are exported as Prometheus summaries, the count and the sum of the observed seconds
+        self.timers = defaultdict(lambda: [0, 0.0, 0.0])
+        self.started_at = time.time()
+
+    def inc(self, name : str, value : float = 1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+
+    def set_gauge(self, name : str, value : float, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name : str, seconds : float, **labels):
+        with self.lock:
+            timer = self.timers[(name, label_key(labels))]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name : str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Tuple[Dict, Dict, Dict]:
+        with self.lock:
+            return dict(self.counters), dict(self.gauges), {key: list(value) for key, value in self.timers.items()}
+
+    def render(self) -> str:
+        counters, gauges, timers = self.snapshot()
+        lines = []
+        for metric_type, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (metric_name, labels), value in sorted(values.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# TYPE {name} summary")
+            for (metric_name, labels), (count, total, _) in sorted(timers.items()):
+                if metric_name == name:
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        counters, gauges, timers = self.snapshot()
+        uptime = time.time() - self.started_at
+        pages = sum(value for (name, _), value in counters.items() if name == PAGES_TOTAL)
+        exceptions = sum(value for (name, _), value in counters.items() if name == EXCEPTIONS_TOTAL)
+        queue_depth = sum(value for (name, _), value in gauges.items() if name == QUEUE_DEPTH)
+        parts = [f"{pages:.0f} pages ({pages / uptime * 60 if uptime else 0:.1f}/min)", f"{exceptions:.0f} exceptions",
+                 f"queue {queue_depth:.0f}"]
+        stages = sorted(
+            ((dict(labels).get('stage'), count, total) for (name, labels), (count, total, _) in timers.items() if name == STAGE_SECONDS),
+            key=lambda stage: -stage[2]
+        )
+        for stage, count, total in stages:
+            parts.append(f"{stage} {total:.1f}s/{count} (avg {total / count:.3f}s)")
+        return "Crawler metrics: " + ", ".join(parts)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+            self.started_at = time.time()
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port : int, host : str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Metrics are served on http://{host}:{server.server_address[1]}/metrics", flush=True)
+    return server
+
+def start_summary_logger(interval_seconds : float, stop : Optional[Event] = None) -> Event:
+    stop = stop or Event()
+
+    def log_summary():
+        while not stop.wait(interval_seconds):
+            print(metrics.summary(), flush=True)
+
+    Thread(target=log_summary, name="metrics-summary", daemon=True).start()
+    return stop
@@ -1,32 +1,42 @@
-import datetime
+import contextlib
+import os
+import re
+import time
+from typing import List, Optional, Tuple
 
 from parsel import Selector
 
-from index_db.operations import BrandRepository, SellerRepository, ProductRepository
+from index_db.operations import BrandRepository, SellerRepository, ProductRepository, batch, product_state_index
 from .driver import ChromeDriver
+from .keywords import keyword_matcher
+from .metrics import (
+    metrics, STAGE_SECONDS, PAGES_TOTAL, PAGE_SECONDS, EXCEPTIONS_TOTAL, DISCOVERED_URLS_TOTAL,
+    PRODUCT_LOAD_RETRIES_TOTAL, PRODUCT_LOAD_FAILURES_TOTAL
+)
+from .scheduler import revisit_scheduler
+from .urls import canonicalize_url, OZON_HOST
+from .widgets import clean_price, extract_listing_title, extract_product, extract_tile_cards, is_page_json, parse_rating_reviews
 
-with open('keywords.txt', 'r') as f:
-    KEYWORDS = f.read().split('\n')
+TILE_PATTERN = re.compile(r'class="[^"]*\btile-root\b')
+LISTING_TILES_SELECTOR = '#contentScrollPaginator div.tile-root'
+LISTING_READY_SELECTORS = ('div[data-widget="sellerTransparency"]',)
+PRODUCT_READY_SELECTORS = (
+    'div[data-widget="webProductHeading"]',
+    'div[data-widget="webPrice"]',
+    'div[data-widget="webCurrentSeller"]',
+)
+PRODUCT_STATE_SELECTORS = ('div[id^="state-webPrice"]', 'div[id^="state-webCurrentSeller"]')
+PRODUCT_LOAD_TIMEOUTS = (15000, 30000)
+# Widget states are rendered with the markup, so the lazy lower blocks usually do not have to be waited for.
+# When they cannot be read, the widgets are waited for on the page that is already open.
+PRODUCT_LOAD_STAGES = ((PRODUCT_STATE_SELECTORS, 5000), (PRODUCT_READY_SELECTORS, PRODUCT_LOAD_TIMEOUTS[0]))
+# Known products are updated straight from listing cards, their pages are only visited for what cards lack
+CARD_INGESTION = os.getenv('CARD_INGESTION', '1') == '1'
 
 
-def parse_product_card(product_selector : Selector, db):
+def scrape_product_card(product_selector : Selector) -> dict:
     product_info = product_selector.xpath('div')[0]
-    product_url = product_info.css('a').attrib['href']
-    product_primary_key = int(product_url.split('/')[-2].split('-')[-1])
-    product_name = product_info.xpath('a/div').css('span::text').get()
-    product_price = product_info.xpath('div')[0].xpath('div').css('span::text')[0].get().replace('\u2009', '')[:-1]
-    product_brand_name = product_info.xpath('div')[1].css('b::text').get()
-    continue_parsing = False
-    for word in KEYWORDS:
-        if word in product_name.lower() or word in product_brand_name.lower():
-            continue_parsing = True
-            break
-    if not continue_parsing:
-        return None
-    if product_brand_name:
-        brand_id = BrandRepository.get_or_create(db, product_brand_name).id
-    else:
-        brand_id = None
+    product_url = canonicalize_url(product_info.css('a').attrib['href'])
     product_rating_reviews = product_info.xpath('div')[2].css('span::text')
     if product_rating_reviews:
         product_rating = float(product_rating_reviews[0].get())
@@ -34,115 +44,199 @@ def parse_product_card(product_selector : Selector, db):
     else:
         product_rating = 0.0
         product_reviews = 0
-    product_sections = product_selector.css('section').xpath('div/div').css('div::text')
     product_on_sale = False
-    for section in product_sections:
-        section_name = section.get()
-        product_on_sale = 'Распродажа' in section_name
+    for section in product_selector.css('section').xpath('div/div').css('div::text'):
+        product_on_sale = 'Распродажа' in section.get()
         if product_on_sale: break
-    product_description = {
-        'pk' : product_primary_key,
-        'name' : product_name,
+    return {
+        'pk' : int(product_url.split('/')[-2].split('-')[-1]),
+        'name' : product_info.xpath('a/div').css('span::text').get(),
         'url' : product_url,
         'on_sale' : product_on_sale,
-        'price' : None,
-        'price_ozon_card' : product_price,
+        'price_ozon_card' : clean_price(product_info.xpath('div')[0].xpath('div').css('span::text')[0].get()),
         'rating' : product_rating,
         'review_count' : product_reviews,
+        'brand_name' : product_info.xpath('div')[1].css('b::text').get(),
+    }
+
+def parse_product_card(card : dict, db) -> Optional[str]:
+    if not keyword_matcher.matches(card['name'], card['brand_name']):
+        return None
+    if card['brand_name']:
+        brand_id = BrandRepository.get_or_create(db, card['brand_name']).id
+    else:
+        brand_id = None
+    product_description = {
+        'pk' : card['pk'],
+        'name' : card['name'],
+        'url' : card['url'],
+        'on_sale' : card['on_sale'],
+        'price' : None,
+        'price_ozon_card' : card['price_ozon_card'],
+        'rating' : card['rating'],
+        'review_count' : card['review_count'],
         'question_count' : None,
         'seller_id' : None,
         'brand_id' : brand_id,
     }
     product_description['hash'] = ProductRepository.compute_product_hash(product_description)
-    product_stored = ProductRepository.get_by_pk(db, product_primary_key)
-    if not (product_stored and ProductRepository.get_last_state(db, product_stored.id).hash == product_description['hash']):
-        return product_url
+    card_changed = product_state_index.get(db, card['pk']) != product_description['hash']
+    if not CARD_INGESTION:
+        return card['url'] if card_changed else None
+    product_id = product_state_index.get_product_id(db, card['pk'])
+    if product_id is None:
+        return card['url']
+    if card_changed and not ingest_product_card(card['pk'], product_description, db):
+        return card['url']
+    # Unchanged cards say nothing about the regular price, the questions or the seller
+    if revisit_scheduler.product_page_is_stale(db, product_id):
+        return card['url']
     return None
 
-def parse_seller(url : str, db, driver : ChromeDriver, refresh_after_seconds : int = 60*60):
-    current_time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+def ingest_product_card(product_pk : int, product_description : dict, db) -> bool:
+    product_stored = ProductRepository.get_by_pk(db, product_pk)
+    if product_stored is None:
+        return False
+    last_state = ProductRepository.get_last_state(db, product_stored.id)
+    if last_state is None:
+        return False
+    # Cards carry no seller, regular price or question count, those stay as the last product page showed them
+    product_description['price'] = last_state.price
+    product_description['question_count'] = last_state.question_count
+    product_description['seller_id'] = product_stored.seller_id
+    ProductRepository.add_state(db, product_stored.id, product_description)
+    return True
+
+def seller_needs_refresh(url : str, db, refresh_after_seconds : Optional[int] = None) -> bool:
     seller_stored = SellerRepository.get_by_url(db, url)
-    if seller_stored is not None and (current_time - seller_stored.last_update).seconds < refresh_after_seconds:
-        return []
-    html_src = driver.get_page(url, 60, 3)
-    response = Selector(html_src)
-    seller_name = response.xpath('//div[@data-widget="sellerTransparency"]/div')[0].css('span::text').get()
-    seller_id = SellerRepository.get_or_create(db, seller_name, url).id
-    seller_products = response.xpath('//div[@id="contentScrollPaginator"]').css('div.tile-root')
+    return revisit_scheduler.seller_is_stale(db, seller_stored, refresh_after_seconds)
+
+def parse_listing(html_src : str, db, response : Optional[Selector] = None) -> List[str]:
+    # Tiles are read from the embedded widget state first, the DOM is only walked for tiles it does not cover
     products_to_parse = []
-    for product in seller_products:
+    parsed_pks = set()
+    for card in extract_tile_cards(html_src):
+        if card['pk'] in parsed_pks:
+            continue
+        parsed_pks.add(card['pk'])
+        product_url = parse_product_card(card, db)
+        if product_url is not None:
+            products_to_parse.append(product_url)
+    if is_page_json(html_src) or len(parsed_pks) >= len(TILE_PATTERN.findall(html_src)):
+        return products_to_parse
+    response = response or Selector(html_src)
+    for product in response.xpath('//div[@id="contentScrollPaginator"]').css('div.tile-root'):
         try:
-            product_url = parse_product_card(product, db)
+            card = scrape_product_card(product)
+            if card['pk'] in parsed_pks:
+                continue
+            product_url = parse_product_card(card, db)
             if product_url is not None:
                 products_to_parse.append(product_url)
         except Exception:
             continue
     return products_to_parse
 
-def parse_brand(url : str, db, driver : ChromeDriver, refresh_after_seconds : int = 60*60):
-    current_time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+def parse_seller_page(url : str, html_src : str, db) -> List[str]:
+    with metrics.timer(STAGE_SECONDS, stage="parse"):
+        if is_page_json(html_src):
+            response = None
+            seller_name = extract_listing_title(html_src)
+            if seller_name is None:
+                raise ValueError(f"Seller page {url} has no seller name")
+        else:
+            response = Selector(html_src)
+            seller_name = response.xpath('//div[@data-widget="sellerTransparency"]/div')[0].css('span::text').get()
+        seller = SellerRepository.get_or_create(db, seller_name, url)
+        SellerRepository.update(db, seller.id)
+        return parse_listing(html_src, db, response)
+
+def parse_seller(url : str, db, driver : ChromeDriver, refresh_after_seconds : Optional[int] = None, force : bool = False):
+    if not force and not seller_needs_refresh(url, db, refresh_after_seconds):
+        return []
+    html_src = driver.load_page(url, LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR, 60)
+    return parse_seller_page(url, html_src, db)
+
+def brand_needs_refresh(url : str, db, refresh_after_seconds : Optional[int] = None) -> bool:
     brand_stored = BrandRepository.get_by_url(db, url)
-    if brand_stored is not None and (current_time - brand_stored.last_update).seconds < refresh_after_seconds:
+    return revisit_scheduler.brand_is_stale(db, brand_stored, refresh_after_seconds)
+
+def parse_brand_page(url : str, html_src : str, db) -> List[str]:
+    with metrics.timer(STAGE_SECONDS, stage="parse"):
+        if is_page_json(html_src):
+            response = None
+            brand_name = extract_listing_title(html_src)
+            if brand_name is None:
+                raise ValueError(f"Brand page {url} has no brand name")
+        else:
+            response = Selector(html_src)
+            brand_name = response.xpath('//div[@data-widget="sellerTransparency"]')[0].css('span::text').get().replace('\n', '').strip()
+        brand = BrandRepository.get_or_create(db, brand_name, url)
+        BrandRepository.update(db, brand.id)
+        return parse_listing(html_src, db, response)
+
+def parse_brand(url : str, db, driver : ChromeDriver, refresh_after_seconds : Optional[int] = None, force : bool = False):
+    if not force and not brand_needs_refresh(url, db, refresh_after_seconds):
         return []
-    html_src = driver.get_page(url, 60, 3)
-    response = Selector(html_src)
-    brand_name = response.xpath('//div[@data-widget="sellerTransparency"]')[0].css('span::text').get().replace('\n', '').strip()
-    brand_id = BrandRepository.get_or_create(db, brand_name, url).id
-    brand_products = response.xpath('//div[@id="contentScrollPaginator"]')[0].css('div.tile-root')
-    products_to_parse = []
-    for product in brand_products:
-        try:
-            product_url = parse_product_card(product, db)
-            if product_url is not None:
-                products_to_parse.append(product_url)
-        except Exception:
-            continue
-    return products_to_parse
+    html_src = driver.load_page(url, LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR, 60)
+    return parse_brand_page(url, html_src, db)
+
+def parse_category_page(url : str, html_src : str, db) -> List[str]:
+    with metrics.timer(STAGE_SECONDS, stage="parse"):
+        return parse_listing(html_src, db)
 
 def parse_category(url : str, db, driver : ChromeDriver):
-    html_src = driver.get_page(url, 30, 3)
-    response = Selector(html_src)
-    category_products = response.xpath('//div[@id="contentScrollPaginator"]').css('div.tile-root')
-    products_to_parse = []
-    for product in category_products:
-        try:
-            product_url = parse_product_card(product, db)
-            if product_url is not None:
-                products_to_parse.append(product_url)
-        except Exception:
-            continue
-    return products_to_parse
+    html_src = driver.load_page(url, (LISTING_TILES_SELECTOR,), LISTING_TILES_SELECTOR, 30)
+    return parse_category_page(url, html_src, db)
 
-def parse_product(url : str, db, driver : ChromeDriver, refresh_after_seconds : int = 60*60):
-    try:
-        html_src = driver.get_page(url, 15)
-        response = Selector(html_src)
-        product_card, product_sellers = response.css('div.container.c')
-    except ValueError:
-        for try_cooldown in range(1, 6):
-            html_src = driver.get_page(url, 15*try_cooldown, 2*try_cooldown)
+def product_page_loaded(response : Selector) -> bool:
+    return len(response.css('div.container.c')) == 2
+
+def parse_product_source(url : str, html_src : str, db, refresh_after_seconds : Optional[int] = None) -> Optional[List[str]]:
+    with metrics.timer(STAGE_SECONDS, stage="parse"):
+        product = extract_product(html_src, url)
+        if product is None:
+            if is_page_json(html_src):
+                return None
             response = Selector(html_src)
-            if len(response.css('div.container.c')) == 2:
-                break
-        else:
-            print(f"Page {url} was not loaded", flush=True)
-            return []
-        product_card, product_sellers = response.css('div.container.c')
-    current_time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
-    links_to_parse = []
-    # Scraping product
+            if not product_page_loaded(response):
+                return None
+            product = scrape_product_page(response)
+        return store_product(url, product, db, refresh_after_seconds)
+
+def parse_product(url : str, db, driver : ChromeDriver, refresh_after_seconds : Optional[int] = None):
+    (ready_selectors, timeout), *later_stages = PRODUCT_LOAD_STAGES
+    html_src = driver.load_page(url, ready_selectors, timeout=timeout)
+    links_to_parse = parse_product_source(url, html_src, db, refresh_after_seconds)
+    if links_to_parse is not None:
+        return links_to_parse
+    for ready_selectors, timeout in later_stages:
+        metrics.inc(PRODUCT_LOAD_RETRIES_TOTAL)
+        html_src = driver.wait_page(ready_selectors, timeout)
+        if html_src is None:
+            break
+        links_to_parse = parse_product_source(url, html_src, db, refresh_after_seconds)
+        if links_to_parse is not None:
+            return links_to_parse
+    # Only a page that never rendered its widgets is loaded once more
+    metrics.inc(PRODUCT_LOAD_RETRIES_TOTAL)
+    html_src = driver.load_page(url, PRODUCT_READY_SELECTORS, timeout=PRODUCT_LOAD_TIMEOUTS[-1])
+    links_to_parse = parse_product_source(url, html_src, db, refresh_after_seconds)
+    if links_to_parse is not None:
+        return links_to_parse
+    metrics.inc(PRODUCT_LOAD_FAILURES_TOTAL)
+    print(f"Page {url} was not loaded", flush=True)
+    return []
+
+def scrape_product_page(response : Selector) -> dict:
+    product_card, product_sellers = response.css('div.container.c')
     unique_number = product_card.xpath('.//button[@data-widget="webDetailSKU"]').css('div::text').get().split()[1]
     product_on_sale = not len(product_card.xpath('//div[@data-widget="bigPromoPDP"]')) == 0
     product_block, price_block = product_card.xpath('div[@data-widget="webPdpGrid"]/div')
     product_name = product_block.xpath('.//div[@data-widget="webProductHeading"]').css('h1::text').get()
-    product_rating_review = product_block.xpath('.//div[@data-widget="webSingleProductScore"]/a')
-    try:
-        product_rating_review = product_rating_review.css('div::text').get().split(' • ')
-        product_rating = float(product_rating_review[0])
-        product_reviews = int("".join(product_rating_review[1].split()[:-1]))
-    except Exception:
-        product_rating = 0.0
-        product_reviews = 0
+    product_rating, product_reviews = parse_rating_reviews(
+        product_block.xpath('.//div[@data-widget="webSingleProductScore"]/a').css('div::text').get()
+    )
     product_question = product_block.xpath('.//div[@data-widget="webQuestionCount"]/a').css('div::text').get()
     if "Задать" in product_question:
         product_question_count = 0
@@ -151,86 +245,131 @@ def parse_product(url : str, db, driver : ChromeDriver, refresh_after_seconds :
     product_brand = product_block.xpath('.//div[@data-widget="webBrand"]/div/div')
     if product_brand.css('a'):
         product_brand_name = product_brand.css('a::text').get()
-        product_brand_url = product_brand.css('a').attrib['href']
-        product_brand = BrandRepository.get_or_create(db, product_brand_name, product_brand_url)
-        product_brand_id = product_brand.id
-        if (current_time - product_brand.last_update).seconds >= refresh_after_seconds:
-            links_to_parse.append(product_brand_url)
+        product_brand_url = canonicalize_url(product_brand.css('a').attrib['href'])
     else:
-        product_brand_id = None
+        product_brand_name = product_brand_url = None
     try:
         product_price_ozon_card, product_price_other_card = price_block.xpath('.//div[@data-widget="webPrice"]/div')[0].xpath('div')
-        product_price_ozon_card = product_price_ozon_card.css('span::text')[0].get().replace('\u2009', '')[:-1]
-        product_price_other_card = product_price_other_card.css('span::text')[0].get().replace('\u2009', '')[:-1]
+        product_price_ozon_card = clean_price(product_price_ozon_card.css('span::text')[0].get())
+        product_price_other_card = clean_price(product_price_other_card.css('span::text')[0].get())
     except ValueError:
         product_price_ozon_card = price_block.xpath('.//div[@data-widget="webPrice"]/div')[0].xpath('div')
-        product_price_ozon_card = product_price_other_card = product_price_ozon_card.css('span::text')[0].get().replace('\u2009', '')[:-1]
+        product_price_ozon_card = product_price_other_card = clean_price(product_price_ozon_card.css('span::text')[0].get())
     # Scraping product's sellers
     product_seller = product_sellers.xpath('.//div[@data-widget="webCurrentSeller"]/div/div')[0].xpath('div')
     try:
-        product_seller_url = product_seller.css('a').attrib['href']
+        product_seller_url = canonicalize_url(product_seller.css('a').attrib['href'])
     except Exception:
         product_seller_url = None
-    product_seller_name = product_seller.css('a::text').get()
-    seller = SellerRepository.get_or_create(db, product_seller_name, product_seller_url)
-    seller_id = seller.id
-    if product_seller_url and (current_time - seller.last_update).seconds >= refresh_after_seconds:
-        links_to_parse.append(product_seller_url)
-    other_sellers = product_sellers.xpath('.//div[@id="seller-list"]')
-    more_sellers_button = None # other_sellers.xpath('button')
-    if more_sellers_button is not None:
-        html_src = driver.click_button_get_page('//div[@id="seller-list"]/button')
-        response = Selector(html_src)
-        other_sellers = response.xpath('//div[@id="seller-list"]')
-    other_sellers = other_sellers.xpath('div/div')
-    for seller in other_sellers:
+    other_seller_urls = []
+    for seller in product_sellers.xpath('.//div[@id="seller-list"]').xpath('div/div'):
         try:
-            seller_url = seller.xpath('div/div').css('a')[0].attrib['href']
-            stored_seller = SellerRepository.get_by_url(db, seller_url)
-            if not stored_seller or (current_time - stored_seller.last_update).seconds >= refresh_after_seconds:
-                links_to_parse.append(seller_url)
+            other_seller_urls.append(canonicalize_url(seller.xpath('div/div').css('a')[0].attrib['href']))
         except Exception:
             continue
-    product_description = {
+    return {
         'pk' : int(unique_number),
         'name' : product_name,
-        'url' : url,
         'on_sale' : product_on_sale,
         'price' : product_price_other_card,
         'price_ozon_card' : product_price_ozon_card,
         'rating' : product_rating,
         'review_count' : product_reviews,
         'question_count' : product_question_count,
-        'seller_id' : seller_id,
+        'brand_name' : product_brand_name,
+        'brand_url' : product_brand_url,
+        'seller_name' : product_seller.css('a::text').get(),
+        'seller_url' : product_seller_url,
+        'other_seller_urls' : other_seller_urls,
+    }
+
+def store_product(url : str, product : dict, db, refresh_after_seconds : Optional[int] = None) -> List[str]:
+    links_to_parse = []
+    if product['brand_url']:
+        product_brand = BrandRepository.get_or_create(db, product['brand_name'], product['brand_url'])
+        product_brand_id = product_brand.id
+        if revisit_scheduler.brand_is_stale(db, product_brand, refresh_after_seconds):
+            links_to_parse.append(product['brand_url'])
+    else:
+        product_brand_id = None
+    seller = SellerRepository.get_or_create(db, product['seller_name'], product['seller_url'])
+    if product['seller_url'] and revisit_scheduler.seller_is_stale(db, seller, refresh_after_seconds):
+        links_to_parse.append(product['seller_url'])
+    for seller_url in product['other_seller_urls']:
+        stored_seller = SellerRepository.get_by_url(db, seller_url)
+        if revisit_scheduler.seller_is_stale(db, stored_seller, refresh_after_seconds):
+            links_to_parse.append(seller_url)
+    product_description = {
+        'pk' : product['pk'],
+        'name' : product['name'],
+        'url' : url,
+        'on_sale' : product['on_sale'],
+        'price' : product['price'],
+        'price_ozon_card' : product['price_ozon_card'],
+        'rating' : product['rating'],
+        'review_count' : product['review_count'],
+        'question_count' : product['question_count'],
+        'seller_id' : seller.id,
         'brand_id' : product_brand_id
     }
     product_stored = ProductRepository.get_or_create(db, product_description)
-    ProductRepository.add_state(db, product_stored.id, product_description)
+    page_fields_changed = ProductRepository.page_fields_changed(db, product_stored, product_description)
+    ProductRepository.change_seller(db, product_stored, seller.id)
+    ProductRepository.add_state(db, product_stored.id, product_description, force=page_fields_changed)
+    ProductRepository.mark_page_visited(db, product_stored.id)
     return links_to_parse
 
-def identify_and_parse(url : str, driver : ChromeDriver, db):
-    if url.startswith('/'):
-        url = "https://www.ozon.ru" + url
+def identify_target(url : str) -> Optional[Tuple[str, str]]:
+    url = canonicalize_url(url)
+    if url is None:
+        return None
     url_parts = url.split('/')
     if len(url_parts) < 4:
-        return []
+        return None
     site, target_type = url_parts[2:4]
-    if site != "www.ozon.ru":
+    if site != OZON_HOST:
+        return None
+    return url, target_type
+
+@contextlib.contextmanager
+def timed_batch(db):
+    # The outermost batch writes everything on exit, so that is where the database time goes
+    with batch(db):
+        yield
+        commit_started = time.perf_counter()
+    metrics.observe(STAGE_SECONDS, time.perf_counter() - commit_started, stage="db_write")
+
+def record_page(target_type : str, started : float, new_urls : List[str]):
+    metrics.inc(PAGES_TOTAL, target_type=target_type)
+    metrics.observe(PAGE_SECONDS, time.perf_counter() - started, target_type=target_type)
+    metrics.inc(DISCOVERED_URLS_TOTAL, len(new_urls), target_type=target_type)
+
+def record_exception(target_type : str, exception : Exception):
+    metrics.inc(EXCEPTIONS_TOTAL, target_type=target_type, exception=type(exception).__name__)
+
+def identify_and_parse(url : str, driver : ChromeDriver, db, force : bool = False):
+    target = identify_target(url)
+    if target is None:
         return []
+    url, target_type = target
 
+    started = time.perf_counter()
     try:
-        if target_type == "product":
-            new_urls = parse_product(url, db, driver)
-        elif target_type == "brand":
-            new_urls = parse_brand(url, db, driver)
-        elif target_type == "category" or target_type == "search":
-            new_urls = parse_category(url, db, driver)
-        elif target_type == "seller":
-            new_urls = parse_seller(url, db, driver)
-        else:
-            new_urls = []
+        with timed_batch(db):
+            if target_type == "product":
+                new_urls = parse_product(url, db, driver)
+            elif target_type == "brand":
+                new_urls = parse_brand(url, db, driver, force=force)
+            elif target_type == "category" or target_type == "search":
+                new_urls = parse_category(url, db, driver)
+            elif target_type == "seller":
+                new_urls = parse_seller(url, db, driver, force=force)
+            else:
+                new_urls = []
+        record_page(target_type, started, new_urls)
         print(f"Found {len(new_urls)} urls", flush=True)
         return new_urls
     except Exception as e:
+        record_exception(target_type, e)
         print(f"Exception occurred in {url}: {e}", flush=True)
         return []
@@ -0,0 +1,166 @@
+import datetime
+import heapq
+import os
+import time
+from threading import Lock
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from index_db.models import Product
+from index_db.operations import BrandRepository, SellerRepository, ProductRepository, product_state_index
+from ozon_scraper.urls import canonicalize_url, canonical_key
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+class RevisitScheduler:
+    def __init__(self, default_interval : float = 60*60, min_interval : float = 15*60,
+                 max_interval : float = 7*24*60*60, changes_per_visit : float = 1.0,
+                 product_page_interval : float = 24*60*60):
+        self.default_interval = default_interval
+        self.product_page_interval = product_page_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.changes_per_visit = changes_per_visit
+        self.queue = []
+        self.due_at = {}
+        self.intervals = {}
+        self.lock = Lock()
+
+    def estimate_interval(self, changes : int, first_seen : Optional[datetime.datetime]) -> float:
+        # Changes are treated as a Poisson process. One change per default interval is used as a prior,
+        # so new entities are visited at the default pace and the estimate sharpens as history grows.
+        observed_seconds = (utc_now() - first_seen).total_seconds() if first_seen else 0.0
+        change_rate = (changes + 1) / (max(observed_seconds, 0.0) + self.default_interval)
+        interval = self.changes_per_visit / change_rate
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def cached_interval(self, db, entity_type : str, entity_id : int) -> float:
+        # Estimates move slowly, so they are reused for a while instead of aggregating the history on every check
+        now = time.time()
+        cached = self.intervals.get((entity_type, entity_id))
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        interval = self.estimate_interval(*ProductRepository.get_change_stats(db, **{f"{entity_type}_id": entity_id}))
+        self.intervals[(entity_type, entity_id)] = (now + self.min_interval, interval)
+        return interval
+
+    def product_interval(self, db, product_id : int) -> float:
+        return self.cached_interval(db, "product", product_id)
+
+    def seller_interval(self, db, seller_id : int) -> float:
+        return self.cached_interval(db, "seller", seller_id)
+
+    def brand_interval(self, db, brand_id : int) -> float:
+        return self.cached_interval(db, "brand", brand_id)
+
+    def is_stale(self, last_update : Optional[datetime.datetime], interval : float) -> bool:
+        return last_update is None or (utc_now() - last_update).total_seconds() >= interval
+
+    def seller_is_stale(self, db, seller, refresh_after_seconds : Optional[float] = None) -> bool:
+        if seller is None:
+            return True
+        interval = refresh_after_seconds or self.seller_interval(db, seller.id)
+        return self.is_stale(seller.last_update, interval)
+
+    def product_page_is_stale(self, db, product_id : int, refresh_after_seconds : Optional[float] = None) -> bool:
+        interval = refresh_after_seconds or self.product_page_interval
+        if not self.is_stale(product_state_index.get_visited_at(db, product_id), interval):
+            return False
+        # Another process may have visited the page since the index was warmed
+        visited_at = ProductRepository.get_page_visited_at(db, product_id)
+        if visited_at is not None:
+            product_state_index.update(visits={product_id: visited_at})
+        return self.is_stale(visited_at, interval)
+
+    def brand_is_stale(self, db, brand, refresh_after_seconds : Optional[float] = None) -> bool:
+        if brand is None:
+            return True
+        interval = refresh_after_seconds or self.brand_interval(db, brand.id)
+        return self.is_stale(brand.last_update, interval)
+
+    def push(self, url : str, due : float):
+        with self.lock:
+            # A url is kept once, with its latest due time, stale heap entries are skipped on pop
+            self.due_at[url] = due
+            heapq.heappush(self.queue, (due, url))
+
+    def schedule(self, db, url : str):
+        url = canonicalize_url(url)
+        if url is None:
+            return
+        key = canonical_key(url)
+        target_type = urlsplit(url).path.split('/')[1]
+        interval = self.default_interval
+        if target_type == "product" and key and key.startswith("product:"):
+            product = ProductRepository.get_by_pk(db, int(key.split(":")[1]))
+            if product is not None:
+                interval = self.product_interval(db, product.id)
+        elif target_type == "seller":
+            seller = SellerRepository.get_by_url(db, url)
+            if seller is not None:
+                interval = self.seller_interval(db, seller.id)
+        elif target_type == "brand":
+            brand = BrandRepository.get_by_url(db, url)
+            if brand is not None:
+                interval = self.brand_interval(db, brand.id)
+        self.push(url, time.time() + interval)
+
+    def warm(self, db):
+        # Rebuilds the schedule after a restart from the history, using one grouped query per entity type
+        now = time.time()
+        current_time = utc_now()
+        scheduled = 0
+        for column, entities in (
+            (Product.seller_id, {seller.id: seller for seller in SellerRepository.get_all(db)}),
+            (Product.brand_id, {brand.id: brand for brand in BrandRepository.get_all(db)}),
+        ):
+            for entity_id, changes, first_seen, last_seen in ProductRepository.get_all_change_stats(db, column):
+                entity = entities.get(entity_id)
+                if entity is None or not entity.url:
+                    continue
+                last_visit = entity.last_update or last_seen
+                elapsed = (current_time - last_visit).total_seconds()
+                self.push(entity.url, now + self.estimate_interval(changes, first_seen) - elapsed)
+                scheduled += 1
+        products = dict(db.query(Product.id, Product.url))
+        for product_id, changes, first_seen, last_seen in ProductRepository.get_all_change_stats(db, Product.id):
+            if products.get(product_id):
+                elapsed = (current_time - last_seen).total_seconds()
+                self.push(products[product_id], now + self.estimate_interval(changes, first_seen) - elapsed)
+                scheduled += 1
+        print(f"Revisit scheduler was warmed with {scheduled} urls", flush=True)
+
+    def seconds_until_next(self) -> Optional[float]:
+        with self.lock:
+            while self.queue and self.due_at.get(self.queue[0][1]) != self.queue[0][0]:
+                heapq.heappop(self.queue)
+            if not self.queue:
+                return None
+            return max(self.queue[0][0] - time.time(), 0.0)
+
+    def pop_due(self) -> List[str]:
+        now = time.time()
+        due_urls = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                due, url = heapq.heappop(self.queue)
+                if self.due_at.get(url) == due:
+                    del self.due_at[url]
+                    due_urls.append(url)
+        return due_urls
+
+    def wait_next(self) -> List[str]:
+        delay = self.seconds_until_next()
+        if delay is None:
+            return []
+        time.sleep(delay)
+        return self.pop_due()
+
+revisit_scheduler = RevisitScheduler(
+    float(os.getenv('REVISIT_DEFAULT_SECONDS', 60*60)),
+    float(os.getenv('REVISIT_MIN_SECONDS', 15*60)),
+    float(os.getenv('REVISIT_MAX_SECONDS', 7*24*60*60)),
+    product_page_interval=float(os.getenv('PRODUCT_PAGE_REFRESH_SECONDS', 24*60*60))
+)
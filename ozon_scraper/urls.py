@@ -0,0 +1,44 @@
+import re
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+OZON_HOST = "www.ozon.ru"
+KEPT_QUERY_PARAMS = {'text', 'page', 'sorting'}
+PRODUCT_PATH_PATTERN = re.compile(r"^/product/(?:(?P<slug>[^/]*)-)?(?P<pk>\d+)/?")
+
+def canonicalize_url(url : str) -> Optional[str]:
+    url = url.strip()
+    if not url:
+        return None
+    if url.startswith('//'):
+        url = "https:" + url
+    elif url.startswith('/'):
+        url = f"https://{OZON_HOST}" + url
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host == "ozon.ru":
+        host = OZON_HOST
+    if not parts.path:
+        return f"https://{host}/"
+
+    product_match = PRODUCT_PATH_PATTERN.match(parts.path)
+    if host == OZON_HOST and product_match:
+        slug = product_match.group('slug')
+        pk = product_match.group('pk')
+        path = f"/product/{slug}-{pk}/" if slug else f"/product/{pk}/"
+        return urlunsplit(("https", host, path, "", ""))
+
+    path = re.sub(r"/{2,}", "/", parts.path)
+    if not path.endswith('/'):
+        path += '/'
+    query = sorted((k, v) for k, v in parse_qsl(parts.query) if k in KEPT_QUERY_PARAMS)
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+def canonical_key(url : str) -> Optional[str]:
+    canonical_url = canonicalize_url(url)
+    if canonical_url is None:
+        return None
+    product_match = PRODUCT_PATH_PATTERN.match(urlsplit(canonical_url).path)
+    if product_match:
+        return f"product:{product_match.group('pk')}"
+    return canonical_url
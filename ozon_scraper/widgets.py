@@ -0,0 +1,215 @@
+import html
+import json
+import re
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from .urls import canonicalize_url, canonical_key
+
+WIDGET_STATE_PATTERN = re.compile(
+    r'''id="state-([A-Za-z0-9]+)-[^"]*"[^>]*?\sdata-state=(?:'([^']*)'|"([^"]*)")'''
+)
+RATING_PATTERN = re.compile(r'\d(?:[.,]\d{1,2})?')
+REVIEWS_PATTERN = re.compile(r'([\d\s \xa0]+)отзыв')
+
+PRODUCT_WIDGETS = (
+    'webProductHeading', 'webPrice', 'webSingleProductScore', 'webQuestionCount', 'webBrand',
+    'webCurrentSeller', 'webSellerList', 'webDetailSKU', 'bigPromoPDP'
+)
+LISTING_WIDGETS = ('tileGrid', 'searchResults')
+LISTING_TITLE_WIDGETS = ('sellerTransparency',)
+
+
+def extract_widget_states(source : str, names : Optional[Sequence[str]] = None) -> Dict[str, List[dict]]:
+    # Pages carry every widget state as JSON in data-state attributes, API responses carry them in widgetStates.
+    # Only widgets with the requested name prefixes are decoded.
+    names = tuple(names) if names else None
+    raw_states = []
+    if is_page_json(source):
+        try:
+            widget_states = json.loads(source).get('widgetStates') or {}
+        except ValueError:
+            widget_states = {}
+        raw_states = [(key.split('-')[0], value) for key, value in widget_states.items()]
+    else:
+        for match in WIDGET_STATE_PATTERN.finditer(source):
+            raw_states.append((match.group(1), html.unescape(match.group(2) or match.group(3) or '')))
+    states = {}
+    for name, value in raw_states:
+        if names and not name.startswith(names):
+            continue
+        try:
+            state = json.loads(value) if isinstance(value, str) else value
+        except ValueError:
+            continue
+        if isinstance(state, dict):
+            states.setdefault(name, []).append(state)
+    return states
+
+def is_page_json(source : str) -> bool:
+    return source.lstrip().startswith('{')
+
+def first_state(states : Dict[str, List[dict]], name : str) -> Optional[dict]:
+    return states[name][0] if states.get(name) else None
+
+def find_value(node, *keys : str):
+    if isinstance(node, dict):
+        for key in keys:
+            if node.get(key) not in (None, '', [], {}):
+                return node[key]
+        node = list(node.values())
+    if isinstance(node, list):
+        for child in node:
+            if isinstance(child, (dict, list)):
+                value = find_value(child, *keys)
+                if value is not None:
+                    return value
+    return None
+
+def iter_texts(node) -> Iterator[str]:
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ('text', 'title') and isinstance(value, str):
+                yield value
+            elif isinstance(value, (dict, list)):
+                yield from iter_texts(value)
+    elif isinstance(node, list):
+        for child in node:
+            yield from iter_texts(child)
+
+def iter_links(node, marker : str) -> Iterator[str]:
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ('link', 'url', 'href') and isinstance(value, str) and marker in value:
+                yield value
+            elif isinstance(value, (dict, list)):
+                yield from iter_links(value, marker)
+    elif isinstance(node, list):
+        for child in node:
+            yield from iter_links(child, marker)
+
+def to_digits(text) -> Optional[int]:
+    if isinstance(text, int):
+        return text
+    digits = "".join(symbol for symbol in str(text or '') if symbol.isdigit())
+    return int(digits) if digits else None
+
+def clean_price(text : str) -> str:
+    return "".join(symbol for symbol in text if symbol.isdigit() or symbol in '.,')
+
+def parse_rating_reviews(text : Optional[str]):
+    try:
+        rating, reviews = text.split(' • ')[:2]
+        return float(rating), int("".join(reviews.split()[:-1]))
+    except Exception:
+        return 0.0, 0
+
+def product_pk_from_url(url : Optional[str]) -> Optional[int]:
+    key = canonical_key(url) if url else None
+    if key and key.startswith('product:'):
+        return int(key.split(':')[1])
+    return None
+
+def extract_product(source : str, url : Optional[str] = None) -> Optional[dict]:
+    states = extract_widget_states(source, PRODUCT_WIDGETS)
+    heading = first_state(states, 'webProductHeading')
+    price = first_state(states, 'webPrice')
+    current_seller = first_state(states, 'webCurrentSeller')
+    if heading is None or price is None or current_seller is None:
+        return None
+    name = find_value(heading, 'title', 'name')
+    seller_name = find_value(current_seller, 'name', 'title')
+    price_ozon_card = price.get('cardPrice') or price.get('price')
+    price_other_card = price.get('price') or price.get('cardPrice')
+    sku = first_state(states, 'webDetailSKU')
+    pk = to_digits(find_value(sku, 'sku')) if sku else None
+    pk = pk or product_pk_from_url(url)
+    if not name or not seller_name or not isinstance(price_ozon_card, str) or pk is None:
+        return None
+
+    score = first_state(states, 'webSingleProductScore')
+    rating, review_count = parse_rating_reviews(find_value(score, 'text') if score else None)
+    question = first_state(states, 'webQuestionCount')
+    question_text = find_value(question, 'text', 'title') if question else None
+    question_count = 0 if not question_text or "Задать" in question_text else to_digits(question_text) or 0
+
+    brand = first_state(states, 'webBrand')
+    brand_link = find_value(brand, 'link', 'url') if brand else None
+    seller_link = find_value(current_seller, 'link', 'url')
+    seller_url = canonicalize_url(seller_link) if isinstance(seller_link, str) else None
+    other_seller_urls = []
+    for seller_list in states.get('webSellerList', []):
+        for link in iter_links(seller_list, '/seller/'):
+            other_url = canonicalize_url(link)
+            if other_url and other_url != seller_url and other_url not in other_seller_urls:
+                other_seller_urls.append(other_url)
+    return {
+        'pk' : pk,
+        'name' : name,
+        'on_sale' : 'bigPromoPDP' in states,
+        'price' : clean_price(price_other_card),
+        'price_ozon_card' : clean_price(price_ozon_card),
+        'rating' : rating,
+        'review_count' : review_count,
+        'question_count' : question_count,
+        'brand_name' : find_value(brand, 'name', 'text', 'title') if brand_link else None,
+        'brand_url' : canonicalize_url(brand_link) if isinstance(brand_link, str) else None,
+        'seller_name' : seller_name,
+        'seller_url' : seller_url,
+        'other_seller_urls' : other_seller_urls,
+    }
+
+def extract_tile_card(item : dict) -> Optional[dict]:
+    link = find_value(item.get('action') or {}, 'link') or find_value(item, 'link')
+    url = canonicalize_url(link) if isinstance(link, str) else None
+    pk = product_pk_from_url(url)
+    if pk is None:
+        return None
+    name = None
+    brand_name = None
+    rating = 0.0
+    review_count = 0
+    price = None
+    on_sale = False
+    for node in item.get('mainState') or []:
+        node_id = node.get('id') if isinstance(node, dict) else None
+        texts = list(iter_texts(node))
+        if node_id == 'name' and texts:
+            name = texts[0]
+        elif node_id == 'brand' and texts:
+            brand_name = texts[0]
+        for text in texts:
+            if price is None and '₽' in text:
+                price = clean_price(text)
+            elif RATING_PATTERN.fullmatch(text.strip()) and not rating:
+                rating = float(text.strip().replace(',', '.'))
+            elif REVIEWS_PATTERN.match(text) and not review_count:
+                review_count = to_digits(REVIEWS_PATTERN.match(text).group(1)) or 0
+            on_sale = on_sale or 'Распродажа' in text
+    if not name or not price:
+        return None
+    return {
+        'pk' : pk,
+        'name' : name,
+        'url' : url,
+        'on_sale' : on_sale,
+        'price_ozon_card' : price,
+        'rating' : rating,
+        'review_count' : review_count,
+        'brand_name' : brand_name,
+    }
+
+def extract_tile_cards(source : str) -> List[dict]:
+    cards = []
+    for name, states in extract_widget_states(source, LISTING_WIDGETS).items():
+        for state in states:
+            for item in state.get('items') or []:
+                card = extract_tile_card(item) if isinstance(item, dict) else None
+                if card is not None:
+                    cards.append(card)
+    return cards
+
+def extract_listing_title(source : str) -> Optional[str]:
+    # Seller and brand pages name their owner in the transparency widget
+    title = first_state(extract_widget_states(source, LISTING_TITLE_WIDGETS), 'sellerTransparency')
+    name = find_value(title, 'title', 'name', 'text') if title else None
+    return name.strip() if isinstance(name, str) and name.strip() else None
@@ -0,0 +1,162 @@
+import datetime
+import io
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from index_db.operations import BrandRepository, SellerRepository, ProductRepository, normalize_text
+from telegram_bot.cache import report_cache
+from telegram_bot.utils import write_report
+
+CHANGE_PERIODS_DAYS = (7, 30)
+ANALYTICS_REPORT_COLUMNS = [
+    ("Имя товара", 'str'), ("Артикул", 'int'), ("Ссылка", 'str'), ("Продавец", 'str'),
+    ("Цена по Ozon карте", 'float'), ("Цена", 'float'),
+    ("Мин. цена по Ozon карте", 'float'), ("Макс. цена по Ozon карте", 'float'), ("Медиана цены по Ozon карте", 'float'),
+    ("Изменение за 7 дней, %", 'float'), ("Изменение за 30 дней, %", 'float'),
+    ("Выгода по Ozon карте, %", 'float'), ("Время на распродаже, %", 'float'),
+    ("Место по цене среди продавцов", 'int'), ("Продавцов с товаром", 'int')
+]
+
+
+def load_history(rows : List[tuple]) -> Dict[str, np.ndarray]:
+    count = len(rows)
+    columns = list(zip(*rows)) if rows else [(), (), (), (), ()]
+    return {
+        'product_ids' : np.fromiter(columns[0], dtype=np.int64, count=count),
+        'prices' : np.array(columns[1], dtype=np.float64),
+        'card_prices' : np.array(columns[2], dtype=np.float64),
+        'on_sale' : np.array([bool(value) for value in columns[3]], dtype=np.float64),
+        # Timestamps are stored in UTC without a zone
+        'times' : np.array(columns[4], dtype='datetime64[us]').astype(np.int64) / 1e6,
+    }
+
+def compute_price_analytics(history : Dict[str, np.ndarray], now : float) -> Dict[str, np.ndarray]:
+    # States are written only on change, so every state holds until the next one of the same product
+    order = np.lexsort((history['times'], history['product_ids']))
+    product_ids = history['product_ids'][order]
+    card_prices = history['card_prices'][order]
+    prices = history['prices'][order]
+    on_sale = history['on_sale'][order]
+    times = history['times'][order]
+    products, starts, counts = np.unique(product_ids, return_index=True, return_counts=True)
+    ends = starts + counts - 1
+    analytics = {
+        'product_ids' : products,
+        'card_price' : card_prices[ends],
+        'price' : prices[ends],
+        'min_card_price' : np.fmin.reduceat(card_prices, starts) if len(starts) else card_prices[:0],
+        'max_card_price' : np.fmax.reduceat(card_prices, starts) if len(starts) else card_prices[:0],
+    }
+
+    groups = np.repeat(np.arange(len(products)), counts)
+    sorted_card_prices = card_prices[np.lexsort((card_prices, groups))]
+    analytics['median_card_price'] = (sorted_card_prices[starts + (counts - 1) // 2] + sorted_card_prices[starts + counts // 2]) / 2
+
+    # One sorted key over (product, time) lets a single searchsorted find the state in force at a moment for all products
+    first_time = times.min() if len(times) else 0.0
+    span = (times.max() - first_time if len(times) else 0.0) + 1.0
+    keys = groups * span + (times - first_time)
+    for days in CHANGE_PERIODS_DAYS:
+        targets = np.arange(len(products)) * span + (now - days * 86400 - first_time)
+        # A target past a product's last state would land in the next product, its last state is the one in force
+        positions = np.minimum(np.searchsorted(keys, targets, side='right') - 1, ends)
+        known = positions >= starts
+        past_prices = np.where(known, card_prices[np.clip(positions, 0, None)], np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            analytics[f'change_{days}d'] = (analytics['card_price'] - past_prices) / past_prices * 100
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        analytics['card_benefit'] = (analytics['price'] - analytics['card_price']) / analytics['price'] * 100
+        durations = np.diff(times, append=now)
+        durations[ends] = now - times[ends]
+        durations = np.clip(durations, 0, None)
+        if len(starts):
+            total = np.add.reduceat(durations, starts)
+            on_sale_time = np.add.reduceat(durations * on_sale, starts)
+            analytics['sale_share'] = np.where(total > 0, on_sale_time / total, on_sale[ends]) * 100
+        else:
+            analytics['sale_share'] = durations[:0]
+    return analytics
+
+def rank_by_price(names : List[str], card_prices : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Products with the same normalized name are the same product offered by different sellers
+    _, name_groups = np.unique(np.array([normalize_text(name) for name in names], dtype=object), return_inverse=True)
+    name_groups = name_groups.reshape(-1)
+    order = np.lexsort((np.nan_to_num(card_prices, nan=np.inf), name_groups))
+    sorted_groups = name_groups[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(order) else order
+    group_sizes = np.diff(np.r_[group_starts, len(order)])
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(group_starts, group_sizes) + 1
+    sizes = np.empty(len(order), dtype=np.int64)
+    sizes[order] = np.repeat(group_sizes, group_sizes)
+    return ranks, sizes
+
+def analytics_rows(db, history_rows : List[tuple]):
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    analytics = compute_price_analytics(load_history(history_rows), now)
+    product_ids = analytics['product_ids'].tolist()
+    products_info = {row[0]: row for row in ProductRepository.get_products_info(db, product_ids)}
+    names = sorted({products_info[product_id][2] for product_id in product_ids if product_id in products_info})
+    competitors = ProductRepository.get_current_prices_by_names(db, names) if names else []
+    ranks, sizes = rank_by_price(
+        [name for _, name, _ in competitors], np.array([price for _, _, price in competitors], dtype=np.float64)
+    )
+    competitor_ranks = {row[0]: (int(rank), int(size)) for row, rank, size in zip(competitors, ranks, sizes)}
+
+    def value(array, index):
+        number = float(array[index])
+        return None if np.isnan(number) else round(number, 2)
+
+    for index, product_id in enumerate(product_ids):
+        info = products_info.get(product_id)
+        if info is None:
+            continue
+        _, pk, name, url, seller_name = info
+        rank, size = competitor_ranks.get(product_id, (None, None))
+        yield [
+            name, pk, url, seller_name, value(analytics['card_price'], index), value(analytics['price'], index),
+            value(analytics['min_card_price'], index), value(analytics['max_card_price'], index),
+            value(analytics['median_card_price'], index), value(analytics['change_7d'], index),
+            value(analytics['change_30d'], index), value(analytics['card_benefit'], index),
+            value(analytics['sale_share'], index), rank, size
+        ]
+
+def build_analytics_report(title : str, db, history_rows : List[tuple], report_format : str) -> Tuple[io.BytesIO, int]:
+    return write_report(title, ANALYTICS_REPORT_COLUMNS, analytics_rows(db, history_rows), report_format)
+
+def make_seller_analytics(seller_name : str, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
+    seller = SellerRepository.get_by_name(db, seller_name)
+    if seller is None:
+        raise KeyError(f"Seller {seller_name} does not exist!")
+    # Period changes move with the calendar, so the cached report is only reused within a day
+    version = (ProductRepository.get_last_history_id(db, seller_id=seller.id), datetime.date.today())
+    report_file = report_cache.get_or_build(
+        ('seller_analytics', seller.id, report_format), version,
+        lambda: build_analytics_report(
+            f"Аналитика {seller_name}", db, ProductRepository.get_history_columns(db, seller_id=seller.id), report_format
+        )[0]
+    )
+    return report_file, f"{seller_name}_analytics.{report_format}"
+
+def make_brand_analytics(brand_name : str, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
+    brand = BrandRepository.get_by_name(db, brand_name)
+    if brand is None:
+        raise KeyError(f"Brand {brand_name} does not exist!")
+    version = (ProductRepository.get_last_history_id(db, brand_id=brand.id), datetime.date.today())
+    report_file = report_cache.get_or_build(
+        ('brand_analytics', brand.id, report_format), version,
+        lambda: build_analytics_report(
+            f"Аналитика {brand_name}", db, ProductRepository.get_history_columns(db, brand_id=brand.id), report_format
+        )[0]
+    )
+    return report_file, f"{brand_name}_analytics.{report_format}"
+
+def make_keyword_analytics(product_keyword : str, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
+    product_ids = ProductRepository.get_keyword_product_ids(db, product_keyword)
+    if not product_ids:
+        raise KeyError(f"Product containing {product_keyword} does not exist!")
+    history_rows = ProductRepository.get_history_columns(db, product_ids=product_ids)
+    report_file, _ = build_analytics_report(f"Аналитика {product_keyword}", db, history_rows, report_format)
+    return report_file, f"{product_keyword}_analytics.{report_format}"
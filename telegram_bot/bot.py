@@ -6,10 +6,12 @@ from telebot.storage import StateMemoryStorage
 from dotenv import load_dotenv
 
 from index_db.db import get_db
+from telegram_bot.analytics import make_seller_analytics, make_brand_analytics, make_keyword_analytics
+from telegram_bot.jobs import report_jobs
 from telegram_bot.utils import (
     get_sellers_names, get_brands_names, get_product_count,
     make_seller_report, make_brand_report, make_product_report,
-    make_products_report_by_keyword
+    make_products_report_by_keyword, REPORT_FORMATS
 )
 
 load_dotenv()
@@ -21,6 +23,46 @@ state_storage = StateMemoryStorage()
 bot = telebot.TeleBot(TELEGRAM_API_KEY, state_storage=state_storage)
 
 user_states = {}
+user_formats = {}
+
+def get_report_format(message) -> str:
+    return user_formats.get(message.from_user.id, REPORT_FORMATS[0])
+
+def submit_report(message, report_type : str, make_report, argument, description : str, not_found_text : str):
+    report_format = get_report_format(message)
+
+    def build():
+        db = next(get_db(DATABASE_URL))
+        try:
+            return make_report(argument, db, report_format)
+        finally:
+            db.close()
+
+    def on_start(chat_id, job):
+        bot.send_message(chat_id, f"Составляю {job.description}")
+
+    def on_done(chat_id, report_file, file_name):
+        bot.send_document(chat_id, report_file, visible_file_name=file_name)
+
+    def on_error(chat_id, error):
+        if isinstance(error, KeyError):
+            bot.send_message(chat_id, not_found_text)
+        else:
+            print(f"Report {description} failed: {error}", flush=True)
+            bot.send_message(chat_id, f"Не удалось составить {description}")
+
+    status, position = report_jobs.submit(
+        message.from_user.id, message.chat.id, (report_type, argument, report_format), description,
+        build, on_start, on_done, on_error
+    )
+    if status == "queued":
+        bot.send_message(message.chat.id, f"{description.capitalize()} поставлен в очередь, позиция: {position}")
+    elif status == "joined":
+        bot.send_message(message.chat.id, f"{description.capitalize()} уже составляется, пришлю его, как только он будет готов")
+    elif status == "duplicate":
+        bot.send_message(message.chat.id, f"Вы уже запросили {description}")
+    else:
+        bot.send_message(message.chat.id, "Слишком много отчётов в работе, дождитесь готовых и повторите запрос")
 
 @bot.message_handler(commands=['start'])
 def start_dialog(message):
@@ -32,7 +74,12 @@ def start_dialog(message):
         types.KeyboardButton('/brand_report'),
         types.KeyboardButton('/product_report'),
         types.KeyboardButton('/product_keyword_report'),
-        types.KeyboardButton('/product_count')
+        types.KeyboardButton('/seller_analytics'),
+        types.KeyboardButton('/brand_analytics'),
+        types.KeyboardButton('/keyword_analytics'),
+        types.KeyboardButton('/product_count'),
+        types.KeyboardButton('/report_format'),
+        types.KeyboardButton('/reports_status')
     ]
     for button in buttons:
         markup.add(button)
@@ -66,16 +113,12 @@ def ask_for_seller(message):
 
 def process_seller(message):
     seller_name = message.text
-    bot.send_message(message.chat.id, f"Составляю отчёт по продавцу: {seller_name}")
-
-    db = next(get_db(DATABASE_URL))
     try:
-        report_file, file_name = make_seller_report(seller_name, db)
-        bot.send_document(message.chat.id, report_file, visible_file_name=file_name)
-    except KeyError:
-        bot.send_message(message.chat.id, f"Продавец {seller_name} не найден")
+        submit_report(
+            message, 'seller', make_seller_report, seller_name,
+            f"отчёт по продавцу {seller_name}", f"Продавец {seller_name} не найден"
+        )
     finally:
-        db.close()
         del user_states[message.from_user.id]
 
 @bot.message_handler(commands=['brand_report'])
@@ -86,16 +129,12 @@ def ask_for_brand(message):
 
 def process_brand(message):
     brand_name = message.text
-    bot.send_message(message.chat.id, f"Составляю отчёт по бренду: {brand_name}")
-
-    db = next(get_db(DATABASE_URL))
     try:
-        report_file, file_name = make_brand_report(brand_name, db)
-        bot.send_document(message.chat.id, report_file, visible_file_name=file_name)
-    except KeyError:
-        bot.send_message(message.chat.id, f"Бренд {brand_name} не найден")
+        submit_report(
+            message, 'brand', make_brand_report, brand_name,
+            f"отчёт по бренду {brand_name}", f"Бренд {brand_name} не найден"
+        )
     finally:
-        db.close()
         del user_states[message.from_user.id]
 
 @bot.message_handler(commands=['product_report'])
@@ -110,16 +149,12 @@ def process_product(message):
     except ValueError:
         bot.send_message(message.chat.id, "Артикул товара должен быть целым числом!")
         return
-    bot.send_message(message.chat.id, f"Составляю отчёт по товару: {product_pk}")
-
-    db = next(get_db(DATABASE_URL))
     try:
-        report_file, file_name = make_product_report(product_pk, db)
-        bot.send_document(message.chat.id, report_file, visible_file_name=file_name)
-    except KeyError:
-        bot.send_message(message.chat.id, f"Товар {product_pk} не найден")
+        submit_report(
+            message, 'product', make_product_report, product_pk,
+            f"отчёт по товару {product_pk}", f"Товар {product_pk} не найден"
+        )
     finally:
-        db.close()
         del user_states[message.from_user.id]
 
 @bot.message_handler(commands=['product_keyword_report'])
@@ -130,16 +165,90 @@ def ask_for_keyword(message):
 
 def process_product_keyword(message):
     product_keyword = message.text
-    bot.send_message(message.chat.id, f"Составляю отчёт по товару: {product_keyword}")
+    try:
+        submit_report(
+            message, 'keyword', make_products_report_by_keyword, product_keyword,
+            f"отчёт по товарам {product_keyword}", f"Товар с ключевым словом {product_keyword} не найден"
+        )
+    finally:
+        del user_states[message.from_user.id]
 
-    db = next(get_db(DATABASE_URL))
+@bot.message_handler(commands=['seller_analytics'])
+def ask_for_seller_analytics(message):
+    bot.send_message(message.chat.id, "Введите имя продавца, учитывая регистр")
+    user_states[message.from_user.id] = "waiting_for_seller_analytics"
+    bot.register_next_step_handler(message, process_seller_analytics)
+
+def process_seller_analytics(message):
+    seller_name = message.text
     try:
-        report_file, file_name = make_products_report_by_keyword(product_keyword, db)
-        bot.send_document(message.chat.id, report_file, visible_file_name=file_name)
-    except KeyError:
-        bot.send_message(message.chat.id, f"Товар с ключевым словом {product_keyword} не найден")
+        submit_report(
+            message, 'seller_analytics', make_seller_analytics, seller_name,
+            f"аналитику цен продавца {seller_name}", f"Продавец {seller_name} не найден"
+        )
+    finally:
+        del user_states[message.from_user.id]
+
+@bot.message_handler(commands=['brand_analytics'])
+def ask_for_brand_analytics(message):
+    bot.send_message(message.chat.id, "Введите название брэнда, учитывая регистр")
+    user_states[message.from_user.id] = "waiting_for_brand_analytics"
+    bot.register_next_step_handler(message, process_brand_analytics)
+
+def process_brand_analytics(message):
+    brand_name = message.text
+    try:
+        submit_report(
+            message, 'brand_analytics', make_brand_analytics, brand_name,
+            f"аналитику цен бренда {brand_name}", f"Бренд {brand_name} не найден"
+        )
+    finally:
+        del user_states[message.from_user.id]
+
+@bot.message_handler(commands=['keyword_analytics'])
+def ask_for_keyword_analytics(message):
+    bot.send_message(message.chat.id, "Введите ключевое слово для поиска интересующих вас товаров")
+    user_states[message.from_user.id] = "waiting_for_keyword_analytics"
+    bot.register_next_step_handler(message, process_keyword_analytics)
+
+def process_keyword_analytics(message):
+    product_keyword = message.text
+    try:
+        submit_report(
+            message, 'keyword_analytics', make_keyword_analytics, product_keyword,
+            f"аналитику цен товаров {product_keyword}", f"Товар с ключевым словом {product_keyword} не найден"
+        )
+    finally:
+        del user_states[message.from_user.id]
+
+@bot.message_handler(commands=['reports_status'])
+def get_reports_status(message):
+    jobs = report_jobs.get_user_jobs(message.from_user.id)
+    if not jobs:
+        bot.send_message(message.chat.id, "У вас нет отчётов в работе")
+        return
+    statuses = {"queued": "в очереди", "running": "составляется"}
+    reply = "\n".join(f"{job.description.capitalize()}: {statuses[job.status]}" for job in jobs)
+    bot.send_message(message.chat.id, reply)
+
+@bot.message_handler(commands=['report_format'])
+def ask_for_report_format(message):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    for report_format in REPORT_FORMATS:
+        markup.add(types.KeyboardButton(report_format))
+    bot.send_message(message.chat.id, f"Текущий формат отчётов: {get_report_format(message)}. Выберите новый формат", reply_markup=markup)
+    user_states[message.from_user.id] = "waiting_report_format"
+    bot.register_next_step_handler(message, process_report_format)
+
+def process_report_format(message):
+    report_format = message.text.strip().lower()
+    try:
+        if report_format not in REPORT_FORMATS:
+            bot.send_message(message.chat.id, f"Формат {report_format} не поддерживается, доступны: {', '.join(REPORT_FORMATS)}")
+            return
+        user_formats[message.from_user.id] = report_format
+        bot.send_message(message.chat.id, f"Отчёты будут приходить в формате {report_format}")
     finally:
-        db.close()
         del user_states[message.from_user.id]
 
 @bot.message_handler(commands=['product_count'])
@@ -0,0 +1,48 @@
+import io
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Hashable, Optional
+
+class ReportCache:
+    def __init__(self, max_bytes : int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key : Hashable, version : Hashable) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key : Hashable, version : Hashable, content : bytes):
+        if len(content) > self.max_bytes:
+            return
+        with self.lock:
+            # Only the latest version of a report is kept, older ones can never be served again
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.entries[key] = (version, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_build(self, key : Hashable, version : Hashable, build : Callable[[], io.BytesIO]) -> io.BytesIO:
+        content = self.get(key, version)
+        if content is None:
+            content = build().getvalue()
+            self.put(key, version, content)
+        return io.BytesIO(content)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+report_cache = ReportCache(int(os.getenv('REPORT_CACHE_BYTES', 64 * 1024 * 1024)))
@@ -0,0 +1,85 @@
+import io
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Hashable, List, Tuple
+
+class ReportJob:
+    def __init__(self, key : Hashable, description : str):
+        self.key = key
+        self.description = description
+        self.status = "queued"
+        self.subscribers = []
+
+class ReportJobQueue:
+    def __init__(self, workers : int = 2, per_user_limit : int = 2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report")
+        self.per_user_limit = per_user_limit
+        self.lock = Lock()
+        self.jobs = {}
+        self.user_jobs = defaultdict(int)
+
+    def submit(self, user_id : int, chat_id : int, key : Hashable, description : str,
+               build : Callable[[], Tuple[io.BytesIO, str]],
+               on_start : Callable[[int, ReportJob], None],
+               on_done : Callable[[int, io.BytesIO, str], None],
+               on_error : Callable[[int, Exception], None]) -> Tuple[str, int]:
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None and (user_id, chat_id) in job.subscribers:
+                return "duplicate", 0
+            if self.user_jobs[user_id] >= self.per_user_limit:
+                return "limited", 0
+            self.user_jobs[user_id] += 1
+            if job is not None:
+                # The same report is being built already, its result is sent to every subscriber
+                job.subscribers.append((user_id, chat_id))
+                return "joined", 0
+            job = ReportJob(key, description)
+            job.subscribers.append((user_id, chat_id))
+            self.jobs[key] = job
+            position = sum(1 for other in self.jobs.values() if other.status == "queued")
+        self.executor.submit(self.run, job, build, on_start, on_done, on_error)
+        return "queued", position
+
+    def run(self, job : ReportJob, build, on_start, on_done, on_error):
+        content = file_name = None
+        error = None
+        try:
+            with self.lock:
+                job.status = "running"
+                subscribers = list(job.subscribers)
+            for _, chat_id in subscribers:
+                try:
+                    on_start(chat_id, job)
+                except Exception as e:
+                    print(f"Failed to notify {chat_id} about report {job.description}: {e}", flush=True)
+            report_file, file_name = build()
+            content = report_file.getvalue()
+        except Exception as e:
+            error = e
+        finally:
+            # The job is released whatever happened, otherwise its key and the user slots stay taken
+            with self.lock:
+                self.jobs.pop(job.key, None)
+                subscribers = list(job.subscribers)
+                for user_id, _ in subscribers:
+                    self.user_jobs[user_id] -= 1
+            for _, chat_id in subscribers:
+                try:
+                    if error is None:
+                        on_done(chat_id, io.BytesIO(content), file_name)
+                    else:
+                        on_error(chat_id, error)
+                except Exception as e:
+                    print(f"Failed to deliver report {job.description} to {chat_id}: {e}", flush=True)
+
+    def get_user_jobs(self, user_id : int) -> List[ReportJob]:
+        with self.lock:
+            return [job for job in self.jobs.values() if any(user == user_id for user, _ in job.subscribers)]
+
+report_jobs = ReportJobQueue(
+    int(os.getenv('REPORT_WORKERS', 2)),
+    int(os.getenv('REPORT_JOBS_PER_USER', 2))
+)
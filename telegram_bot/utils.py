@@ -1,9 +1,46 @@
 import io
-from typing import Tuple, List
+import csv
+import heapq
+from typing import Tuple, List, Iterable, Sequence
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from openpyxl import Workbook
 
 from index_db.operations import BrandRepository, SellerRepository, ProductRepository
+from index_db.rollups import RollupRepository, raw_history_cutoff
+from telegram_bot.cache import report_cache
+
+REPORT_FORMATS = ('xlsx', 'csv', 'parquet')
+STREAM_BATCH_SIZE = 1000
+
+ARROW_TYPES = {
+    'str' : pa.string(),
+    'int' : pa.int64(),
+    'float' : pa.float64(),
+    'bool' : pa.bool_(),
+    'datetime' : pa.timestamp('us'),
+}
+
+SELLER_REPORT_COLUMNS = [
+    ("Имя товара", 'str'), ("Артикул", 'int'), ("Ссылка", 'str'), ("Брэнд", 'str'),
+    ("Цена по Ozon карте", 'float'), ("Цена", 'float'), ("Рейтинг", 'float'),
+    ("Количество отзывов", 'int'), ("Количество вопросов", 'int'), ("На распродаже", 'bool')
+]
+BRAND_REPORT_COLUMNS = [
+    ("Имя товара", 'str'), ("Артикул", 'int'), ("Ссылка", 'str'), ("Продавец", 'str'),
+    ("Цена по Ozon карте", 'float'), ("Цена", 'float'), ("Рейтинг", 'float'),
+    ("Количество отзывов", 'int'), ("Количество вопросов", 'int'), ("На распродаже", 'bool')
+]
+PRODUCT_REPORT_COLUMNS = [
+    ("Цена по Ozon карте", 'float'), ("Цена", 'float'), ("Рейтинг", 'float'), ("Количество отзывов", 'int'),
+    ("Количество вопросов", 'int'), ("На распродаже", 'bool'), ("Дата", 'datetime')
+]
+KEYWORD_REPORT_COLUMNS = [
+    ("Продавец", 'str'), ("Цена по Ozon карте", 'float'), ("Цена", 'float'), ("Рейтинг", 'float'),
+    ("Количество отзывов", 'int'), ("Количество вопросов", 'int'), ("На распродаже", 'bool'),
+    ("Дата", 'datetime'), ("Ссылка(товар)", 'str'), ("Ссылка(продавец)", 'str')
+]
 
 def get_sellers_names(db) -> List[str]:
     sellers = SellerRepository.get_all(db)
@@ -18,159 +55,166 @@ def get_brands_names(db) -> List[str]:
 def get_product_count(db) -> int:
     return ProductRepository.get_product_count(db)
 
-def make_seller_report(seller_name : str, db) -> Tuple[io.BytesIO, str]:
+def write_xlsx(title : str, columns : Sequence[Tuple[str, str]], rows : Iterable[list], report_file : io.BytesIO) -> int:
+    # Write-only workbooks keep a constant memory footprint, rows are flushed as they are appended
+    workbook = Workbook(write_only=True)
+    workbook_state = workbook.create_sheet(title)
+    workbook_state.append([name for name, _ in columns])
+    rows_count = 0
+    for row in rows:
+        workbook_state.append(row)
+        rows_count += 1
+    workbook.save(report_file)
+    return rows_count
+
+def write_csv(title : str, columns : Sequence[Tuple[str, str]], rows : Iterable[list], report_file : io.BytesIO) -> int:
+    text_file = io.TextIOWrapper(report_file, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text_file)
+    writer.writerow([name for name, _ in columns])
+    rows_count = 0
+    for row in rows:
+        writer.writerow(row)
+        rows_count += 1
+    text_file.flush()
+    text_file.detach()
+    return rows_count
+
+def arrow_table(chunk : List[list], schema) -> pa.Table:
+    columns = list(zip(*chunk)) if chunk else [[] for _ in schema]
+    arrays = [pa.array(list(values), type=field.type) for values, field in zip(columns, schema)]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_parquet(title : str, columns : Sequence[Tuple[str, str]], rows : Iterable[list], report_file : io.BytesIO) -> int:
+    schema = pa.schema([(name, ARROW_TYPES[column_type]) for name, column_type in columns])
+    rows_count = 0
+    chunk = []
+    with pq.ParquetWriter(report_file, schema) as writer:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == STREAM_BATCH_SIZE:
+                writer.write_table(arrow_table(chunk, schema))
+                rows_count += len(chunk)
+                chunk = []
+        if chunk or rows_count == 0:
+            writer.write_table(arrow_table(chunk, schema))
+            rows_count += len(chunk)
+    return rows_count
+
+REPORT_WRITERS = {
+    'xlsx' : write_xlsx,
+    'csv' : write_csv,
+    'parquet' : write_parquet,
+}
+
+def write_report(title : str, columns : Sequence[Tuple[str, str]], rows : Iterable[list], report_format : str = 'xlsx') -> Tuple[io.BytesIO, int]:
+    if report_format not in REPORT_WRITERS:
+        raise ValueError(f"Report format {report_format} is not supported!")
+    report_file = io.BytesIO()
+    rows_count = REPORT_WRITERS[report_format](title, columns, rows, report_file)
+    report_file.seek(0)
+    return report_file, rows_count
+
+def to_number(value):
+    # Prices scraped from cards may be stored as text
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def make_seller_report(seller_name : str, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
     seller = SellerRepository.get_by_name(db, seller_name)
     if seller is None:
         raise KeyError(f"Seller {seller_name} does not exist!")
-    seller_id = seller.id
-
-    workbook = Workbook()
-    workbook_state = workbook.active
-    workbook_state.title = f"Отчёт по {seller_name}"
-
-    workbook_state.append([
-        "Имя товара", "Артикул", "Ссылка", "Брэнд", "Цена по Ozon карте",
-        "Цена", "Рейтинг", "Количество отзывов", "Количество вопросов", "На распродаже"
-    ])
-
-    products_states = ProductRepository.get_by_seller_id(db, seller_id)
-    for product, product_state in products_states:
-        product_name = product.name
-        product_pk = product.pk
-        product_url = product.url
-        product_brand = BrandRepository.get_by_id(db, product.brand_id)
-        if product_brand is None:
-            product_brand_name = ""
-        else:
-            product_brand_name = product_brand.name
-        product_price_ozon = product_state.price_ozon_card
-        product_price = product_state.price
-        product_rating = product_state.rating
-        product_reviews = product_state.review_count
-        product_questions = product_state.question_count
-        product_on_sale = product_state.on_sale
-        workbook_state.append([
-            product_name, product_pk, product_url, product_brand_name,
-            product_price_ozon, product_price, product_rating,
-            product_reviews, product_questions, product_on_sale
-        ])
 
-    report_file = io.BytesIO()
-    workbook.save(report_file)
-    report_file.seek(0)
-    file_name = f"{seller_name}.xlsx"
+    def rows():
+        products_states = ProductRepository.get_current_by_seller_id(db, seller.id, STREAM_BATCH_SIZE)
+        for product, product_state, product_brand, _ in products_states:
+            product_brand_name = "" if product_brand is None else product_brand.name
+            yield [
+                product.name, product.pk, product.url, product_brand_name,
+                to_number(product_state.price_ozon_card), to_number(product_state.price), product_state.rating,
+                product_state.review_count, product_state.question_count, product_state.on_sale
+            ]
+
+    version = ProductRepository.get_data_version(db, seller_id=seller.id)
+    report_file = report_cache.get_or_build(
+        ('seller', seller.id, report_format), version,
+        lambda: write_report(f"Отчёт по {seller_name}", SELLER_REPORT_COLUMNS, rows(), report_format)[0]
+    )
+    file_name = f"{seller_name}.{report_format}"
     return report_file, file_name
 
-def make_brand_report(brand_name : str, db) -> Tuple[io.BytesIO, str]:
+def make_brand_report(brand_name : str, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
     brand = BrandRepository.get_by_name(db, brand_name)
     if brand is None:
         raise KeyError(f"Brand {brand_name} does not exist!")
-    brand_id = brand.id
-
-    workbook = Workbook()
-    workbook_state = workbook.active
-    workbook_state.title = f"Отчёт по {brand_name}"
-
-    workbook_state.append([
-        "Имя товара", "Артикул", "Ссылка", "Продавец", "Цена по Ozon карте",
-        "Цена", "Рейтинг", "Количество отзывов", "Количество вопросов", "На распродаже"
-    ])
-
-    products_states = ProductRepository.get_by_brand_id(db, brand_id)
-    for product, product_state in products_states:
-        product_name = product.name
-        product_pk = product.pk
-        product_url = product.url
-        product_seller_id = product.seller_id
-        if product_seller_id:
-            product_seller = SellerRepository.get_by_id(db, product_seller_id).name
-        else:
-            product_seller = ""
-        product_price_ozon = product_state.price_ozon_card
-        product_price = product_state.price
-        product_rating = product_state.rating
-        product_reviews = product_state.review_count
-        product_questions = product_state.question_count
-        product_on_sale = product_state.on_sale
-        workbook_state.append([
-            product_name, product_pk, product_url, product_seller,
-            product_price_ozon, product_price, product_rating,
-            product_reviews, product_questions, product_on_sale
-        ])
 
-    report_file = io.BytesIO()
-    workbook.save(report_file)
-    report_file.seek(0)
-    file_name = f"{brand_name}.xlsx"
+    def rows():
+        products_states = ProductRepository.get_current_by_brand_id(db, brand.id, STREAM_BATCH_SIZE)
+        for product, product_state, _, product_seller in products_states:
+            yield [
+                product.name, product.pk, product.url, product_seller.name,
+                to_number(product_state.price_ozon_card), to_number(product_state.price), product_state.rating,
+                product_state.review_count, product_state.question_count, product_state.on_sale
+            ]
+
+    version = ProductRepository.get_data_version(db, brand_id=brand.id)
+    report_file = report_cache.get_or_build(
+        ('brand', brand.id, report_format), version,
+        lambda: write_report(f"Отчёт по {brand_name}", BRAND_REPORT_COLUMNS, rows(), report_format)[0]
+    )
+    file_name = f"{brand_name}.{report_format}"
     return report_file, file_name
 
-def make_product_report(product_pk : int, db) -> Tuple[io.BytesIO, str]:
+def make_product_report(product_pk : int, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
     product = ProductRepository.get_by_pk(db, product_pk)
     if product is None:
         raise KeyError(f"Product with {product_pk} does not exist!")
 
-    workbook = Workbook()
-    workbook_state = workbook.active
-    workbook_state.title = f"Отчёт по товару {product_pk}"
-
-    workbook_state.append([
-        "Цена по Ozon карте", "Цена", "Рейтинг", "Количество отзывов",
-        "Количество вопросов", "На распродаже", "Дата"
-    ])
-
-    product_history = ProductRepository.get_product_history(db, product.id)
-    for state in product_history:
-        price_ozon = state.price_ozon_card
-        price = state.price
-        rating = state.rating
-        reviews = state.review_count
-        questions = state.question_count
-        on_sale = state.on_sale
-        created_at = state.created_at
-        workbook_state.append([
-            price_ozon, price, rating, reviews, questions, on_sale, created_at
-        ])
-
-    report_file = io.BytesIO()
-    workbook.save(report_file)
-    report_file.seek(0)
-    file_name = f"{product_pk}.xlsx"
+    # Recent states are reported raw, older days come from the daily rollups with the last values of each day
+    cutoff = raw_history_cutoff()
+    rolled_up_id = RollupRepository.get_rolled_up_id(db)
+
+    def rows():
+        recent_states = (
+            [
+                to_number(state.price_ozon_card), to_number(state.price), state.rating, state.review_count,
+                state.question_count, state.on_sale, state.created_at
+            ]
+            for state in RollupRepository.get_recent_history(db, product.id, cutoff, rolled_up_id).yield_per(STREAM_BATCH_SIZE)
+        )
+        daily_states = (
+            [
+                rollup.last_price_ozon_card, rollup.last_price, rollup.last_rating, rollup.last_review_count,
+                rollup.last_question_count, rollup.last_on_sale, rollup.bucket_start
+            ]
+            for rollup in RollupRepository.get_product_rollups(db, product.id, 'day', cutoff).yield_per(STREAM_BATCH_SIZE)
+        )
+        yield from heapq.merge(recent_states, daily_states, key=lambda row: row[-1], reverse=True)
+
+    # Every history row is reported, not only the current one, and rollup progress decides which of them are read raw
+    version = (ProductRepository.get_last_history_id(db, product.id), rolled_up_id, cutoff)
+    report_file = report_cache.get_or_build(
+        ('product', product.id, report_format), version,
+        lambda: write_report(f"Отчёт по товару {product_pk}", PRODUCT_REPORT_COLUMNS, rows(), report_format)[0]
+    )
+    file_name = f"{product_pk}.{report_format}"
     return report_file, file_name
 
-def make_products_report_by_keyword(product_keyword : str, db) -> Tuple[io.BytesIO, str]:
-    products = ProductRepository.get_by_keyword(db, product_keyword)
-    if products is None:
+def make_products_report_by_keyword(product_keyword : str, db, report_format : str = 'xlsx') -> Tuple[io.BytesIO, str]:
+    def rows():
+        products = ProductRepository.get_current_by_keyword(db, product_keyword, STREAM_BATCH_SIZE)
+        for product, state, _, seller in products:
+            yield [
+                seller.name, to_number(state.price_ozon_card), to_number(state.price), state.rating,
+                state.review_count, state.question_count, state.on_sale, state.created_at,
+                product.url, seller.url
+            ]
+
+    report_file, rows_count = write_report(f"Отчёт по товару {product_keyword}", KEYWORD_REPORT_COLUMNS, rows(), report_format)
+    if rows_count == 0:
         raise KeyError(f"Product containing {product_keyword} does not exist!")
-
-    workbook = Workbook()
-    workbook_state = workbook.active
-    workbook_state.title = f"Отчёт по товару {product_keyword}"
-
-    workbook_state.append([
-        "Продавец", "Цена по Ozon карте", "Цена", "Рейтинг", "Количество отзывов",
-        "Количество вопросов", "На распродаже", "Дата", "Ссылка(товар)", "Ссылка(продавец)"
-    ])
-
-    for product in products:
-        seller = SellerRepository.get_by_id(db, product.seller_id)
-        state = ProductRepository.get_last_state(db, product.id)
-        seller_name = seller.name
-        price_ozon = state.price_ozon_card
-        price = state.price
-        rating = state.rating
-        reviews = state.review_count
-        questions = state.question_count
-        on_sale = state.on_sale
-        created_at = state.created_at
-        product_url = product.url
-        seller_url = seller.url
-        workbook_state.append([
-            seller_name, price_ozon, price, rating, reviews, questions,
-            on_sale, created_at, product_url, seller_url
-        ])
-
-    report_file = io.BytesIO()
-    workbook.save(report_file)
-    report_file.seek(0)
-    file_name = f"{product_keyword}.xlsx"
+    file_name = f"{product_keyword}.{report_format}"
     return report_file, file_name
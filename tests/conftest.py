@@ -0,0 +1,19 @@
+import pytest
+
+from index_db.db import dispose_engines, get_session_factory, init_db
+from index_db.operations import product_state_index
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    url = f"sqlite:///{tmp_path / 'ozon.db'}"
+    init_db(url)
+    yield url
+    dispose_engines()
+
+@pytest.fixture
+def db(database_url):
+    product_state_index.clear()
+    session = get_session_factory(database_url)()
+    yield session
+    session.close()
@@ -0,0 +1,44 @@
+import datetime
+
+import numpy as np
+
+from telegram_bot.analytics import compute_price_analytics, load_history
+
+
+def history_row(product_id : int, price : float, card_price : float, day : datetime.datetime) -> tuple:
+    return (product_id, price, card_price, False, day)
+
+def test_period_change_of_stale_states_stays_within_product():
+    # States are only written on change, so the last state of a product is often older than the period
+    rows = [
+        history_row(1, 120, 100, datetime.datetime(2024, 1, 1)),
+        history_row(1, 220, 200, datetime.datetime(2024, 1, 10)),
+        history_row(2, 50, 40, datetime.datetime(2024, 1, 2)),
+        history_row(2, 30, 20, datetime.datetime(2024, 1, 20)),
+        history_row(3, 10, 10, datetime.datetime(2024, 1, 5)),
+    ]
+    now = datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc).timestamp()
+    analytics = compute_price_analytics(load_history(rows), now)
+    assert analytics['product_ids'].tolist() == [1, 2, 3]
+    assert analytics['card_price'].tolist() == [200, 20, 10]
+    assert analytics['change_7d'].tolist() == [0, 0, 0]
+    assert analytics['change_30d'].tolist() == [0, 0, 0]
+
+def test_period_change_compares_with_state_in_force():
+    rows = [
+        history_row(1, 120, 100, datetime.datetime(2024, 1, 1)),
+        history_row(1, 220, 200, datetime.datetime(2024, 2, 25)),
+        history_row(2, 30, 20, datetime.datetime(2024, 1, 20)),
+        history_row(2, 50, 40, datetime.datetime(2024, 2, 28)),
+    ]
+    now = datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc).timestamp()
+    analytics = compute_price_analytics(load_history(rows), now)
+    assert analytics['change_7d'].tolist() == [100, 100]
+    assert analytics['change_30d'].tolist() == [100, 100]
+
+def test_period_change_is_unknown_before_first_state():
+    rows = [history_row(1, 120, 100, datetime.datetime(2024, 2, 28)), history_row(2, 10, 10, datetime.datetime(2024, 1, 1))]
+    now = datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc).timestamp()
+    analytics = compute_price_analytics(load_history(rows), now)
+    assert np.isnan(analytics['change_7d'][0])
+    assert analytics['change_7d'][1] == 0
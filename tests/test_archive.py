@@ -0,0 +1,19 @@
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ozon_scraper.archive import PageArchive
+
+
+def test_writers_with_separate_locks_share_objects(tmp_path):
+    # Every crawler process has its own archive and lock over the same directory
+    html_src = "<html>" + "товар " * 50000 + "</html>"
+    archives = [PageArchive(str(tmp_path), codec='gzip') for _ in range(8)]
+    with ThreadPoolExecutor(len(archives)) as executor:
+        hashes = list(executor.map(
+            lambda archive: archive.put("https://www.ozon.ru/product/tovar-1/", html_src), archives * 4
+        ))
+    assert len(set(hashes)) == 1
+    assert archives[0].get(hashes[0], 'gzip') == html_src
+    assert not glob.glob(os.path.join(str(tmp_path), "objects", "*", "*.tmp"))
+    assert len(archives[0].records()) == 32
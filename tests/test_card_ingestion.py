@@ -0,0 +1,56 @@
+import datetime
+
+import pytest
+from sqlalchemy import event
+
+from index_db.models import ProductPageVisit
+from index_db.operations import ProductRepository, SellerRepository, batch, product_state_index, utc_now
+from ozon_scraper import parser
+
+
+def card(pk : int, price : float = 100.0) -> dict:
+    return {
+        'pk' : pk, 'name' : f"Товар {pk}", 'url' : f"https://www.ozon.ru/product/tovar-{pk}/", 'on_sale' : False,
+        'price_ozon_card' : price, 'rating' : 4.5, 'review_count' : 10, 'brand_name' : None,
+    }
+
+def store_products(db, count : int, visited_at : datetime.datetime):
+    seller = SellerRepository.get_or_create(db, "Продавец", "https://www.ozon.ru/seller/prodavec-1/")
+    for pk in range(1, count + 1):
+        product_description = dict(card(pk), price=120.0, question_count=3, seller_id=seller.id, brand_id=None)
+        product = ProductRepository.get_or_create(db, product_description)
+        ProductRepository.add_state(db, product.id, product_description)
+        db.merge(ProductPageVisit(product_id=product.id, visited_at=visited_at))
+    db.commit()
+    product_state_index.warm(db)
+
+def count_statements(db):
+    statements = []
+    event.listen(db.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    return statements
+
+@pytest.fixture(autouse=True)
+def match_every_card(monkeypatch):
+    monkeypatch.setattr(parser.keyword_matcher, 'matches', lambda name, brand_name: True)
+    monkeypatch.setattr(parser, 'CARD_INGESTION', True)
+
+def test_unchanged_cards_of_known_products_cost_no_queries(db):
+    store_products(db, 100, utc_now())
+    statements = count_statements(db)
+    with batch(db):
+        urls = [parser.parse_product_card(card(pk), db) for pk in range(1, 101)]
+    assert urls == [None] * 100
+    assert not [statement for statement in statements if statement.lstrip().upper().startswith("SELECT")]
+
+def test_changed_card_is_written_without_visiting_the_page(db):
+    store_products(db, 1, utc_now())
+    with batch(db):
+        assert parser.parse_product_card(card(1, price=90.0), db) is None
+    history = ProductRepository.get_product_history(db, ProductRepository.get_by_pk(db, 1).id).all()
+    assert [(state.price_ozon_card, state.price, state.question_count) for state in history] == [(90, 120, 3), (100, 120, 3)]
+
+def test_stale_product_page_and_new_product_are_visited(db):
+    store_products(db, 1, utc_now() - datetime.timedelta(days=30))
+    with batch(db):
+        assert parser.parse_product_card(card(1), db) == card(1)['url']
+        assert parser.parse_product_card(card(2), db) == card(2)['url']
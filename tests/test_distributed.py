@@ -0,0 +1,59 @@
+import time
+
+from index_db.db import get_session_factory
+from index_db.operations import FrontierRepository
+from ozon_scraper.distributed import LeasedFrontier
+
+
+def tasks(*numbers : int) -> list:
+    return [(f"product:{number}", f"https://www.ozon.ru/product/tovar-{number}/") for number in numbers]
+
+def test_duplicate_inserts_are_ignored(db, database_url):
+    assert FrontierRepository.add_many_ignore(db, tasks(1, 2)) == 2
+    # Another process pushing the same links adds nothing
+    other_db = get_session_factory(database_url)()
+    try:
+        assert FrontierRepository.add_many_ignore(other_db, tasks(2, 3)) == 1
+    finally:
+        other_db.close()
+    assert FrontierRepository.count_by_status(db) == {"pending": 3}
+
+def test_leases_do_not_overlap(db, database_url):
+    FrontierRepository.add_many_ignore(db, tasks(1, 2, 3))
+    other_db = get_session_factory(database_url)()
+    try:
+        first = FrontierRepository.lease(db, "worker-1", 2, 60)
+        second = FrontierRepository.lease(other_db, "worker-2", 2, 60)
+    finally:
+        other_db.close()
+    assert [task.key for task in first] == ["product:1", "product:2"]
+    assert [task.key for task in second] == ["product:3"]
+    assert FrontierRepository.lease(db, "worker-1", 2, 60) == []
+    assert FrontierRepository.count_by_status(db) == {"leased": 3}
+
+def test_expired_leases_are_reclaimed(db):
+    FrontierRepository.add_many_ignore(db, tasks(1, 2))
+    FrontierRepository.lease(db, "crashed", 1, 0.01)
+    FrontierRepository.lease(db, "alive", 1, 60)
+    time.sleep(0.05)
+    assert FrontierRepository.reclaim_expired(db) == 1
+    assert FrontierRepository.count_by_status(db) == {"pending": 1, "leased": 1}
+    assert [task.key for task in FrontierRepository.lease(db, "alive", 2, 60)] == ["product:1"]
+
+def test_heartbeat_keeps_leases_alive(db):
+    FrontierRepository.add_many_ignore(db, tasks(1))
+    FrontierRepository.lease(db, "worker-1", 1, 0.01)
+    assert FrontierRepository.heartbeat(db, "worker-1", 60) == 1
+    time.sleep(0.05)
+    assert FrontierRepository.reclaim_expired(db) == 0
+
+def test_completed_round_is_finished(database_url):
+    frontier = LeasedFrontier(database_url, owner="worker-1")
+    try:
+        assert frontier.seed(["https://www.ozon.ru/product/tovar-1/", "https://www.ozon.ru/product/tovar-1/?at=1"]) == 1
+        [task] = frontier.lease(4)
+        assert not frontier.is_finished()
+        frontier.complete(task)
+        assert frontier.is_finished()
+    finally:
+        frontier.close()
@@ -0,0 +1,99 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from ozon_scraper.http_driver import PAGE_API_PATH, IncompletePageError, OzonApiDriver
+from ozon_scraper.parser import LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR
+
+PAGES = {
+    "/seller/prodavec-1/": {
+        'widgetStates' : {"sellerTransparency-1" : "{}", "tileGridDesktop-2" : '{"items": [1]}'},
+        'nextPage' : "/seller/prodavec-1/?page=2",
+    },
+    "/seller/prodavec-1/?page=2": {'widgetStates' : {"tileGridDesktop-2" : '{"items": [2]}'}},
+    "/seller/bez-vidzhetov-2/": {'widgetStates' : {"tileGridDesktop-2" : '{"items": []}'}},
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        page_url = parse_qs(parts.query).get('url', [""])[0]
+        self.server.requests.append(page_url)
+        if parts.path != PAGE_API_PATH or page_url.startswith("/seller/zablokirovan"):
+            self.respond(403, "text/html", "<html>Доступ ограничен</html>".encode("utf-8"))
+        elif page_url.startswith("/seller/proverka"):
+            self.respond(200, "text/html", b"<html>challenge</html>")
+        elif page_url in PAGES:
+            self.respond(200, "application/json", json.dumps(PAGES[page_url]).encode('utf-8'))
+        else:
+            self.respond(404, "text/plain", b"")
+
+    def respond(self, status : int, content_type : str, body : bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class BrowserStub:
+    def __init__(self):
+        self.loads = []
+
+    def load_page(self, url : str, *args, **kwargs) -> str:
+        self.loads.append(url)
+        return "<html>browser</html>"
+
+    def quit(self):
+        pass
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def browser():
+    return BrowserStub()
+
+@pytest.fixture
+def driver(stub_server, browser):
+    driver = OzonApiDriver(f"http://127.0.0.1:{stub_server.server_port}", fallback=lambda: browser)
+    yield driver
+    driver.quit()
+
+def test_next_pages_are_merged(driver, stub_server, browser):
+    html_src = driver.load_page("https://www.ozon.ru/seller/prodavec-1/", LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR)
+    assert json.loads(html_src) == {'widgetStates' : {
+        "sellerTransparency-1" : "{}", "tileGridDesktop-2" : '{"items": [1]}', "tileGridDesktop-2-page1" : '{"items": [2]}'
+    }}
+    assert stub_server.requests == ["/seller/prodavec-1/", "/seller/prodavec-1/?page=2"]
+    assert browser.loads == []
+
+@pytest.mark.parametrize("url", ["https://www.ozon.ru/seller/zablokirovan-3/", "https://www.ozon.ru/seller/proverka-4/"])
+def test_blocked_api_falls_back_to_browser(driver, stub_server, browser, url):
+    assert driver.load_page(url, LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR) == "<html>browser</html>"
+    # The browser alone is used while the block cools down
+    assert driver.load_page("https://www.ozon.ru/seller/prodavec-1/", LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR) == "<html>browser</html>"
+    assert len(stub_server.requests) == 1
+    assert browser.loads == [url, "https://www.ozon.ru/seller/prodavec-1/"]
+
+def test_missing_widgets_make_page_incomplete(driver, stub_server, browser):
+    with pytest.raises(IncompletePageError):
+        driver.fetch_page("https://www.ozon.ru/seller/bez-vidzhetov-2/", 5, {"sellerTransparency"})
+    # An incomplete page is loaded in the browser once, without blocking the API
+    url = "https://www.ozon.ru/seller/bez-vidzhetov-2/"
+    assert driver.load_page(url, LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR) == "<html>browser</html>"
+    assert driver.load_page("https://www.ozon.ru/seller/prodavec-1/", LISTING_READY_SELECTORS, LISTING_TILES_SELECTOR) != "<html>browser</html>"
+    assert browser.loads == [url]
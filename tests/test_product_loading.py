@@ -0,0 +1,30 @@
+from ozon_scraper import parser
+
+
+class StagedDriver:
+    # The open page renders its widgets only after the first wait
+    def __init__(self, wait_pages : list):
+        self.loads = []
+        self.wait_pages = list(wait_pages)
+
+    def load_page(self, url : str, ready_selectors, timeout : float = 15000) -> str:
+        self.loads.append((ready_selectors, timeout))
+        return "loading"
+
+    def wait_page(self, ready_selectors, timeout : float = 15000):
+        return self.wait_pages.pop(0) if self.wait_pages else None
+
+def parse_rendered(url : str, html_src : str, db, refresh_after_seconds=None):
+    return ["https://www.ozon.ru/seller/prodavec-1/"] if html_src == "rendered" else None
+
+def test_product_page_is_waited_for_instead_of_reloaded(monkeypatch):
+    monkeypatch.setattr(parser, 'parse_product_source', parse_rendered)
+    driver = StagedDriver(["rendered"])
+    assert parser.parse_product("https://www.ozon.ru/product/tovar-1/", None, driver) == ["https://www.ozon.ru/seller/prodavec-1/"]
+    assert driver.loads == [(parser.PRODUCT_STATE_SELECTORS, 5000)]
+
+def test_product_page_is_reloaded_when_waiting_fails(monkeypatch):
+    monkeypatch.setattr(parser, 'parse_product_source', parse_rendered)
+    driver = StagedDriver(["loading"])
+    assert parser.parse_product("https://www.ozon.ru/product/tovar-1/", None, driver) == []
+    assert driver.loads == [(parser.PRODUCT_STATE_SELECTORS, 5000), (parser.PRODUCT_READY_SELECTORS, parser.PRODUCT_LOAD_TIMEOUTS[-1])]
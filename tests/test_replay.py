@@ -0,0 +1,43 @@
+import datetime
+
+from index_db.operations import BrandRepository, ProductRepository, SellerRepository, batch, utc_now
+
+
+def replaying(db, observed_at : datetime.datetime):
+    db.info['observed_at'] = observed_at
+    return batch(db)
+
+def test_replay_only_moves_last_update_forward(db):
+    seller = SellerRepository.get_or_create(db, "Продавец", "https://www.ozon.ru/seller/prodavec-1/")
+    brand = BrandRepository.get_or_create(db, "Бренд", "https://www.ozon.ru/brand/brend-1/")
+    SellerRepository.update(db, seller.id)
+    BrandRepository.update(db, brand.id)
+    crawled_at, brand_crawled_at = seller.last_update, brand.last_update
+    with replaying(db, utc_now() - datetime.timedelta(days=10)):
+        SellerRepository.update(db, seller.id)
+        BrandRepository.update(db, brand.id)
+    assert seller.last_update == crawled_at
+    assert brand.last_update == brand_crawled_at
+
+    fetched_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    new_seller = SellerRepository.get_or_create(db, "Новый продавец", "https://www.ozon.ru/seller/novyy-2/")
+    with replaying(db, fetched_at):
+        SellerRepository.update(db, new_seller.id)
+    assert new_seller.last_update == datetime.datetime(2024, 1, 1)
+
+def test_replay_of_older_page_keeps_the_seller(db):
+    old_seller = SellerRepository.get_or_create(db, "Старый", "https://www.ozon.ru/seller/staryy-1/")
+    new_seller = SellerRepository.get_or_create(db, "Новый", "https://www.ozon.ru/seller/novyy-2/")
+    product_description = {
+        'pk' : 1, 'name' : "Товар", 'url' : "https://www.ozon.ru/product/tovar-1/", 'on_sale' : False, 'price' : 120.0,
+        'price_ozon_card' : 100.0, 'rating' : 4.5, 'review_count' : 10, 'question_count' : 3,
+        'seller_id' : new_seller.id, 'brand_id' : None,
+    }
+    product = ProductRepository.get_or_create(db, product_description)
+    ProductRepository.add_state(db, product.id, product_description)
+    with replaying(db, utc_now() - datetime.timedelta(days=10)):
+        ProductRepository.change_seller(db, product, old_seller.id)
+    assert product.seller_id == new_seller.id
+    with replaying(db, utc_now() + datetime.timedelta(minutes=1)):
+        ProductRepository.change_seller(db, product, old_seller.id)
+    assert product.seller_id == old_seller.id
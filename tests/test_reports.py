@@ -0,0 +1,31 @@
+import datetime
+
+from index_db.operations import ProductRepository, SellerRepository, batch, utc_now
+from telegram_bot.cache import report_cache
+from telegram_bot.utils import make_product_report
+
+
+def product_description(seller_id : int, price_ozon_card : float) -> dict:
+    return {
+        'pk' : 1, 'name' : "Товар", 'url' : "https://www.ozon.ru/product/tovar-1/", 'on_sale' : False, 'price' : 120.0,
+        'price_ozon_card' : price_ozon_card, 'rating' : 4.5, 'review_count' : 10, 'question_count' : 3,
+        'seller_id' : seller_id, 'brand_id' : None,
+    }
+
+def report_lines(db) -> list:
+    report_file, _ = make_product_report(1, db, 'csv')
+    return report_file.getvalue().decode('utf-8').splitlines()
+
+def test_product_report_cache_sees_replayed_history(db):
+    report_cache.clear()
+    seller = SellerRepository.get_or_create(db, "Продавец", "https://www.ozon.ru/seller/prodavec-1/")
+    product = ProductRepository.get_or_create(db, product_description(seller.id, 100.0))
+    ProductRepository.add_state(db, product.id, product_description(seller.id, 100.0))
+    assert len(report_lines(db)) == 2
+
+    # An older page adds a history row that does not become the current state
+    db.info['observed_at'] = utc_now() - datetime.timedelta(days=2)
+    with batch(db):
+        ProductRepository.add_state(db, product.id, product_description(seller.id, 90.0))
+    db.info.pop('observed_at')
+    assert len(report_lines(db)) == 3